@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    检查 import dayu_database 的启动时间。
+
+    每一个检查都会启动一个新的python 进程，记录import 的耗时，以及import 之后是否已经加载了不应该加载的模块
+    （例如sqlalchemy、table.py）。重复多次取最小值，减少硬盘缓存、系统负载的影响。
+    任何一项超过预算，或者加载了重型模块，进程返回1，可以直接放到CI 中运行。
+
+    使用方法（在仓库根目录）：
+        python benchmark/import_time.py
+        python benchmark/import_time.py --budget 80 --repeat 10
+
+    '''
+
+import json
+import os
+import subprocess
+import sys
+
+# 默认预算，单位ms
+DEFAULT_BUDGET = 50.0
+
+# import 之后不应该出现在 sys.modules 中的模块
+HEAVY_MODULES = ('sqlalchemy', 'dayu_database.base', 'dayu_database.table')
+
+# (说明, import 语句)
+TARGETS = (('import dayu_database', 'import dayu_database'),
+           ('DBPath', 'from dayu_database.db_path import DBPath'),
+           ('filter_parse', 'import dayu_database.filter_parse'),
+           ('sub_level', 'import dayu_database.sub_level'))
+
+CHILD_SCRIPT = '''
+import json, sys, time
+start = time.time()
+exec(sys.argv[1])
+cost = (time.time() - start) * 1000.0
+heavy = [h for h in json.loads(sys.argv[2]) if sys.modules.get(h, None) is not None]
+sys.stdout.write(json.dumps({'cost': cost, 'heavy': heavy}))
+'''
+
+
+def measure(statement, repeat=5):
+    '''
+    在新的进程中执行import 语句
+    :param statement: string，import 语句
+    :param repeat: int，重复的次数
+    :return: tuple，(最小的耗时ms, 加载了的重型模块 list)
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(x for x in (root, env.get('PYTHONPATH', None)) if x)
+
+    costs = []
+    heavy = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', CHILD_SCRIPT, statement, json.dumps(HEAVY_MODULES)],
+                                         env=env, cwd=root)
+        result = json.loads(output)
+        costs.append(result['cost'])
+        heavy = result['heavy']
+    return min(costs), heavy
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='check import time of dayu_database')
+    parser.add_argument('--budget', type=float, default=float(os.environ.get('DAYU_DB_IMPORT_BUDGET', DEFAULT_BUDGET)),
+                        help='budget of every import, in ms')
+    parser.add_argument('--repeat', type=int, default=5, help='run every import N times, use the fastest one')
+    args = parser.parse_args(argv)
+
+    failed = False
+    for label, statement in TARGETS:
+        cost, heavy = measure(statement, repeat=args.repeat)
+        ok = cost <= args.budget and not heavy
+        failed = failed or not ok
+        print '{:<24} {:>8.1f} ms  {}{}'.format(label, cost, 'ok' if ok else 'FAIL',
+                                                 '  (loaded: {})'.format(', '.join(heavy)) if heavy else '')
+
+    print 'budget: {} ms'.format(args.budget)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
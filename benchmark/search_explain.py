@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    对比SEARCH 中relationship 过滤条件的两种执行计划：
+    * join：多对一的relationship（top.name、parent.parent.name、created_by.name）使用LEFT JOIN
+    * exists：和原本一样，全部使用 has()、any() 生成的EXISTS 子查询
+
+    每一个示例的过滤条件都会分别编译成两种SearchPlan，通过 EXPLAIN (ANALYZE, FORMAT JSON) 得到
+    planner 估计的cost、实际的执行时间，以及两种方式的结果数量（应该完全相同）。
+
+    需要一个已经初始化的数据库（init_db）。如果指定了 --shots，会先在 --parent 下用 bulk_create 生成一个合成的项目，
+    benchmark 结束之后回滚，不会留下数据（--keep 可以保留）。
+
+    使用方法（在仓库根目录）：
+        python benchmark/search_explain.py --db test --static /path/to/static --parent /dayu/sequence/pl --shots 300
+        python benchmark/search_explain.py --db test --parent /dayu/sequence/pl --no-analyze --verbose
+
+    '''
+
+import os
+import sys
+import time
+
+# bulk_create 使用的spec，shot、version 从1 开始
+DEFAULT_SPEC = '{shot:04d}/element/plt/bga/v{version:04d}'
+
+
+def samples(parent):
+    '''
+    根据parent 生成示例的过滤条件
+    :param parent: FOLDER orm，合成项目所在的文件夹
+    :return: list of tuple，(说明, target_table, filters)
+    '''
+    project_name = parent.top.name if parent.top else parent.name
+    prefix = parent.name + '%'
+
+    def condition(col, op, value):
+        return {'col': col, 'op': op, 'value': value, 'type': 'VARCHAR', 'do': True}
+
+    return [('file: top.name',
+             'file', {'and': [condition('top.name', 'eq', project_name)]}),
+            ('file: parent.parent.name + top.name',
+             'file', {'and': [condition('parent.parent.name', 'like', prefix),
+                              condition('top.name', 'eq', project_name)]}),
+            ('file: created_by.name',
+             'file', {'and': [condition('created_by.name', 'ne', ''),
+                              condition('name', 'like', prefix)]}),
+            ('file: not parent.name',
+             'file', {'and': [condition('name', 'like', prefix),
+                              {'not': [condition('parent.name', 'like', prefix)]}]}),
+            ('folder: sub_files.name + top.name',
+             'folder', {'and': [condition('sub_files.name', 'like', prefix),
+                                condition('top.name', 'eq', project_name)]})]
+
+
+def explain(session, plan, analyze=True):
+    '''
+    EXPLAIN 一个SearchPlan
+    :param session: sqlalchemy session
+    :param plan: SearchPlan
+    :param analyze: bool，是否实际执行（EXPLAIN ANALYZE）
+    :return: dict，EXPLAIN (FORMAT JSON) 的结果
+    '''
+    import sqlalchemy.event
+
+    query = plan._result(session)._as_query()
+    prefix = 'EXPLAIN ({}) '.format('ANALYZE, FORMAT JSON' if analyze else 'FORMAT JSON')
+
+    # JSONB、expanding 的参数没有办法编译成字面量，所以在发送给数据库之前加上 EXPLAIN，参数仍然由驱动处理
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        return prefix + statement, parameters
+
+    connection = session.connection()
+    sqlalchemy.event.listen(connection, 'before_cursor_execute', before_cursor_execute, retval=True)
+    try:
+        return connection.execute(query.statement, query._params).scalar()[0]
+    finally:
+        sqlalchemy.event.remove(connection, 'before_cursor_execute', before_cursor_execute)
+
+
+def node_types(node):
+    '''
+    执行计划中用到的节点类型，例如 Hash Join、Nested Loop、SubPlan
+    '''
+    result = [node['Node Type'] + (' ({})'.format(node['Subplan Name']) if node.get('Subplan Name') else '')]
+    for sub in node.get('Plans', []):
+        result.extend(node_types(sub))
+    return result
+
+
+def create_project(session, parent, shots, versions, spec=DEFAULT_SPEC):
+    '''
+    在parent 下生成合成的项目
+    :return: int，新建的FILE 数量
+    '''
+    from dayu_database import bulk
+
+    specs = [spec.format(shot=x * 10, version=v) for x in range(1, shots + 1) for v in range(1, versions + 1)]
+    start = time.time()
+    bulk.bulk_create(parent, specs, session=session)
+    print 'created {} items in {:.2f} s'.format(len(specs), time.time() - start)
+    return len(specs)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='compare JOIN and EXISTS plans of SEARCH relationship filters')
+    parser.add_argument('--db', default=os.environ.get('DAYU_DB_NAME', 'default'), help='database name')
+    parser.add_argument('--static', default=None, help='DAYU_CONFIG_STATIC_PATH, folder contains db_url/<db>.json')
+    parser.add_argument('--parent', required=True, help='DBPath of the folder, e.g. /dayu/sequence/pl')
+    parser.add_argument('--shots', type=int, default=0, help='create N synthetic shots under parent')
+    parser.add_argument('--versions', type=int, default=10, help='versions of every synthetic shot')
+    parser.add_argument('--spec', default=DEFAULT_SPEC, help='bulk_create spec of every synthetic item')
+    parser.add_argument('--keep', action='store_true', help='commit the synthetic project instead of rollback')
+    parser.add_argument('--no-analyze', dest='analyze', action='store_false', help='only EXPLAIN, do not execute')
+    parser.add_argument('--verbose', action='store_true', help='print node types of every plan')
+    args = parser.parse_args(argv)
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, root)
+    # DBPath、util 等内部调用 get_session() 时使用的是环境变量中的数据库
+    os.environ['DAYU_DB_NAME'] = args.db
+
+    import dayu_database
+    from dayu_database.db_path import DBPath
+    from dayu_database import search_plan
+    from dayu_database.config.const import DAYU_CONFIG_STATIC_PATH
+
+    db = dayu_database.get_db(args.db)
+    if args.static:
+        db.config.update(**{DAYU_CONFIG_STATIC_PATH: args.static})
+    db.connect()
+    session = dayu_database.get_session()
+
+    parent = DBPath(args.parent).orm()
+    if parent is None:
+        print 'no such folder: {}'.format(args.parent)
+        return 1
+
+    try:
+        if args.shots:
+            create_project(session, parent, args.shots, args.versions, spec=args.spec)
+            session.flush()
+        session.execute('ANALYZE folder; ANALYZE file')
+
+        print '{:<40} {:<7} {:>12} {:>10} {:>8}'.format('sample', 'mode', 'cost', 'time ms', 'rows')
+        for label, target_table, filters in samples(parent):
+            counts = {}
+            for mode in ('join', 'exists'):
+                plan = search_plan.compile_plan(target_table, filters, join=mode == 'join')
+                result = explain(session, plan, analyze=args.analyze)
+                counts[mode] = plan.count(session)
+                print '{:<40} {:<7} {:>12.1f} {:>10} {:>8}'.format(
+                        label, mode, result['Plan']['Total Cost'],
+                        '{:.2f}'.format(result['Execution Time']) if 'Execution Time' in result else '-',
+                        counts[mode])
+                if args.verbose:
+                    print '    ' + ' -> '.join(node_types(result['Plan']))
+            if counts['join'] != counts['exists']:
+                print '    WARNING: different result count!'
+    finally:
+        if args.keep:
+            session.commit()
+        else:
+            session.rollback()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,21 +2,32 @@
 # -*- encoding: utf-8 -*-
 
 __author__ = 'andyguo'
+__doc__ = \
+    '''
+    dayu_database 的入口。
+
+    import dayu_database 只会加载很轻量的模块（配置、状态，以及DayuPath 的插件注册），
+    sqlalchemy、table.py 中的orm 定义、数据库反射都会在第一次 connect()、第一次使用session 的时候才加载。
+    engine 和连接池由 engine.py 在进程内统一管理，每一个线程通过 get_session() 得到自己的session。
+    这样只需要 DBPath 字符串操作、filter_parse token 的小工具，可以在几毫秒内启动。
+
+    import 的耗时可以通过 benchmark/import_time.py 检查。
+    '''
 
 import os
 import threading
 
-from sqlalchemy import create_engine
-from sqlalchemy.engine.url import URL
-from sqlalchemy.orm import sessionmaker
-
 import dayu_path_patch
-from config.const import DAYU_DB_NAME, DAYU_CONFIG_STATIC_PATH
+from config.const import DAYU_DB_NAME, DAYU_CONFIG_STATIC_PATH, DAYU_DB_REFLECTION_CACHE
 from config import DayuDatabaseConfig
 from status import DayuDatabaseStatusNotConnect, DayuDatabaseStatusConnected
-from deco import lazy
 
+# key 是数据库的名字。同一个进程内所有的线程共享同一个DayuDatabase（以及同一个engine、连接池），session 按照线程分配
 _database_context = {}
+_context_lock = threading.RLock()
+
+# 已经完成反射、BASE.prepare() 的数据库url
+_prepared_urls = set()
 
 
 def get_session(db=None):
@@ -27,10 +38,20 @@ def get_session(db=None):
     return db_instance.session
 
 
+def remove_session(db=None):
+    '''
+    关闭当前线程的session，把连接还给连接池。线程池的worker 每完成一次任务之后调用
+    :param db: string，数据库的名字
+    :return: None
+    '''
+    db_instance = get_db(db)
+    if db_instance.status is DayuDatabaseStatusConnected:
+        db_instance.remove_session()
+
+
 def get_db(db=None):
-    current_threading_id = id(threading.current_thread())
     db = db or os.environ.get(DAYU_DB_NAME, None) or 'default'
-    db_instance = _database_context.get(current_threading_id, {}).get(db, None)
+    db_instance = _database_context.get(db, None)
     if db_instance is None:
         db_instance = DayuDatabase(db=db)
     return db_instance
@@ -42,19 +63,18 @@ class DayuDatabase(object):
 
     def __new__(cls, db=None):
         db = db or os.environ.get(DAYU_DB_NAME, None) or 'default'
-        current_threading_id = id(threading.current_thread())
-        instance = _database_context.get(current_threading_id, {}).get(db, None)
-        if instance:
+        with _context_lock:
+            instance = _database_context.get(db, None)
+            if instance:
+                return instance
+
+            instance = super(DayuDatabase, cls).__new__(cls, db=db)
+            instance.status = DayuDatabaseStatusNotConnect
+            instance.config = DayuDatabaseConfig(parent=instance)
+            instance.config.update(DAYU_DB_NAME=db)
+            _database_context[db] = instance
             return instance
 
-        instance = super(DayuDatabase, cls).__new__(cls, db=db)
-        instance.status = DayuDatabaseStatusNotConnect
-        instance.config = DayuDatabaseConfig(parent=instance)
-        instance.config.update(DAYU_DB_NAME=db)
-        current_threading_db = _database_context.setdefault(current_threading_id, {})
-        current_threading_db[db] = instance
-        return instance
-
     def __init__(self, db=None):
         pass
 
@@ -70,37 +90,65 @@ class DayuDatabase(object):
             raise DayuDatabaseConfigNotExistError('no database config file: {}'.format(db_url_file))
 
         import json
+        import engine
+        from sqlalchemy.engine.url import URL
         with open(db_url_file, 'r') as jf:
             self.url = URL(**json.load(jf))
 
-        self.engine = create_engine(self.url, echo=False, isolation_level='READ COMMITTED')
-        current_threading_db = _database_context.setdefault(id(threading.current_thread()), {})
-        current_threading_db[db] = self
+        # 相同url 的数据库在进程内共享同一个engine 和连接池
+        self.engine = engine.get_engine(self.url, self.config)
         self.status = DayuDatabaseStatusConnected
         return self
 
-    @lazy
+    @property
+    def session_maker(self):
+        '''
+        当前进程的scoped_session。fork 之后的子进程会得到新的scoped_session
+        '''
+        import engine
+        return engine.get_scoped_session(self.engine)
+
+    def _prepare(self):
+        '''
+        反射数据库，生成所有的orm class。每一个数据库url 在进程内只会执行一次
+        '''
+        key = str(self.engine.url)
+        if key in _prepared_urls:
+            return
+
+        with _context_lock:
+            if key in _prepared_urls:
+                return
+
+            import base
+            import auto_naming
+            import reflection_cache
+            # 如果设置了 DAYU_DB_REFLECTION_CACHE，并且数据库结构没有变化，那么直接使用本地的反射快照
+            reflection_cache.reflect(self.engine, base.BASE.metadata, self.config.get(DAYU_DB_REFLECTION_CACHE, None))
+            base.BASE.prepare(self.engine,
+                              reflect=False,
+                              classname_for_table=auto_naming._classname_for_table,
+                              name_for_collection_relationship=auto_naming._name_for_collection_relationship,
+                              name_for_scalar_relationship=auto_naming._name_for_scalar_relationship,
+                              generate_relationship=auto_naming._generate_relationship)
+            _prepared_urls.add(key)
+
+    @property
     def session(self):
+        '''
+        当前线程（greenlet）的session。同一个线程内多次调用得到的是同一个session
+        '''
         if self.status is DayuDatabaseStatusNotConnect:
             from error import DayuDatabaseNotConnectError
             raise DayuDatabaseNotConnectError('database not connect! please run .connect() before get_session()')
 
-        import base
-        import auto_naming
-        import sqlalchemy.event
-        self.session_maker = sessionmaker(bind=self.engine, autoflush=False)
-        base.BASE.prepare(self.engine,
-                          reflect=True,
-                          classname_for_table=auto_naming._classname_for_table,
-                          name_for_collection_relationship=auto_naming._name_for_collection_relationship,
-                          name_for_scalar_relationship=auto_naming._name_for_scalar_relationship,
-                          generate_relationship=auto_naming._generate_relationship)
-
-        _session = self.session_maker()
-
-        @sqlalchemy.event.listens_for(_session, 'after_commit')
-        def event_after_commit(session):
-            print 'db commit completed'
-            # net_log.get_logger().info('db commit completed')
-
-        return _session
+        import engine
+        self._prepare()
+        return engine.current_session(self.engine)
+
+    def remove_session(self):
+        '''
+        关闭当前线程（greenlet）的session，归还连接。之后再使用 .session 会得到一个新的session
+        '''
+        import engine
+        engine.remove_session(self.engine)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    非阻塞的查询接口，给GUI、服务程序使用。
+
+    get_session()、DBPath.orm()、SEARCH.items 等所有的入口都是阻塞的，
+    Qt 的浏览器在解析一个很深的通配符路径时，整个界面都会卡住。
+
+    这里的函数会把查询交给后台的线程池执行，立刻返回一个Future：
+    * future.result(timeout=None)：等待并获得结果（如果查询抛出异常，这里会重新抛出）
+    * future.add_done_callback(func)：查询完成之后调用 func(future)。
+      注意callback 在后台线程中执行，Qt 中需要通过signal 回到主线程再更新界面
+    * future.done()、future.exception()
+
+    每一个后台线程都有自己的session（参考 engine.py），多个查询可以同时进行，
+    线程的数量（默认4）应该不超过连接池的大小 DAYU_DB_POOL_SIZE。
+    每一次查询完成之后，后台线程的session 会被关闭，连接还给连接池。
+    所以返回的orm 是detached 状态：已经读取的column 可以直接使用，但是不能再lazy load 其他relationship。
+    如果需要在当前线程继续使用，可以 dayu_database.get_session().merge(orm, load=False)。
+
+    传入的orm 只会读取 __tablename__ 和 id，后台线程会在自己的session 中重新读取，不会跨线程使用同一个session。
+
+    python2 中没有asyncio，所以这里使用的是基于线程池的Future，而不是coroutine。
+
+    使用方法：
+        from dayu_database import aio
+        future = aio.resolve(DBPath('/dayu/sequence/pl/.*/element/.*'))
+        future.add_done_callback(lambda f: signal.emit(f.result()))
+
+    '''
+
+import threading
+
+# 默认的后台线程数量
+DEFAULT_WORKERS = 4
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class Future(object):
+    '''
+    后台查询的结果。
+    '''
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def __repr__(self):
+        return '<Future>({})'.format('done' if self._done else 'pending')
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout=None):
+        '''
+        等待并返回结果。如果查询抛出了异常，这里重新抛出
+        :param timeout: float，秒。如果超时，抛出 RuntimeError
+        :return: 查询的结果
+        '''
+        exception = self.exception(timeout=timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+    def exception(self, timeout=None):
+        '''
+        等待并返回查询抛出的异常。如果查询成功，返回None
+        '''
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise RuntimeError('timeout: {}'.format(timeout))
+            return self._exception
+
+    def add_done_callback(self, func):
+        '''
+        查询完成之后调用 func(future)。如果已经完成，立刻调用
+        :param func: 函数
+        :return: None
+        '''
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _set(self, result=None, exception=None):
+        with self._condition:
+            self._result = result
+            self._exception = exception
+            self._done = True
+            self._condition.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+
+class Executor(object):
+    '''
+    执行数据库查询的线程池。每一个任务完成之后，都会关闭当前线程的session
+    '''
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        import Queue
+
+        self._queue = Queue.Queue()
+        self._threads = []
+        for index in range(workers):
+            thread = threading.Thread(target=self._run, name='dayu_database.aio.{}'.format(index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        import dayu_database
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            future, func, args, kwargs = item
+            result, exception = None, None
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                exception = e
+
+            # 先关闭session，再通知调用者，调用者拿到的orm 已经是detached 状态
+            try:
+                dayu_database.remove_session()
+            except Exception as e:
+                exception = exception or e
+            future._set(result=result, exception=exception)
+
+    def submit(self, func, *args, **kwargs):
+        '''
+        在后台线程中执行 func(*args, **kwargs)
+        :return: Future
+        '''
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def shutdown(self):
+        '''
+        等待已经提交的任务完成，然后结束所有的后台线程
+        '''
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def get_executor(workers=None):
+    '''
+    获得进程内共用的线程池。第一次调用时创建
+    :param workers: int，线程的数量。只有第一次调用时有效
+    :return: Executor
+    '''
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = Executor(workers or DEFAULT_WORKERS)
+    return _executor
+
+
+def submit(func, *args, **kwargs):
+    '''
+    在后台线程中执行任意的数据库操作。func 中应该使用 dayu_database.get_session() 获得当前线程的session
+    :return: Future
+    '''
+    return get_executor().submit(func, *args, **kwargs)
+
+
+def _identity(orm):
+    return orm.__tablename__, orm.id
+
+
+def _load(identity):
+    '''
+    在当前线程的session 中重新读取orm
+    '''
+    import dayu_database
+    import util
+
+    table_name, orm_id = identity
+    return dayu_database.get_session().query(util.get_class(table_name)).get(orm_id)
+
+
+def _resolve(path):
+    import base
+
+    # 使用新的对象，避免在后台线程中修改调用者持有的DBPath、DayuPath 的缓存
+    result = type(path)(path).orm()
+    if isinstance(result, base.BASE):
+        return result
+    return list(result) if result is not None else None
+
+
+def resolve(path):
+    '''
+    DBPath.orm() 或者 DayuPath.orm() 的非阻塞版本，支持通配符
+    :param path: DBPath 或者DayuPath
+    :return: Future，结果是orm，或者orm 的list（通配符、多个结果）
+    '''
+    return submit(_resolve, path)
+
+
+def _search(identity):
+    return list(_load(identity).items)
+
+
+def search(search_orm):
+    '''
+    SEARCH.items 的非阻塞版本
+    :param search_orm: SEARCH orm
+    :return: Future，结果是orm 的list
+    '''
+    return submit(_search, _identity(search_orm))
+
+
+def _children(identity):
+    return list(_load(identity).children)
+
+
+def children(orm):
+    '''
+    orm.children 的非阻塞版本
+    :param orm: FOLDER、FILE、SYMBOL orm
+    :return: Future，结果是orm 的list
+    '''
+    return submit(_children, _identity(orm))
+
+
+def _hierarchy(identity):
+    import tree
+    return tree.load_hierarchy(_load(identity))
+
+
+def hierarchy(orm):
+    '''
+    orm.hierarchy 的非阻塞版本
+    :param orm: FOLDER、FILE orm
+    :return: Future，结果是 [root_orm, project, ..., orm]
+    '''
+    return submit(_hierarchy, _identity(orm))
+
+
+def root_folder():
+    '''
+    util.get_root_folder() 的非阻塞版本
+    :return: Future，结果是root FOLDER orm
+    '''
+    import util
+    return submit(util.get_root_folder)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    批量创建层级结构。
+
+    通过orm 逐个创建FOLDER、FILE 的时候，每一行在 before_insert 中都需要：
+    读取db_config、访问hierarchy、遍历 parent.children 检查重名、发射message 事件。
+    DBPath.create() 还会在每一个层级flush 一次。创建一个300 个shot 的sequence（以及每个shot 的type 文件夹），
+    会产生上万次数据库往返。
+
+    bulk_create() 把整个批次在内存中一次性解析：
+    * 按照层级逐层处理，每一层只查询一次已经存在的同名orm
+    * meaning、完整的name（to_name）、depth、top、path_ids 全部在内存中计算
+    * 使用多行 INSERT ... VALUES 批量写入FOLDER、FILE，然后批量写入 path_index
+    * 不会触发每一行的 before_insert、after_insert 监听函数。
+      但是原本每一行都会发射的事件，仍然会在写入前后集中发射，已有的监听函数（例如shotgun 写入cloud_id、cloud_table）不受影响：
+        ('event', 'db', 'folder' | 'file', 'commit', 'before')，参数是 (mapper, connection, target)。
+            target 是还没有写入的orm（只包含这一行的内容和parent），监听函数对它的修改会写入数据库
+        ('event', 'db', 'folder' | 'file', 'commit', 'after')，参数是 (mapper, connection, target)，target 是写入之后的orm
+      另外，整个批次在写入前后各发射一次批量事件：
+        ('event', 'db', 'bulk', 'commit', 'before')，参数是 (connection, rows)，监听函数可以修改rows 中的内容
+        ('event', 'db', 'bulk', 'commit', 'after')，参数是 (session, 新建的orm 列表)
+
+    和 DBPath.create() 一样，不能用来创建project，也不能创建自动增长版本号的VERSION。
+
+    使用方法：
+        from dayu_database import bulk
+        sequence = DBPath('/dayu/sequence/pl').orm()
+        specs = ['{:04d}/element/{}'.format(x * 10, t) for x in range(1, 301) for t in ('plt', 'cmp')]
+        shots = bulk.bulk_create(sequence, specs)
+        session.commit()
+
+    '''
+
+import collections
+import itertools
+
+
+class _Node(object):
+    '''
+    批次中的一个层级。可能对应已经存在的orm，也可能是需要新建的row
+    '''
+
+    def __init__(self, short_name):
+        self.short_name = short_name
+        self.children = collections.OrderedDict()
+        self.orm = None
+        self.names = None
+
+    def use(self, orm, parent_names):
+        '''
+        对应到已经存在的orm
+        '''
+        import tree
+
+        self.orm = orm
+        self.names = parent_names + [orm.name]
+        self.table_name = orm.__tablename__
+        self.id = orm.id
+        self.name = orm.name
+        self.depth = orm.depth
+        self.top_id = orm.top_id
+        # 旧的数据库可能还没有path_ids 这个column
+        self.path_ids = list(orm.path_ids or []) or None if tree.has_path_ids(type(orm)) else None
+        for key in ('db_config_name', 'storage_config_name', 'pipeline_config_name', 'type_name', 'type_group_name'):
+            setattr(self, key, getattr(orm, key))
+
+    def row(self, parent):
+        '''
+        生成写入数据库的内容
+        '''
+        import table
+        import tree
+
+        result = {'id'                  : self.id,
+                'name'                : self.name,
+                'label'               : self.name,
+                'active'              : True,
+                'parent_id'           : parent.id,
+                'top_id'              : self.top_id,
+                'depth'               : self.depth,
+                'meaning'             : self.meaning,
+                'db_config_name'      : self.db_config_name,
+                'storage_config_name' : self.storage_config_name,
+                'pipeline_config_name': self.pipeline_config_name,
+                'type_name'           : self.type_name,
+                'type_group_name'     : self.type_group_name}
+        if tree.has_path_ids(getattr(table, self.table_name.upper())):
+            result['path_ids'] = self.path_ids
+        return result
+
+
+def _split(spec):
+    if isinstance(spec, basestring):
+        return [x for x in spec.strip('/').split('/') if x]
+    return [str(x) for x in spec]
+
+
+def _resolve(node, parent, used_ids):
+    '''
+    和 insert_folder、insert_file 以及 DepthMixin.validate_depth 相同的规则，在内存中解析新建层级的全部属性
+    :param node: 需要新建的_Node
+    :param parent: 已经解析的parent _Node
+    :param used_ids: set，这个批次中已经使用的id
+    :return: None
+    '''
+    import mixin
+    import util
+    from util import snowflake
+
+    config_orm = util.get_db_config(parent.db_config_name)
+    depth = parent.depth + 1
+    depth_config = config_orm.config.get(str(depth), None)
+    if depth_config is None:
+        raise Exception('no db_config found!')
+
+    names = parent.names + [node.short_name]
+    if len(depth_config['content']) > 1:
+        db_path_string = '/' + '/'.join(str(x) for x in names[1:])
+        for _regex, _value in config_orm.derived('db_pattern', mixin._compile_db_pattern)[str(depth)]:
+            if _regex.match(db_path_string):
+                meaning = _value
+                break
+        else:
+            raise Exception('no match meaning with depth!, {}'.format(db_path_string))
+    else:
+        meaning = depth_config['content'][0]
+
+    node.meaning = meaning
+    node.table_name = 'file' if depth_config['is_end'][meaning] else 'folder'
+    node.depth = depth
+    node.top_id = parent.id if depth == 2 else parent.top_id
+    node.db_config_name = parent.db_config_name
+    node.storage_config_name = parent.storage_config_name
+    node.pipeline_config_name = parent.pipeline_config_name
+    node.type_name = node.short_name if meaning == 'TYPE' else parent.type_name
+    node.type_group_name = node.short_name if meaning == 'TYPE_GROUP' else parent.type_group_name
+
+    selected_names = (x for index, x in enumerate(names) if index in depth_config['to_name_param'][meaning])
+    node.name = depth_config['to_name'][meaning].format(*selected_names)
+    node.names = parent.names + [node.name]
+
+    # 同一毫秒内生成大量id 的时候，snowflake 的随机位有可能重复，所以批次内需要确保唯一
+    node.id = snowflake()
+    while node.id in used_ids:
+        node.id = snowflake()
+    used_ids.add(node.id)
+    node.path_ids = parent.path_ids + [node.id] if parent.path_ids else None
+
+
+def _existing_children(session, parent_ids):
+    '''
+    一次性读取多个parent 中已经存在的FOLDER、FILE、SYMBOL
+    :return: dict，key 是parent id，value 是 {name: orm}
+    '''
+    import table
+
+    result = collections.defaultdict(dict)
+    if not parent_ids:
+        return result
+
+    for x in session.query(table.FOLDER).filter(table.FOLDER.parent_id.in_(parent_ids)):
+        result[x.parent_id].setdefault(x.name, x)
+    for x in session.query(table.FILE).filter(table.FILE.parent_id.in_(parent_ids)):
+        result[x.parent_id].setdefault(x.name, x)
+    for x in session.query(table.SYMBOL).filter(table.SYMBOL.origin_table == 'folder',
+                                                table.SYMBOL.origin_id.in_(parent_ids)):
+        result[x.origin_id].setdefault(x.name, x)
+    return result
+
+
+def _validate_types(session, nodes):
+    '''
+    和 TypeMixin 的 @validates 一样，确保TYPE、TYPE_GROUP 存在。所有的名字只查询一次
+    '''
+    import table
+
+    for orm_class, key, label in ((table.TYPE, 'type_name', 'TYPE'),
+                                  (table.TYPE_GROUP, 'type_group_name', 'TYPE_GROUP')):
+        names = set(getattr(x, key) for x in nodes) - {None}
+        if not names:
+            continue
+        exists = set(x for x, in session.query(orm_class.name).filter(orm_class.name.in_(names)))
+        for name in sorted(names - exists):
+            raise Exception('no {} named: {}'.format(label, name))
+
+
+def _publish_before(connection, new_nodes):
+    '''
+    为每一个新建的row 发射原本 insert_folder、insert_file 中的 commit before 事件，然后把监听函数的修改写回row。
+    target 是没有加入session 的orm，只填充了这一行的内容以及parent，不会触发 @validates 和任何数据库查询
+    :param connection: sqlalchemy connection
+    :param new_nodes: list of tuple，(需要新建的_Node, parent _Node)
+    :return: dict，key 是table 名，value 是需要写入的row 的list
+    '''
+    import message
+    from sqlalchemy import inspect
+    from sqlalchemy.orm.attributes import set_committed_value
+    import table
+
+    rows = {'folder': [], 'file': []}
+    targets = {}
+    for node, parent_node in new_nodes:
+        orm_class = getattr(table, node.table_name.upper())
+        mapper = inspect(orm_class)
+        row = node.row(parent_node)
+        target = mapper.class_manager.new_instance()
+        for key, value in row.items():
+            set_committed_value(target, key, value)
+        set_committed_value(target, 'parent', parent_node.orm if parent_node.orm is not None
+                            else targets[parent_node.id])
+        targets[node.id] = target
+
+        message.pub(('event', 'db', node.table_name, 'commit', 'before'), mapper, connection, target)
+
+        # 监听函数修改、添加的column 写回row
+        state = inspect(target)
+        for column in orm_class.__table__.c:
+            prop = mapper.get_property_by_column(column)
+            if prop.key in state.dict:
+                row[column.key] = state.dict[prop.key]
+        rows[node.table_name].append(row)
+    return rows
+
+
+def bulk_create(parent, specs, session=None, batch_size=500):
+    '''
+    在parent 下批量创建层级结构。已经存在的层级会直接使用，不会重复创建。
+    :param parent: FOLDER orm 或者 DBPath，所有specs 的起点
+    :param specs: list。每一个元素是一个相对于parent 的"短名"路径，可以是 'a/b/c' 这样的string，也可以是 ['a', 'b', 'c']
+    :param session: sqlalchemy session，默认是 dayu_database.get_session()。写入使用这个session 的事务，需要用户自己commit
+    :param batch_size: int，每一条INSERT 语句写入的行数
+    :return: list of orm，每一个spec 最后一个层级对应的orm，顺序和specs 一致
+    '''
+    import message
+    from sqlalchemy import inspect
+    from sqlalchemy.orm import object_session
+    import dayu_database
+    import path_index
+    import table
+    import tree
+    import version_counter
+    from config.const import DAYU_DB_ROOT_FOLDER_NAME
+
+    if not isinstance(parent, table.FOLDER):
+        parent = parent.orm()
+    if not isinstance(parent, table.FOLDER):
+        raise Exception('parent not represent a FOLDER!')
+    if parent.name == DAYU_DB_ROOT_FOLDER_NAME:
+        raise Exception('can not create project with bulk_create!')
+
+    session = session or object_session(parent) or dayu_database.get_session()
+
+    # 把所有的spec 组合成一个树状结构，相同前缀的层级只会处理一次
+    root = _Node(parent.name)
+    root.use(parent, [x.name for x in tree.load_hierarchy(parent)[:-1]])
+    leaves = []
+    for spec in specs:
+        current = root
+        for short_name in _split(spec):
+            current = current.children.setdefault(short_name, _Node(short_name))
+        leaves.append(current)
+
+    # 逐层解析。每一层只需要查询一次已经存在的orm
+    new_nodes = []
+    used_ids = set()
+    level = [root]
+    while level:
+        existing = _existing_children(session, [x.id for x in level if x.orm is not None and x.children])
+        next_level = []
+        for parent_node in level:
+            if not parent_node.children:
+                continue
+            if parent_node.table_name == 'file':
+                raise Exception('FILE can not contain children: {}'.format(parent_node.name))
+
+            taken = existing[parent_node.id]
+            for short_name, node in parent_node.children.items():
+                orm = taken.get(short_name, None)
+                if orm is None:
+                    _resolve(node, parent_node, used_ids)
+                    orm = taken.get(node.name, None)
+
+                if orm is None:
+                    taken[node.name] = node
+                    new_nodes.append((node, parent_node))
+                elif isinstance(orm, _Node) or isinstance(orm, table.SYMBOL):
+                    # 同一个批次中不同的短名得到了相同的完整name，或者和SYMBOL 重名
+                    raise Exception(getattr(node, 'name', short_name))
+                else:
+                    node.use(orm, parent_node.names)
+
+                next_level.append(node)
+
+        level = next_level
+
+    _validate_types(session, [x for x, _ in new_nodes])
+
+    connection = session.connection()
+    rows = _publish_before(connection, new_nodes)
+    message.pub(('event', 'db', 'bulk', 'commit', 'before'), connection, rows)
+
+    new_orms = []
+    for table_name in ('folder', 'file'):
+        orm_class = getattr(table, table_name.upper())
+        table_rows = rows[table_name]
+        # 监听函数可能只给部分row 添加了内容（例如cloud_id），多行 INSERT 要求每一行的column 相同。
+        # 所以把column 相同的连续row 分为一组写入，保持parent 在children 之前写入的顺序
+        for _, group in itertools.groupby(table_rows, key=lambda x: tuple(sorted(x))):
+            group = list(group)
+            for start in range(0, len(group), batch_size):
+                connection.execute(orm_class.__table__.insert().values(group[start:start + batch_size]))
+
+        ids = [x['id'] for x in table_rows]
+        for start in range(0, len(ids), batch_size):
+            new_orms.extend(session.query(orm_class).filter(orm_class.id.in_(ids[start:start + batch_size])))
+
+    # 版本名的FILE 需要同步到版本计数器
+    version_counter.observe(connection, [(x['parent_id'], x['name']) for x in rows['file']])
+
+    # hierarchy 只需要一次查询，然后批量写入硬盘路径的反向索引
+    tree.load_hierarchies(new_orms)
+    path_index.index(connection, new_orms)
+
+    # 原本每一行 after_insert 发射的事件
+    for orm in new_orms:
+        message.pub(('event', 'db', orm.__tablename__, 'commit', 'after'), inspect(type(orm)), connection, orm)
+    message.pub(('event', 'db', 'bulk', 'commit', 'after'), session, new_orms)
+
+    by_id = {x.id: x for x in new_orms}
+    return [x.orm if x.orm is not None else by_id[x.id] for x in leaves]
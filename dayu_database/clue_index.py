@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    onset metadata 的线索索引。
+
+    原本 util.get_vfx_onset() 会读取整个项目所有的METADATA FILE，然后在python 中逐个检查
+    vfx_clue、cam_clue 中的线索是否出现在 orm.name 中。打开一个shot 的metadata 页面，就要传输整个项目的metadata。
+
+    这里为FOLDER、FILE 维护一个 clue_tokens column（JSONB array，GIN 索引）：
+    * 内容是 vfx_clue 和 cam_clue 合并、去重之后的线索
+    * 'ALL'、'*'（以及空字符串，它出现在任何名字中）统一记录为通配符 WILDCARD
+    * 由 table.py 中的监听函数在insert、update 的时候维护，已经存在的数据通过 init_db.migrate 回填
+
+    "线索出现在orm.name 中" 等价于 "线索是orm.name 的某个子串"，
+    所以只需要把orm.name 的全部子串（以及通配符）作为 ?| 的参数，一次走GIN 索引的查询就可以得到全部匹配的metadata。
+    如果数据库还没有clue_tokens 这个column，那么退回到原本读取全部metadata 的方式。
+
+    '''
+
+import json
+
+# 匹配任何名字的线索
+WILDCARD = '*'
+WILDCARD_CLUES = ('ALL', '*', '')
+
+# get_vfx_onset_many 每一条查询最多处理的orm 数量
+BATCH_SIZE = 100
+
+
+def has_clue_tokens(orm_class):
+    '''
+    判断当前数据库的table 是否已经具备 clue_tokens 这个column（旧的数据库需要先执行 init_db.migrate）
+    :param orm_class: FOLDER、FILE class
+    :return: bool
+    '''
+    return 'clue_tokens' in orm_class.__table__.c
+
+
+def get_tokens(*clue_lists):
+    '''
+    把多个线索list 合并成clue_tokens
+    :param clue_lists: 多个list，例如 vfx_clue、cam_clue。None 或者不是list 的内容会被忽略
+    :return: list of string，排序之后的线索
+    '''
+    result = set()
+    for clues in clue_lists:
+        if not isinstance(clues, list):
+            continue
+        for clue in clues:
+            if clue is None:
+                continue
+            clue = clue if isinstance(clue, basestring) else json.dumps(clue)
+            result.add(WILDCARD if clue in WILDCARD_CLUES else clue)
+    return sorted(result)
+
+
+def sync(orm, force=False):
+    '''
+    根据vfx_clue、cam_clue 更新orm 的clue_tokens。（在 before_insert、before_update 监听函数中调用）
+    :param orm: FOLDER、FILE orm
+    :param force: bool，如果为False，只有vfx_clue 或者cam_clue 发生变化的时候才会更新
+    :return: None
+    '''
+    from sqlalchemy import inspect
+
+    if not has_clue_tokens(type(orm)):
+        return
+
+    if not force:
+        attrs = inspect(orm).attrs
+        if not (attrs.vfx_clue.history.has_changes() or attrs.cam_clue.history.has_changes()):
+            return
+
+    orm.clue_tokens = get_tokens(orm.vfx_clue, orm.cam_clue)
+
+
+def candidates(name):
+    '''
+    name 的全部子串，以及通配符。任何出现在name 中的线索一定在这个集合中
+    :param name: string
+    :return: set of string
+    '''
+    name = name or ''
+    result = {name[start:end] for start in range(len(name)) for end in range(start + 1, len(name) + 1)}
+    result.add(WILDCARD)
+    return result
+
+
+def matches(tokens, name):
+    '''
+    判断clue_tokens 是否和name 匹配
+    :param tokens: list of string，clue_tokens
+    :param name: string
+    :return: bool
+    '''
+    return any(x == WILDCARD or x in (name or '') for x in tokens or [])
+
+
+def _scan(session, orm):
+    '''
+    旧数据库没有clue_tokens 时使用：读取项目中全部的METADATA，在python 中检查
+    '''
+    import table
+
+    for meta_file in session.query(table.FILE) \
+            .filter(table.FILE.meaning == 'METADATA') \
+            .filter(table.FILE.top_id == orm.top_id):
+        if matches(get_tokens(meta_file.vfx_clue, meta_file.cam_clue), orm.name):
+            yield meta_file
+
+
+def find_many(session, orms, batch_size=BATCH_SIZE):
+    '''
+    批量得到每一个orm 相关的onset metadata。每 batch_size 个orm 只需要一次走索引的查询
+    :param session: sqlalchemy session
+    :param orms: list of FOLDER、FILE orm
+    :param batch_size: int
+    :return: dict，key 是orm，value 是metadata FILE orm 的list
+    '''
+    from sqlalchemy import bindparam, Text
+    from sqlalchemy.dialects.postgresql import ARRAY
+    import table
+
+    orms = list(orms)
+    result = {x: [] for x in orms}
+    if not has_clue_tokens(table.FILE):
+        for orm in orms:
+            result[orm].extend(_scan(session, orm))
+        return result
+
+    for start in range(0, len(orms), batch_size):
+        batch = orms[start:start + batch_size]
+        tokens = set()
+        for orm in batch:
+            tokens.update(candidates(orm.name))
+
+        # 候选的metadata 已经按照线索过滤，这里只需要再按照top 和name 分配给每一个orm
+        query = session.query(table.FILE) \
+            .filter(table.FILE.meaning == 'METADATA') \
+            .filter(table.FILE.top_id.in_(set(x.top_id for x in batch))) \
+            .filter(table.FILE.clue_tokens.has_any(bindparam('tokens', sorted(tokens), type_=ARRAY(Text)))) \
+            .order_by(table.FILE.id)
+        for meta_file in query:
+            for orm in batch:
+                if meta_file.top_id == orm.top_id and matches(meta_file.clue_tokens, orm.name):
+                    result[orm].append(meta_file)
+
+    return result
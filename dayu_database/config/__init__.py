@@ -59,6 +59,26 @@ class DayuDatabaseConfig(dict):
         self[DAYU_CONFIG_STATIC_PATH] = kwargs.get(DAYU_CONFIG_STATIC_PATH, None) or \
                                         os.environ.get(DAYU_CONFIG_STATIC_PATH, None) or \
                                         os.sep.join([os.path.dirname(os.path.dirname(__file__)), 'static'])
+        self[DAYU_DB_CONFIG_CACHE_TTL] = float(kwargs.get(DAYU_DB_CONFIG_CACHE_TTL, None) or
+                                               os.environ.get(DAYU_DB_CONFIG_CACHE_TTL, None) or
+                                               5.0)
+        self[DAYU_DB_REFLECTION_CACHE] = kwargs.get(DAYU_DB_REFLECTION_CACHE, None) or \
+                                         os.environ.get(DAYU_DB_REFLECTION_CACHE, None)
+        self[DAYU_DB_POOL_SIZE] = int(kwargs.get(DAYU_DB_POOL_SIZE, None) or
+                                      os.environ.get(DAYU_DB_POOL_SIZE, None) or
+                                      5)
+        self[DAYU_DB_MAX_OVERFLOW] = int(kwargs.get(DAYU_DB_MAX_OVERFLOW, None) or
+                                         os.environ.get(DAYU_DB_MAX_OVERFLOW, None) or
+                                         10)
+        self[DAYU_DB_POOL_TIMEOUT] = float(kwargs.get(DAYU_DB_POOL_TIMEOUT, None) or
+                                           os.environ.get(DAYU_DB_POOL_TIMEOUT, None) or
+                                           30.0)
+        self[DAYU_DB_POOL_RECYCLE] = int(kwargs.get(DAYU_DB_POOL_RECYCLE, None) or
+                                         os.environ.get(DAYU_DB_POOL_RECYCLE, None) or
+                                         -1)
+        self[DAYU_DB_POOL_PRE_PING] = str(kwargs.get(DAYU_DB_POOL_PRE_PING, None) or
+                                          os.environ.get(DAYU_DB_POOL_PRE_PING, None) or
+                                          False).lower() in ('1', 'true', 'yes', 'on')
 
     def from_json(self, path):
         import json
@@ -8,3 +8,17 @@ DAYU_DB_ROOT_FOLDER_NAME = '.!0x5f3759df_this_is_a_magic_number_used_for_telling
 DAYU_DB_NAME = 'DAYU_DB_NAME'
 DAYU_APP_NAME = 'DAYU_APP_NAME'
 DAYU_CONFIG_STATIC_PATH = 'DAYU_CONFIG_STATIC_PATH'
+
+# DB_CONFIG、STORAGE、PIPELINE_CONFIG 在进程内缓存的检查间隔（秒）。超过这个时间，会通过updated_time 检查数据库中是否有更新
+# 合并之后的继承info（参考 info_cascade）也使用这个时间，超过之后重新读取
+DAYU_DB_CONFIG_CACHE_TTL = 'DAYU_DB_CONFIG_CACHE_TTL'
+
+# 数据库反射快照的文件夹。设置之后，数据库结构没有变化时直接读取快照，不需要每次启动都反射所有的table
+DAYU_DB_REFLECTION_CACHE = 'DAYU_DB_REFLECTION_CACHE'
+
+# 连接池的设置。同一个进程内，相同的数据库url 只会创建一个engine（参考 engine.py），所有的线程共享同一个连接池
+DAYU_DB_POOL_SIZE = 'DAYU_DB_POOL_SIZE'
+DAYU_DB_MAX_OVERFLOW = 'DAYU_DB_MAX_OVERFLOW'
+DAYU_DB_POOL_TIMEOUT = 'DAYU_DB_POOL_TIMEOUT'
+DAYU_DB_POOL_RECYCLE = 'DAYU_DB_POOL_RECYCLE'
+DAYU_DB_POOL_PRE_PING = 'DAYU_DB_POOL_PRE_PING'
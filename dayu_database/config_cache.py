@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    DB_CONFIG、STORAGE、PIPELINE_CONFIG 的进程级缓存。
+
+    这三种配置几乎不会修改，但是每一次insert FOLDER、FILE，每一次 disk_path() 都需要读取。
+    原本的 util.get_db_config() 每次都会执行一次 session.query(...).one()，批量写入的时候配置查询的次数甚至会超过数据本身。
+
+    这里的缓存：
+    * 以 (数据库url, table 名, config 名) 作为key，同一个进程内所有的session、所有的线程共享
+    * 缓存的是脱离session 的ConfigEntry，不是orm，所以不会受到session 的commit、expire、close 影响
+    * 每隔 DAYU_DB_CONFIG_CACHE_TTL 秒，会查询一次updated_time，如果数据库中的配置被修改过，那么重新读取
+    * 当前进程中修改、删除配置时，会通过table.py 中的监听函数自动失效
+    * 用户也可以调用 refresh() 手动失效
+
+    ConfigEntry.derived() 可以在配置上缓存任意的"预处理"结果（例如预先编译好的正则表达式、路径模板），
+    这些结果会跟随配置一起失效。
+
+    缓存的内容被所有的session、线程共享，所以 ConfigEntry 是只读的：
+    .config、.extra_data 以及里面嵌套的dict、list 都不能修改（会抛出TypeError），.name、.extra_data 也不能重新赋值。
+    需要可以修改的副本时使用 copy.deepcopy(entry.config)；
+    需要修改数据库中的配置时，使用 get_orm()（或者 util.get_db_config_orm() 等）得到orm，修改之后commit。
+
+
+    '''
+
+import copy
+import threading
+import time
+
+# 允许缓存的table，value 是对应的orm class 名字
+CACHED_TABLES = {'db_config': 'DB_CONFIG',
+                 'storage': 'STORAGE',
+                 'pipeline_config': 'PIPELINE_CONFIG'}
+
+_cache = {}
+_lock = threading.RLock()
+
+
+def _read_only(*args, **kwargs):
+    raise TypeError('cached config is read-only, use copy.deepcopy() or get_orm() instead')
+
+
+class ReadOnlyDict(dict):
+    '''
+    不能修改的dict。deepcopy 得到的是普通的dict
+    '''
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def copy(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return {copy.deepcopy(k, memo): copy.deepcopy(v, memo) for k, v in self.items()}
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+class ReadOnlyList(list):
+    '''
+    不能修改的list。deepcopy 得到的是普通的list
+    '''
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(x, memo) for x in self]
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+def freeze(value):
+    '''
+    把json 的内容递归转换成只读的 ReadOnlyDict、ReadOnlyList
+    :param value: json 的内容
+    :return: 只读的内容
+    '''
+    if isinstance(value, dict):
+        return ReadOnlyDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return ReadOnlyList(freeze(x) for x in value)
+    return value
+
+
+class ConfigEntry(object):
+    '''
+    缓存中的一份配置。和对应的orm 一样，提供 name、extra_data、config、updated_time 属性，但是全部是只读的。
+    '''
+
+    def __init__(self, table_name, name, extra_data, updated_time):
+        self.table_name = table_name
+        self._name = name
+        self._extra_data = freeze(extra_data or {})
+        self.updated_time = updated_time
+        self.checked_time = time.time()
+        self._derived = {}
+
+    def __repr__(self):
+        return '<ConfigEntry>({}, {})'.format(self.table_name, self.name)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def extra_data(self):
+        return self._extra_data
+
+    @property
+    def config(self):
+        '''
+        返回实际的config 内容，和 DB_CONFIG.config 一样。内容是只读的，参考 ReadOnlyDict
+        :return: ReadOnlyDict
+        '''
+        return self._extra_data
+
+    def derived(self, key, factory):
+        '''
+        获得基于当前配置预处理之后的结果。每个key 只会调用一次factory。
+        :param key: 任意可以hash 的对象
+        :param factory: 函数，接受当前的ConfigEntry，返回预处理的结果
+        :return: factory 的返回值
+        '''
+        try:
+            return self._derived[key]
+        except KeyError:
+            pass
+
+        value = factory(self)
+        with _lock:
+            return self._derived.setdefault(key, value)
+
+
+def _ttl():
+    import dayu_database
+    from config.const import DAYU_DB_CONFIG_CACHE_TTL
+    return float(dayu_database.get_db().config.get(DAYU_DB_CONFIG_CACHE_TTL, 5.0))
+
+
+def _load(session, table_name, name):
+    '''
+    从数据库中读取配置，生成ConfigEntry。
+    如果不存在或者存在多个，会和原本的 query.one() 一样抛出异常
+    '''
+    from sqlalchemy import select
+    from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+    import table
+
+    orm_table = getattr(table, CACHED_TABLES[table_name]).__table__
+    rows = session.execute(select([orm_table.c.extra_data, orm_table.c.updated_time])
+                           .where(orm_table.c.name == name)).fetchall()
+    if not rows:
+        raise NoResultFound('no {}: {}'.format(table_name, name))
+    if len(rows) > 1:
+        raise MultipleResultsFound('multiple {}: {}'.format(table_name, name))
+
+    return ConfigEntry(table_name, name, rows[0].extra_data, rows[0].updated_time)
+
+
+def _is_stale(session, entry):
+    '''
+    查询数据库中的updated_time，判断缓存是否已经过期
+    '''
+    from sqlalchemy import select
+    import table
+
+    orm_table = getattr(table, CACHED_TABLES[entry.table_name]).__table__
+    rows = session.execute(select([orm_table.c.updated_time])
+                           .where(orm_table.c.name == entry.name)).fetchall()
+    return len(rows) != 1 or rows[0].updated_time != entry.updated_time
+
+
+def get(table_name, name, session=None):
+    '''
+    获得缓存的配置。
+    :param table_name: string，db_config、storage、pipeline_config 中的一个
+    :param name: string，配置的名字，例如 db.movie
+    :param session: sqlalchemy session，如果为None，那么使用 dayu_database.get_session()
+    :return: ConfigEntry
+    '''
+    if session is None:
+        import dayu_database
+        session = dayu_database.get_session()
+
+    key = (str(session.bind.url), table_name, name)
+    entry = _cache.get(key, None)
+    if entry is not None:
+        now = time.time()
+        if now - entry.checked_time < _ttl():
+            return entry
+        if not _is_stale(session, entry):
+            entry.checked_time = now
+            return entry
+
+    entry = _load(session, table_name, name)
+    with _lock:
+        _cache[key] = entry
+    return entry
+
+
+def get_orm(table_name, name, session=None):
+    '''
+    不经过缓存，直接从数据库读取配置的orm。需要修改配置的时候使用，修改之后commit，缓存会自动失效
+    :param table_name: string，db_config、storage、pipeline_config 中的一个
+    :param name: string，配置的名字
+    :param session: sqlalchemy session，如果为None，那么使用 dayu_database.get_session()
+    :return: DB_CONFIG、STORAGE、PIPELINE_CONFIG orm
+    '''
+    import table
+
+    if session is None:
+        import dayu_database
+        session = dayu_database.get_session()
+
+    orm_class = getattr(table, CACHED_TABLES[table_name])
+    return session.query(orm_class).filter(orm_class.name == name).one()
+
+
+def invalidate(table_name=None, name=None):
+    '''
+    让缓存失效。
+    :param table_name: string，如果为None，那么所有table 的缓存都会失效
+    :param name: string，如果为None，那么对应table 的所有缓存都会失效
+    :return: None
+    '''
+    with _lock:
+        for key in list(_cache.keys()):
+            _, key_table_name, key_name = key
+            if table_name is not None and key_table_name != table_name:
+                continue
+            if name is not None and key_name != name:
+                continue
+            _cache.pop(key, None)
+
+    # STORAGE 的根路径前缀树也依赖STORAGE 的内容
+    if table_name in (None, 'storage'):
+        import storage_trie
+        storage_trie.invalidate()
+
+
+def refresh(table_name=None, name=None):
+    '''
+    用户手动刷新缓存，下一次读取时会重新从数据库获得最新的内容。（和 invalidate 相同）
+    '''
+    invalidate(table_name=table_name, name=name)
@@ -13,51 +13,48 @@ def get_configs(self, disk_type='publish'):
     内部的解析分析方法。
     返回初步分析的大致结果：
     * db_config_orm = 对应的数据库结构orm
-    * storage_orm  = 对应的STORAGE orm
+    * storage_orm  = 对应的STORAGE 配置（config_cache.ConfigEntry，和orm 一样可以使用 .config、.name）
     * project_orm = 对应的项目orm （FOLDER orm，并且层级深度是1）
     * root = 根路径
     * compoent = 从项目开始的所有层级结构的列表
 
+    storage 的根路径通过进程内的前缀树查找（参考 storage_trie），不需要查询数据库。
+
     :param disk_type: 路径存储的类型，可以是publish, work, cache 中的一种
     :return: tuple
     '''
-    import dayu_database
-    from table import STORAGE
+    import storage_trie
     import util
-    session = dayu_database.get_session()
-    component = self.split('/')
-    if component and ':' in component[0]:
-        component[0] = component[0].lower()
-
-    mark = component.index(disk_type) if disk_type in component else None
-    if mark:
-        root = '/'.join(component[:mark + 1])
-        storage_orm = None
-        for x in session.query(STORAGE):
-            if root in x.config[disk_type].values():
-                storage_orm = x
-                break
-        else:
-            # raise Exception('no root matched in storage_config')
-            return None, None, None, None, None
-
-        project_name = component[mark + 1]
-        project_orm = util.get_root_folder()[project_name]
-        db_config_orm = None
-        if project_orm:
-            db_config_orm = project_orm.db_config
-        else:
-            # raise Exception('no matching project')
-            return None, None, None, None, None
-
-        return db_config_orm, storage_orm, project_orm, root, component[mark + 1:]
 
+    length, roots, component = storage_trie.match(self, area=disk_type)
+    if not roots or length >= len(component):
+        # raise Exception('no root matched in storage_config')
+        return None, None, None, None, None
 
+    storage_orm = util.get_storage_config(roots[0].storage_name)
+    project_name = component[length]
+    project_orm = util.get_root_folder()[project_name]
+    db_config_orm = None
+    if project_orm:
+        db_config_orm = project_orm.db_config
     else:
+        # raise Exception('no matching project')
         return None, None, None, None, None
 
+    return db_config_orm, storage_orm, project_orm, '/'.join(component[:length]), component[length:]
+
 
 def area(self):
+    '''
+    返回路径所属区域（publish、work、cache）的根路径。
+    优先使用STORAGE 中设置的根路径；如果不是任何storage 中的路径，按照路径中的区域名字判断。
+    :return: DayuPath 对象，如果无法判断，返回None
+    '''
+    import storage_trie
+    length, roots, component = storage_trie.match(self)
+    if roots:
+        return DayuPath('/'.join(component[:length]))
+
     component = self.strip('/').split('/')
 
     if 'publish' in component:
@@ -88,58 +85,46 @@ def platform(self, platform=None):
         import sys
         platform = sys.platform
 
-    import dayu_database
-    from dayu_database.table import STORAGE
-    session = dayu_database.get_session()
-    component = self.split('/')
+    import storage_trie
+    target = storage_trie.convert(self, platform)
+    return DayuPath(target) if target else self
 
-    mark = None
-    area = None
-    if 'publish' in component:
-        area = 'publish'
-        mark = component.index('publish')
-    elif 'work' in component:
-        area = 'work'
-        mark = component.index('work')
-    elif 'cache' in component:
-        area = 'cache'
-        mark = component.index('cache')
 
-    if mark is None:
-        return self
-    else:
-        root_path = '/'.join(component[:mark + 1])
-        for storage in session.query(STORAGE):
-            for k, v in storage.config[area].items():
-                if v == root_path:
-                    target = storage.config[area].get(platform, None)
-                    result = DayuPath(target + '/' + '/'.join(component[mark + 1:])) if target else self
-                    return result
+def platform_many(paths, platform=None):
+    '''
+    批量进行路径平台转换。例如任务在windows、苹果、linux 的渲染节点之间迁移时，转换整个帧序列。
+    所有路径共用同一个前缀树，不会查询数据库。
+    :param paths: list of string 或者 DayuPath
+    :param platform: string，可以是win32, darwin, linux2 中的一种。默认是当前的 sys.platform
+    :return: list of DayuPath，顺序和paths 一致。不是流程内的路径，返回原路径
+    '''
+    if platform is None:
+        import sys
+        platform = sys.platform
 
-        return self
+    import dayu_database
+    import storage_trie
+
+    session = dayu_database.get_session()
+    result = []
+    for x in paths:
+        target = storage_trie.convert(x, platform, session=session)
+        result.append(DayuPath(target if target else x))
+    return result
 
 
-def orm(self, disk_type='publish', refresh=False):
+def _descend(queue, db_config, component, disk_type):
     '''
-    把路径转换为ORM 的函数。
-    路径中的每一个层级，支持使用正则表达式进行通配符选择。
+    从queue 中的FOLDER 开始，逐层访问children，使用orm 的name 正则匹配硬盘路径的每一级。
+    :param queue: deque of orm，开始的FOLDER
+    :param db_config: DB_CONFIG
+    :param component: list of string，从project 开始的硬盘路径的每一级
     :param disk_type: string。可以是publish、work、cache 的三者之一
-    :return: 如果只有唯一对应的ORM，返回ORM；否则返回deque()
+    :return: tuple，(匹配到的orm 的deque, 最后匹配的硬盘路径层级)
     '''
-    if getattr(self, '_cache_orm', None) and refresh is False:
-        return self._cache_orm
-
-    import base
     import re
 
-    db_config, storage, project, root_path, component = self.get_configs(disk_type)
-    if db_config is None:
-        return collections.deque()
-
-    queue = collections.deque()
-    queue.append(project)
     disk_depth = None
-
     while queue \
             and queue[0].__tablename__ == 'folder' \
             and db_config.config[str(queue[0].depth)]['from_disk'][queue[0].meaning][disk_type] < len(
@@ -155,10 +140,71 @@ def orm(self, disk_type='publish', refresh=False):
             if re.match(r'^{}$'.format(x.name), component[disk_depth].split('.')[0]):
                 queue.append(x)
 
+    return queue, disk_depth
+
+
+def _orm_from_index(self, disk_type):
+    '''
+    通过path_index 反向索引查找orm。（参考 dayu_database.path_index）
+    :param disk_type: string。可以是publish、work、cache 的三者之一
+    :return: tuple，(orm 的deque, 命中的硬盘路径)。如果索引中没有，返回 (None, None)
+    '''
+    import dayu_database
+    import path_index
+    import util
+
+    session = dayu_database.get_session()
+    prefix, orms, row = path_index.lookup(session, self, area=disk_type)
+    if not orms:
+        return None, None
+
+    if len(orms) > 1:
+        return collections.deque(orms), None
+
+    hit = orms[0]
+    component = path_index.normalize(self).split('/')
+    matched_length = len(prefix.split('/'))
+    if matched_length < len(component) and hit.__tablename__ == 'folder':
+        # 硬盘路径比命中的FOLDER 更深，剩下的部分继续按照原本的方式逐层匹配
+        root = path_index.normalize(util.get_storage_config(row.storage_name).config[disk_type][row.platform])
+        root_length = len(root.split('/'))
+        queue, disk_depth = _descend(collections.deque([hit]),
+                                     util.get_db_config(hit.db_config_name),
+                                     component[root_length:],
+                                     disk_type)
+        if disk_depth is None:
+            return queue, None
+        return queue, DayuPath('/'.join(component[:root_length + disk_depth + 1]))
+
+    return collections.deque([hit]), DayuPath('/'.join(component[:matched_length]))
+
+
+def orm(self, disk_type='publish', refresh=False):
+    '''
+    把路径转换为ORM 的函数。
+    优先使用path_index 反向索引，一次查询得到最长前缀匹配的orm；
+    索引中没有的路径（例如含有用户名的work 路径），退回到逐层正则匹配的方式。
+    :param disk_type: string。可以是publish、work、cache 的三者之一
+    :return: 如果只有唯一对应的ORM，返回ORM；否则返回deque()
+    '''
+    if getattr(self, '_cache_orm', None) and refresh is False:
+        return self._cache_orm
+
+    import base
+
+    queue, cache_disk_path = _orm_from_index(self, disk_type)
+    if queue is None:
+        db_config, storage, project, root_path, component = self.get_configs(disk_type)
+        if db_config is None:
+            return collections.deque()
+
+        queue, disk_depth = _descend(collections.deque([project]), db_config, component, disk_type)
+        if disk_depth is not None:
+            cache_disk_path = DayuPath(root_path + '/' + '/'.join(component[:disk_depth + 1]))
+
     self._cache_orm = queue[0] if len(queue) == 1 else queue
-    if isinstance(self._cache_orm, base.BASE):
-        setattr(self._cache_orm, '_cache_{}_disk_path'.format(disk_type),
-                DayuPath(root_path + '/' + '/'.join(component[:disk_depth + 1])))
+    if isinstance(self._cache_orm, base.BASE) and cache_disk_path is not None:
+        setattr(self._cache_orm, '_cache_{}_disk_path'.format(disk_type), cache_disk_path)
     return self._cache_orm
 
 
@@ -32,6 +32,91 @@ __doc__ = \
 import collections
 import re
 
+# 只要包含了这些字符，就认为是正则表达式，否则使用 = 进行精确匹配（可以使用索引）
+_regex_meta_characters = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+
+def _match_name(column, component):
+    '''
+    生成name 匹配的SQL 条件。
+    :param column: name 对应的column
+    :param component: DBPath 中的一个层级
+    :return: sqlalchemy 的条件表达式
+    '''
+    if _regex_meta_characters.search(component) is None:
+        return column == component
+    # 和原本python 中的 re.match('^{}$') 保持一致，使用postgres 的 ~ 进行正则匹配
+    return column.op('~')('^{}$'.format(component))
+
+
+def resolve_components(root_orm, components):
+    '''
+    在数据库中查找DBPath 的每一个层级对应的orm。
+    * 开头连续的、没有正则表达式的层级，由于同一个FOLDER 下不允许重名，可以直接拼成嵌套的子查询，不需要单独查询
+    * 之后的每一个层级只需要一次查询（最后一个层级FOLDER、FILE、SYMBOL 各一次）
+
+    返回结果的顺序和原本逐层遍历children 的顺序一致：先按照上一层级的顺序，同一个parent 内按照FOLDER、FILE、SYMBOL，再按照name 排序。
+
+    :param root_orm: 根节点FOLDER orm
+    :param components: list of string，DBPath 的每一个层级
+    :return: list of orm
+    '''
+    from sqlalchemy import select
+    from sqlalchemy.orm import object_session
+    import table
+
+    session = object_session(root_orm)
+    folder_table = table.FOLDER.__table__
+    last = len(components) - 1
+
+    # parent_clause 是一个函数，传入parent_id 的column，返回对应的筛选条件
+    parent_ids = [root_orm.id]
+    parent_clause = lambda column, parent_ids=parent_ids: column.in_(parent_ids)
+
+    index = 0
+    while index < last and _regex_meta_characters.search(components[index]) is None:
+        level = folder_table.alias()
+        subquery = select([level.c.id]).where(parent_clause(level.c.parent_id)) \
+            .where(level.c.name == components[index])
+        parent_ids = None
+        parent_clause = lambda column, subquery=subquery: column.in_(subquery)
+        index += 1
+
+    result = []
+    for index in range(index, last + 1):
+        queries = [session.query(table.FOLDER)
+                       .filter(parent_clause(table.FOLDER.parent_id), _match_name(table.FOLDER.name, components[index]))
+                       .order_by(table.FOLDER.name)]
+        if index == last:
+            queries.append(session.query(table.FILE)
+                           .filter(parent_clause(table.FILE.parent_id), _match_name(table.FILE.name, components[index]))
+                           .order_by(table.FILE.name))
+            queries.append(session.query(table.SYMBOL)
+                           .filter(table.SYMBOL.origin_table == 'folder',
+                                   parent_clause(table.SYMBOL.origin_id),
+                                   _match_name(table.SYMBOL.name, components[index]))
+                           .order_by(table.SYMBOL.origin_table, table.SYMBOL.origin_id))
+
+        children = collections.OrderedDict()
+        for query in queries:
+            for x in query:
+                key = x.origin_id if isinstance(x, table.SYMBOL) else x.parent_id
+                children.setdefault(key, []).append(x)
+
+        # 如果上一层级是子查询（开头精确匹配的部分），那么只会有一个parent
+        if parent_ids is None:
+            result = [x for value in children.values() for x in value]
+        else:
+            result = [x for parent_id in parent_ids for x in children.get(parent_id, ())]
+
+        if not result:
+            return []
+
+        parent_ids = [x.id for x in result]
+        parent_clause = lambda column, parent_ids=parent_ids: column.in_(parent_ids)
+
+    return result
+
 
 class DBPath(str):
     def __init__(self, object):
@@ -86,6 +171,7 @@ class DBPath(str):
         例如：
         DBPath('/project/sequence/pl/.*/dailies/cmp/.*').orm()
         相当于，获得了 pl 场次下，所有shot 的dailies，并且这些dailies 都是cmp 类型的。
+        查询会直接交给数据库完成，每个层级只需要一次查询。（参考 resolve_components）
         :return: 如果查找到多个，就返回orm 的deque。如果只找到一个orm，那么就返回这个orm；如果没有找到对应的orm，那么返回空deque
         '''
         if getattr(self, '_cache_orm', None) and refresh is None:
@@ -95,13 +181,7 @@ class DBPath(str):
         import base
 
         root_orm = util.get_root_folder()
-        queue = collections.deque()
-        queue.append(root_orm)
-
-        while queue and queue[0].depth < len(self.components):
-            current = queue.popleft()
-            queue.extend(x for x in current.children
-                         if re.match('^{}$'.format(self.components[current.depth]), x.name))
+        queue = collections.deque(resolve_components(root_orm, self.components))
 
         self._cache_orm = queue[0] if len(queue) == 1 else queue
         if isinstance(self._cache_orm, base.BASE):
@@ -125,9 +205,10 @@ class DBPath(str):
             getattr(self, '_cache_{}_disk_path'.format(disk_type), None)._cache_db_path = self
 
         else:
-            temp = collections.deque()
-            temp.extend((x.disk_path(disk_type=disk_type)
-                         for x in getattr(self, '_cache_{}_disk_path'.format(disk_type), None)))
+            # 多个orm 的时候，使用批量的方式计算路径
+            import path_template
+            temp = collections.deque(path_template.disk_paths(
+                    list(getattr(self, '_cache_{}_disk_path'.format(disk_type), None)), disk_type=disk_type))
             setattr(self, '_cache_{}_disk_path'.format(disk_type), temp)
 
         return getattr(self, '_cache_{}_disk_path'.format(disk_type), None)
@@ -157,17 +238,15 @@ class DBPath(str):
         :return:
         '''
         import table
+        import tree
         orm = self.orm()
         if isinstance(orm, table.FOLDER):
-            queue = collections.deque()
-            queue.append((orm, self))
-
-            while queue:
-                current_orm, current_path = queue.popleft()
-                for x in current_orm.children:
-                    next_path = DBPath(current_path + '/' + x.name)
-                    queue.append((x, next_path))
-                    yield next_path
+            # 使用id 记录每个orm 对应的数据库路径，SYMBOL 不会有子孙，所以不需要记录
+            paths = {orm.id: self}
+            for current_orm, x in tree.walk_with_parent(orm):
+                next_path = DBPath(paths[current_orm.id] + '/' + x.name)
+                paths[x.id] = next_path
+                yield next_path
 
         else:
             raise Exception('no orm in DB!')
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    进程级的engine、session 注册表。
+
+    原本 DayuDatabase 按照 id(threading.current_thread()) 保存实例，每一个线程 connect() 的时候都会创建自己的engine 和连接池。
+    线程结束之后engine 不会释放，线程id 还可能被新的线程重复使用。GUI 的线程池很容易就把Postgres 的连接数用完。
+
+    这里：
+    * 同一个进程内，每一个数据库url 只会创建一个engine，连接池的参数来自 DayuDatabaseConfig：
+        DAYU_DB_POOL_SIZE、DAYU_DB_MAX_OVERFLOW、DAYU_DB_POOL_TIMEOUT、DAYU_DB_POOL_RECYCLE、DAYU_DB_POOL_PRE_PING
+      （相同url 第二次调用 get_engine() 时，直接返回已经存在的engine，不会使用新的参数）
+    * session 通过 scoped_session 分配，每一个线程（如果安装了greenlet，那么是每一个greenlet）拥有自己的session
+    * 有新的线程第一次获取session 时，会清理已经结束的线程遗留的session，把连接还给连接池
+    * 线程池的worker 完成一次任务之后，可以调用 remove_session() 立刻归还连接
+
+    fork 之后的子进程（农场的wrapper、多进程的ingest 脚本）：
+    * 从父进程继承的连接和父进程共用同一个socket，子进程绝对不能使用，也不能close（close 会让父进程的连接断开）
+    * 子进程第一次使用engine、session 的时候（通过pid 判断，python3 中还会使用 os.register_at_fork），
+      丢弃继承的连接池和session，之后重新连接。丢弃的psycopg2 连接被回收时，会判断pid，不会关闭父进程的连接
+    * 每一个连接都记录了创建时的pid，如果仍然有代码持有继承的连接，checkout 的时候会被丢弃并且重新连接
+
+    '''
+
+import os
+import threading
+
+# key 是数据库url 的string
+_engines = {}
+_sessions = {}
+_lock = threading.RLock()
+
+# 创建当前连接池的进程id
+_pid = os.getpid()
+
+
+def _after_fork():
+    '''
+    fork 之后在子进程中调用。丢弃继承的连接池和session，但是不关闭其中的连接
+    '''
+    global _pid
+    with _lock:
+        for engine in _engines.values():
+            # 和 engine.dispose() 一样替换成新的连接池，但是旧的连接池不会close 任何连接
+            engine.pool = engine.pool.recreate()
+        _sessions.clear()
+        _pid = os.getpid()
+
+
+def check_fork():
+    '''
+    如果当前进程是fork 出的子进程，并且还没有处理过继承的连接，那么丢弃继承的连接池和session
+    :return: bool，是否是新fork 的子进程
+    '''
+    if os.getpid() == _pid:
+        return False
+
+    with _lock:
+        if os.getpid() == _pid:
+            return False
+        _after_fork()
+        return True
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _track_pid(engine):
+    '''
+    记录每一个连接创建时的pid。其他进程checkout 这个连接时，丢弃连接（不close），让连接池重新连接
+    '''
+    import sqlalchemy.event
+    from sqlalchemy import exc
+
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @sqlalchemy.event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info.get('pid', pid) != pid:
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError('connection belongs to pid {}, current pid {}'
+                                         .format(connection_record.info['pid'], pid))
+
+
+def pool_options(config):
+    '''
+    根据DayuDatabaseConfig 生成create_engine 的连接池参数
+    :param config: DayuDatabaseConfig 或者dict
+    :return: dict
+    '''
+    from config.const import (DAYU_DB_POOL_SIZE, DAYU_DB_MAX_OVERFLOW, DAYU_DB_POOL_TIMEOUT,
+                              DAYU_DB_POOL_RECYCLE, DAYU_DB_POOL_PRE_PING)
+
+    config = config or {}
+    return {'pool_size'    : int(config.get(DAYU_DB_POOL_SIZE, 5)),
+            'max_overflow' : int(config.get(DAYU_DB_MAX_OVERFLOW, 10)),
+            'pool_timeout' : float(config.get(DAYU_DB_POOL_TIMEOUT, 30.0)),
+            'pool_recycle' : int(config.get(DAYU_DB_POOL_RECYCLE, -1)),
+            'pool_pre_ping': bool(config.get(DAYU_DB_POOL_PRE_PING, False))}
+
+
+def get_engine(url, config=None):
+    '''
+    获得url 对应的engine。同一个进程内相同的url 只会创建一次
+    :param url: sqlalchemy URL
+    :param config: DayuDatabaseConfig，用来读取连接池的参数
+    :return: sqlalchemy engine
+    '''
+    check_fork()
+    key = str(url)
+    engine = _engines.get(key, None)
+    if engine is not None:
+        return engine
+
+    from sqlalchemy import create_engine
+
+    with _lock:
+        engine = _engines.get(key, None)
+        if engine is None:
+            engine = create_engine(url, echo=False, isolation_level='READ COMMITTED', **pool_options(config))
+            _track_pid(engine)
+            _engines[key] = engine
+        return engine
+
+
+def _scope():
+    '''
+    scoped_session 使用的key。默认是当前的线程，如果安装了greenlet，那么是 (线程, 当前的greenlet)
+    '''
+    current_thread = threading.current_thread()
+    try:
+        import greenlet
+    except ImportError:
+        return current_thread
+    return current_thread, greenlet.getcurrent()
+
+
+def _is_alive(scope):
+    '''
+    判断scope 对应的线程（以及greenlet）是否还在运行
+    '''
+    if isinstance(scope, tuple):
+        current_thread, current_greenlet = scope
+        return current_thread.is_alive() and not current_greenlet.dead
+    return scope.is_alive()
+
+
+def get_scoped_session(engine):
+    '''
+    获得engine 对应的scoped_session。同一个engine 只会创建一次
+    :param engine: sqlalchemy engine
+    :return: sqlalchemy scoped_session
+    '''
+    check_fork()
+    key = str(engine.url)
+    scoped = _sessions.get(key, None)
+    if scoped is not None:
+        return scoped
+
+    import sqlalchemy.event
+    from sqlalchemy.orm import sessionmaker, scoped_session
+
+    with _lock:
+        scoped = _sessions.get(key, None)
+        if scoped is None:
+            session_maker = sessionmaker(bind=engine, autoflush=False)
+
+            @sqlalchemy.event.listens_for(session_maker, 'after_commit')
+            def event_after_commit(session):
+                print 'db commit completed'
+                # net_log.get_logger().info('db commit completed')
+
+            scoped = scoped_session(session_maker, scopefunc=_scope)
+            _sessions[key] = scoped
+        return scoped
+
+
+def current_session(engine):
+    '''
+    获得当前线程（greenlet）的session。
+    当前线程第一次获取session 时，会先清理已经结束的线程的session
+    :param engine: sqlalchemy engine
+    :return: sqlalchemy session
+    '''
+    scoped = get_scoped_session(engine)
+    if not scoped.registry.has():
+        cleanup()
+    return scoped()
+
+
+def remove_session(engine):
+    '''
+    关闭当前线程（greenlet）的session，归还连接。之后再获取session 会得到一个新的session
+    :param engine: sqlalchemy engine
+    :return: None
+    '''
+    check_fork()
+    scoped = _sessions.get(str(engine.url), None)
+    if scoped is not None:
+        scoped.remove()
+
+
+def cleanup():
+    '''
+    关闭所有已经结束的线程（greenlet）遗留的session，把连接还给连接池
+    :return: int，清理的session 数量
+    '''
+    count = 0
+    with _lock:
+        for scoped in _sessions.values():
+            registry = scoped.registry.registry
+            for scope in list(registry.keys()):
+                if _is_alive(scope):
+                    continue
+                session = registry.pop(scope, None)
+                if session is not None:
+                    session.close()
+                    count += 1
+    return count
+
+
+def dispose(url=None):
+    '''
+    关闭engine 以及对应的所有session，释放连接池中的连接
+    :param url: sqlalchemy URL 或者string，如果为None，那么释放全部的engine
+    :return: None
+    '''
+    check_fork()
+    with _lock:
+        keys = list(_engines.keys()) if url is None else [str(url)]
+        for key in keys:
+            scoped = _sessions.pop(key, None)
+            if scoped is not None:
+                for session in scoped.registry.registry.values():
+                    session.close()
+                scoped.registry.registry.clear()
+            engine = _engines.pop(key, None)
+            if engine is not None:
+                engine.dispose()
@@ -13,20 +13,38 @@ __doc__ = \
     
     同时，通过sqlalchemy 的inspect 动态的解析orm 的属性，判断是否是relationship，方便前端进行选择。
     
+    JSONB column（extra_data、path_data、*_clue）除了整体比较，还可以：
+    * 使用 JSONB_OPERATIONS 中的操作，例如 {'col': 'vfx_clue', 'op': 'contains', 'value': '["A001"]', 'type': 'JSONB'}
+    * 用 . 过滤其中的内容，例如 {'col': 'extra_data.fps', 'op': 'eq', 'value': 24, 'type': 'INTEGER'}
+    
     '''
 
 import collections
 import datetime
-
-from sqlalchemy import and_, or_, not_, inspect
-from sqlalchemy.orm.properties import RelationshipProperty, ColumnProperty
+import json
 
 import util
 
+
+def _logic(name):
+    '''
+    延迟加载sqlalchemy 的逻辑函数。只需要token、OPERATION_SWITCH 的工具不会因为import filter_parse 加载sqlalchemy
+    :param name: string，sqlalchemy 中的函数名，例如 and_
+    :return: 函数，参数和sqlalchemy 中对应的函数一致
+    '''
+
+    def logic_func(*args, **kwargs):
+        import sqlalchemy
+        return getattr(sqlalchemy, name)(*args, **kwargs)
+
+    logic_func.__name__ = name
+    return logic_func
+
+
 # 关键字函数定义
-LOGIC_SWITCH = {'and': and_,
-                'or' : or_,
-                'not': not_}
+LOGIC_SWITCH = {'and': _logic('and_'),
+                'or' : _logic('or_'),
+                'not': _logic('not_')}
 
 # 给前端的对应关系，每个tuple 中，第一个是前端显示使用，后一个是后台的函数定义名称
 OPERATION_SWITCH = {'VARCHAR' : collections.OrderedDict((('is', 'eq'), ('like', 'like'), ('is not', 'ne'),
@@ -46,18 +64,41 @@ OPERATION_SWITCH = {'VARCHAR' : collections.OrderedDict((('is', 'eq'), ('like',
                     'JSONB'   : collections.OrderedDict((('is', 'eq'), ('like', 'like'), ('is not', 'ne'),
                                                          ('less than', 'lt'), ('greater than', 'gt'),
                                                          ('less equal', 'le'), ('greater than', 'ge'),
-                                                         ('contain', 'in'), ('not contain', 'not_in'))),
+                                                         ('contain', 'in'), ('not contain', 'not_in'),
+                                                         ('include', 'contains'), ('not include', 'not_contains'),
+                                                         ('included by', 'contained_by'),
+                                                         ('has key', 'has_key'), ('not has key', 'not_has_key'),
+                                                         ('has any key', 'has_any'), ('has all keys', 'has_all'))),
                     'BOOLEAN' : collections.OrderedDict((('is', 'eq'), ('like', 'like'), ('is not', 'ne'))),
                     }
 
+# JSONB 专用的操作：
+# contains -> @>，contained_by -> <@，has_key -> ?，has_any -> ?|，has_all -> ?&
+# 其中 contains、has_key 系列可以使用GIN 索引（参考 init_db/migrate.py 中的 jsonb_gin_index）
+JSONB_OPERATIONS = ('contains', 'contained_by', 'has_key', 'has_any', 'has_all')
+
 DATETIME_FORMATTER = '%Y-%m-%d %H:%M:%S'
 
+
+def _resolve_jsonb(value):
+    '''
+    JSONB 的值使用json 字符串表示，例如 {"fps": 24}、["A001"]、24。
+    不是合法json 的字符串（例如 has_key 的 fps）保持原样
+    '''
+    if isinstance(value, basestring):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+
 # 类型转换的定义
 CAST_RULE = {'VARCHAR' : str,
              'INTEGER' : int,
              'BIGINT'  : long,
              'DATETIME': lambda v: datetime.datetime.strptime(v, DATETIME_FORMATTER),
-             'JSONB'   : None,
+             'JSONB'   : _resolve_jsonb,
              'BOOLEAN' : bool,
              }
 
@@ -208,18 +249,38 @@ def resolve_expression(expression):
     return None
 
 
+def _attribute_info(orm_property):
+    '''
+    给前端的orm 属性描述
+    :param orm_property: ColumnProperty 或者RelationshipProperty
+    :return: dict。JSONB column 的 path 为True，表示可以用 . 继续过滤其中的内容，例如 extra_data.fps
+    '''
+    from sqlalchemy.dialects.postgresql import JSONB
+    from sqlalchemy.orm.properties import RelationshipProperty, ColumnProperty
+
+    if type(orm_property) == ColumnProperty:
+        column_type = str(orm_property._orig_columns[0].type)
+        return {'type': column_type,
+                'join': False,
+                'table': None,
+                'path': isinstance(orm_property._orig_columns[0].type, JSONB),
+                'ops': OPERATION_SWITCH.get(column_type, {}).items()}
+
+    return {'type': 'relation',
+            'join': True if type(orm_property) == RelationshipProperty else False,
+            'table': orm_property.mapper.class_.__tablename__,
+            'path': False,
+            'ops': []}
+
+
 def get_sql_attributes(class_name_or_property):
+    from sqlalchemy import inspect
+    from sqlalchemy.orm.properties import ColumnProperty
+
     atts = class_name_or_property.split('.')
     db_class = util.get_class(atts[0])
     if len(atts) == 1:
-        return {key: {
-            'type' : str(value._orig_columns[0].type) \
-                if type(value) == ColumnProperty \
-                else 'relation',
-            'join' : True if type(value) == RelationshipProperty else False,
-            'table': None if type(
-                    value) == ColumnProperty else value.mapper.class_.__tablename__}
-            for key, value in inspect(db_class).attrs.items()}
+        return {key: _attribute_info(value) for key, value in inspect(db_class).attrs.items()}
     else:
         current_class = db_class
         for x in atts[1:]:
@@ -230,14 +291,55 @@ def get_sql_attributes(class_name_or_property):
                 raise Exception('no such attr')
             current_class = orm_property.mapper.class_
 
-        return {key: {
-            'type' : str(
-                    value._orig_columns[0].type) if type(
-                    value) == ColumnProperty else 'relation',
-            'join' : True if type(value) == RelationshipProperty else False,
-            'table': None if type(
-                    value) == ColumnProperty else value.mapper.class_.__tablename__}
-            for key, value in inspect(current_class).attrs.items()}
+        return {key: _attribute_info(value) for key, value in inspect(current_class).attrs.items()}
+
+
+# 投影查询结果的record class，key 是label 的tuple
+_ROW_TYPES = {}
+
+
+def resolve_projection(model_class, columns):
+    '''
+    解析投影查询需要读取的column。
+    除了普通的column，还可以用 . 读取JSONB column 中的内容，例如 extra_data.fps、extra_data.cache.path
+    :param model_class: ORM class
+    :param columns: list of string，例如 ['id', 'name', 'meaning', 'created_time', 'extra_data.fps']
+    :return: list of tuple，(label, sqlalchemy 表达式)。label 中的 . 会被替换成 __，例如 extra_data__fps
+    '''
+    from sqlalchemy import inspect
+    from sqlalchemy.dialects.postgresql import JSONB
+    from sqlalchemy.orm.properties import ColumnProperty
+
+    result = []
+    for column in columns:
+        atts = column.split('.')
+        orm_property = inspect(model_class).attrs.get(atts[0], None)
+        if type(orm_property) != ColumnProperty:
+            raise Exception('no such attr: {}'.format(column))
+
+        expression = getattr(model_class, atts[0])
+        if len(atts) > 1:
+            if not isinstance(orm_property.columns[0].type, JSONB):
+                raise Exception('only JSONB column can use path: {}'.format(column))
+            expression = expression[atts[1]] if len(atts) == 2 else expression[tuple(atts[1:])]
+
+        label = '__'.join(atts)
+        result.append((label, expression.label(label)))
+
+    return result
+
+
+def get_row_type(labels):
+    '''
+    获得投影查询结果使用的record class（namedtuple，没有 __dict__，每一行只占用一个tuple 的内存）
+    :param labels: list of string，resolve_projection 得到的label
+    :return: namedtuple class
+    '''
+    labels = tuple(labels)
+    row_type = _ROW_TYPES.get(labels, None)
+    if row_type is None:
+        row_type = _ROW_TYPES.setdefault(labels, collections.namedtuple('SearchRow', labels, rename=True))
+    return row_type
 
 
 if __name__ == '__main__':
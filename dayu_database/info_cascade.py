@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    继承info（cascading info）的批量读取和缓存。
+
+    原本 util.get_cascading_info() 和 DepthMixin.cascading_info 会对hierarchy 中的每一个orm 执行一次
+    infos.filter(INFO.name == info_name).first()，一个VERSION 大约需要10 次查询。
+    insert_file 为自动版本号的FILE 初始化版本计数器时也会调用，批量发布的时候这些查询会被重复很多次。
+
+    这里：
+    * 一次查询得到hierarchy 上所有orm 对应名字的INFO，然后在内存中按照从root 到自身的顺序合并
+    * 合并之后的 all_info、inherit_info、private_info 按照 (数据库, info_name, debug, hierarchy 路径) 缓存在进程内，
+      orm 被移动之后路径不同，自然不会使用旧的结果
+    * 当前进程修改、删除INFO 时，table.py 中的监听函数会让路径上包含这个INFO 所挂靠orm 的缓存失效。
+      事务结束（commit、rollback）之前，这个session 不会使用也不会写入缓存，事务结束的时候再失效一次
+    * 其他进程的修改，最迟在 DAYU_DB_CONFIG_CACHE_TTL 秒之后重新读取
+
+    '''
+
+import collections
+import copy
+import threading
+import time
+
+# 最多缓存的数量，超过之后丢弃最久没有使用的
+MAX_ENTRIES = 4096
+
+_cache = collections.OrderedDict()
+_lock = threading.RLock()
+
+# session.info 中记录还没有结束的事务里修改过的INFO
+_PENDING = 'dayu_info_cascade_pending'
+_LISTENING = 'dayu_info_cascade_listening'
+
+
+class _Entry(object):
+    def __init__(self, path, result):
+        self.path = set(path)
+        self.result = result
+        self.checked_time = time.time()
+
+
+def _ttl():
+    import dayu_database
+    from config.const import DAYU_DB_CONFIG_CACHE_TTL
+    return float(dayu_database.get_db().config.get(DAYU_DB_CONFIG_CACHE_TTL, 5.0))
+
+
+def _copy(result):
+    # INFO 的内容可能嵌套dict、list，需要完整复制，调用者修改返回的内容才不会影响缓存
+    return copy.deepcopy(result)
+
+
+def merge(infos, path):
+    '''
+    按照hierarchy 的顺序合并INFO 的内容
+    :param infos: dict，key 是 (hook_table, hook_id)，value 是INFO 的extra_data 或者debug_data
+    :param path: list of tuple，从root 到自身的 (table 名, id)
+    :return: dict，包含 all_info、inherit_info、private_info
+    '''
+    result = {'all_info': {}, 'private_info': {}, 'inherit_info': {}}
+    for key in path[:-1]:
+        result['inherit_info'].update(dict(infos.get(key, None) or {}))
+
+    result['private_info'] = dict(infos.get(path[-1], None) or {})
+    for k in result['private_info']:
+        result['inherit_info'].pop(k, None)
+
+    result['all_info'].update(result['inherit_info'])
+    result['all_info'].update(result['private_info'])
+    return result
+
+
+def _query(session, info_name, path, debug=False):
+    '''
+    一次查询得到path 上所有orm 名为info_name 的INFO。同一个orm 有多个同名INFO 时，使用最早创建的那一个
+    :return: dict，key 是 (hook_table, hook_id)
+    '''
+    from sqlalchemy import select, and_, or_
+    import table
+
+    hooks = collections.defaultdict(set)
+    for hook_table, hook_id in path:
+        if hook_id is not None:
+            hooks[hook_table].add(hook_id)
+    if not hooks:
+        return {}
+
+    info_table = table.INFO.__table__
+    data_column = info_table.c.debug_data if debug else info_table.c.extra_data
+    rows = session.execute(select([info_table.c.hook_table, info_table.c.hook_id, data_column])
+                           .where(info_table.c.name == info_name)
+                           .where(or_(*[and_(info_table.c.hook_table == k, info_table.c.hook_id.in_(v))
+                                        for k, v in hooks.items()]))
+                           .order_by(info_table.c.id))
+
+    result = {}
+    for hook_table, hook_id, data in rows:
+        result.setdefault((hook_table, hook_id), data)
+    return result
+
+
+def resolve(orm, info_name, debug=False, session=None):
+    '''
+    获得orm 的继承info。返回的内容和原本的 util.get_cascading_info 相同
+    :param orm: FOLDER、FILE orm
+    :param info_name: string，对应的是info.name
+    :param debug: bool。默认情况读取extra_data，如果True，那么读取debug_data
+    :param session: sqlalchemy session，默认是orm 所在的session
+    :return: dict，包含 all_info、inherit_info、private_info。修改返回的dict 不会影响缓存
+    '''
+    from sqlalchemy.orm import object_session
+    import dayu_database
+
+    session = session or object_session(orm) or dayu_database.get_session()
+    path = tuple((x.__tablename__, x.id) for x in orm.hierarchy)
+    key = (str(session.bind.url), info_name, bool(debug), path)
+
+    # 当前事务中修改过INFO，数据库中的内容只有这个session 可见，不能使用、也不能写入缓存
+    if session.info.get(_PENDING):
+        return merge(_query(session, info_name, path, debug=debug), path)
+
+    with _lock:
+        entry = _cache.pop(key, None)
+        if entry is not None:
+            _cache[key] = entry
+    if entry is not None and time.time() - entry.checked_time < _ttl():
+        return _copy(entry.result)
+
+    result = merge(_query(session, info_name, path, debug=debug), path)
+    with _lock:
+        _cache[key] = _Entry(path, result)
+        while len(_cache) > MAX_ENTRIES:
+            _cache.popitem(last=False)
+    return _copy(result)
+
+
+def invalidate(info_name=None, hooks=None):
+    '''
+    让缓存失效
+    :param info_name: string 或者list of string。如果为None，那么所有名字的缓存都会失效
+    :param hooks: list of tuple，(hook_table, hook_id)。只让路径上包含这些orm 的缓存失效。如果为None，那么全部失效
+    :return: None
+    '''
+    if isinstance(info_name, basestring):
+        info_name = [info_name]
+
+    with _lock:
+        for key, entry in list(_cache.items()):
+            if info_name is not None and key[1] not in info_name:
+                continue
+            if hooks is not None and not entry.path.intersection(hooks):
+                continue
+            _cache.pop(key, None)
+
+
+def invalidate_info(info):
+    '''
+    INFO 被创建、修改、删除之后，让相关的缓存失效。（在table.py 的监听函数中调用）
+    修改前后的名字、挂靠的orm 都会被处理
+    :param info: INFO orm
+    :return: None
+    '''
+    from sqlalchemy import inspect
+    from sqlalchemy.orm import object_session
+
+    attrs = inspect(info).attrs
+
+    def values(name):
+        history = attrs[name].history
+        return set(history.added or ()) | set(history.unchanged or ()) | set(history.deleted or ())
+
+    # 无法确定名字或者挂靠的orm 时（例如属性已经expire），扩大失效的范围
+    names = list(values('name')) or None
+    hooks = [(x, y) for x in values('hook_table') for y in values('hook_id')] or None
+    invalidate(info_name=names, hooks=hooks)
+
+    session = object_session(info)
+    if session is not None:
+        session.info.setdefault(_PENDING, []).append((names, hooks))
+        _listen(session)
+
+
+def _end_transaction(session, *args):
+    '''
+    事务结束之后，其他session 在这段时间缓存的内容可能已经过期，需要再失效一次
+    '''
+    for names, hooks in session.info.pop(_PENDING, []):
+        invalidate(info_name=names, hooks=hooks)
+
+
+def _listen(session):
+    '''
+    在session 上注册事务结束的监听函数。每一个session 只会注册一次
+    '''
+    import sqlalchemy.event
+
+    if session.info.get(_LISTENING):
+        return
+    session.info[_LISTENING] = True
+    sqlalchemy.event.listen(session, 'after_commit', _end_transaction)
+    sqlalchemy.event.listen(session, 'after_soft_rollback', _end_transaction)
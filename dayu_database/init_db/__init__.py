@@ -35,6 +35,10 @@ def init_db(db=None, preset=None):
 
         session.commit()
 
+    # preset 不会经过reflection table 的监听函数，所以需要通过migration 补全path_ids 这类维护性质的数据
+    from migrate import migrate
+    migrate(db)
+
 
 if __name__ == '__main__':
     init_db('test')
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    对已经存在的数据库进行结构升级。
+
+    init_db() 只会使用create_all 创建不存在的table，对于已经存在的table 新增的column、index 不会生效。
+    这里的每一个migration 都必须是可以重复执行的（IF NOT EXISTS、只更新需要更新的row），
+    这样无论数据库处在哪个状态，直接运行 migrate() 都可以得到最新的结构。
+
+    使用方法：
+        from dayu_database.init_db.migrate import migrate
+        migrate('test')                             # 执行全部非optional 的migration
+        migrate('test', names=['path_ids'])         # 只执行指定的migration
+
+    '''
+
+import collections
+
+MIGRATIONS = collections.OrderedDict()
+
+
+def migration(name, optional=False):
+    '''
+    注册migration 的装饰器。被装饰的函数接受一个已经开启事务的connection。
+    :param name: string，migration 的名字
+    :param optional: bool，如果为True，那么migrate() 默认不会执行，需要用户通过names 明确指定
+    :return: 装饰器
+    '''
+
+    def wrapper(func):
+        MIGRATIONS[name] = (func, optional)
+        return func
+
+    return wrapper
+
+
+def migrate(db=None, names=None):
+    '''
+    按照注册的顺序执行migration，每一个migration 在独立的事务中执行。
+    :param db: string，数据库的名字
+    :param names: list of string，需要执行的migration 名字。如果为None，那么执行全部非optional 的migration
+    :return: list of string，执行过的migration 名字
+    '''
+    import dayu_database
+
+    db_obj = dayu_database.get_db(db=db)
+    db_obj.connect()
+
+    if names is None:
+        names = [k for k, (func, optional) in MIGRATIONS.items() if not optional]
+
+    for name in names:
+        if name not in MIGRATIONS:
+            raise KeyError('no migration named: {}'.format(name))
+
+    for name in names:
+        func, _ = MIGRATIONS[name]
+        with db_obj.engine.begin() as connection:
+            func(connection)
+
+    return names
+
+
+@migration('path_ids')
+def add_path_ids(connection):
+    '''
+    为FOLDER、FILE 添加物化路径 path_ids，并且回填所有已经存在的数据
+    '''
+    for table_name in ('folder', 'file'):
+        connection.execute('ALTER TABLE {0} ADD COLUMN IF NOT EXISTS path_ids BIGINT[]'.format(table_name))
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_{0}_path_ids ON {0} USING gin (path_ids)'
+                           .format(table_name))
+
+    # 从root 开始递归计算每一个FOLDER 的路径。NOT id = ANY(...) 用来防止错误数据形成环状引用
+    connection.execute('''
+        WITH RECURSIVE ancestry(id, path_ids) AS (
+            SELECT id, ARRAY[id] FROM folder WHERE parent_id IS NULL
+            UNION ALL
+            SELECT folder.id, ancestry.path_ids || folder.id
+            FROM folder JOIN ancestry ON folder.parent_id = ancestry.id
+            WHERE NOT folder.id = ANY(ancestry.path_ids)
+        )
+        UPDATE folder SET path_ids = ancestry.path_ids
+        FROM ancestry
+        WHERE folder.id = ancestry.id AND folder.path_ids IS DISTINCT FROM ancestry.path_ids
+    ''')
+
+    # FILE 不会有子孙，直接使用parent 的路径
+    connection.execute('''
+        UPDATE file SET path_ids = folder.path_ids || file.id
+        FROM folder
+        WHERE file.parent_id = folder.id AND folder.path_ids IS NOT NULL
+          AND file.path_ids IS DISTINCT FROM folder.path_ids || file.id
+    ''')
+
+
+@migration('path_index')
+def add_path_index(connection):
+    '''
+    创建硬盘路径的反向索引 path_index，并且根据已经存在的FOLDER、FILE 重新生成全部索引
+    '''
+    from sqlalchemy import Table
+    from sqlalchemy.orm import Session
+    import dayu_database
+    from dayu_database import path_index
+    from dayu_database.base import BASE
+
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS path_index (
+            path VARCHAR COLLATE "C",
+            area VARCHAR NOT NULL,
+            platform VARCHAR NOT NULL,
+            storage_name VARCHAR,
+            hook_table VARCHAR NOT NULL,
+            hook_id BIGINT NOT NULL,
+            PRIMARY KEY (area, platform, hook_table, hook_id)
+        )
+    ''')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_path_index_path ON path_index (path)')
+
+    # 回填需要使用反射之后的orm。如果反射发生在创建table 之前，那么需要单独反射path_index
+    dayu_database.get_session()
+    if path_index.get_table() is None:
+        Table('path_index', BASE.metadata, autoload=True, autoload_with=connection)
+
+    path_index.rebuild(Session(bind=connection))
+
+
+@migration('sibling_name_index')
+def add_sibling_name_index(connection):
+    '''
+    为同一层级的重名检查添加 (parent_id, name) 索引
+    '''
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_folder_parent_id_name ON folder (parent_id, name)')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_file_parent_id_name ON file (parent_id, name)')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_symbol_origin_id_name ON symbol (origin_id, name)')
+
+
+@migration('unique_sibling_name', optional=True)
+def add_unique_sibling_name(connection):
+    '''
+    在数据库层面保证同一层级内FOLDER、FILE、SYMBOL 不会重名。
+    唯一性跨越了三个table，无法使用unique index，所以使用trigger 实现。
+    同一个parent 的检查会使用advisory lock 串行执行，避免并发insert 时同时通过检查。
+
+    已经存在重名数据的数据库，需要先清理重名数据，之后新的写入才会被检查。
+    使用方法：migrate('test', names=['unique_sibling_name'])
+    '''
+    from sqlalchemy import text
+
+    # RAISE 中的 % 会和psycopg2 的参数冲突，使用text() 由sqlalchemy 负责转义
+    connection.execute(text('''
+        CREATE OR REPLACE FUNCTION dayu_check_sibling_name() RETURNS trigger AS $$
+        DECLARE
+            container BIGINT;
+        BEGIN
+            IF TG_TABLE_NAME = 'symbol' THEN
+                IF NEW.origin_table IS DISTINCT FROM 'folder' THEN
+                    RETURN NEW;
+                END IF;
+                container := NEW.origin_id;
+            ELSE
+                container := NEW.parent_id;
+            END IF;
+
+            IF container IS NULL OR NEW.name IS NULL THEN
+                RETURN NEW;
+            END IF;
+
+            PERFORM pg_advisory_xact_lock(container);
+            IF EXISTS (SELECT 1 FROM folder
+                       WHERE parent_id = container AND name = NEW.name
+                         AND NOT (TG_TABLE_NAME = 'folder' AND id = NEW.id))
+               OR EXISTS (SELECT 1 FROM file
+                          WHERE parent_id = container AND name = NEW.name
+                            AND NOT (TG_TABLE_NAME = 'file' AND id = NEW.id))
+               OR EXISTS (SELECT 1 FROM symbol
+                          WHERE origin_table = 'folder' AND origin_id = container AND name = NEW.name
+                            AND NOT (TG_TABLE_NAME = 'symbol' AND id = NEW.id)) THEN
+                RAISE EXCEPTION 'duplicate name % in %', NEW.name, container USING ERRCODE = 'unique_violation';
+            END IF;
+
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    '''))
+
+    for table_name, columns in (('folder', 'name, parent_id'),
+                                ('file', 'name, parent_id'),
+                                ('symbol', 'name, origin_table, origin_id')):
+        connection.execute('DROP TRIGGER IF EXISTS tr_{0}_sibling_name ON {0}'.format(table_name))
+        connection.execute('CREATE TRIGGER tr_{0}_sibling_name '
+                           'BEFORE INSERT OR UPDATE OF {1} ON {0} '
+                           'FOR EACH ROW EXECUTE PROCEDURE dayu_check_sibling_name()'.format(table_name, columns))
+
+
+@migration('version_counter')
+def add_version_counter(connection):
+    '''
+    创建版本计数器 version_counter。计数器会在第一次分配版本号的时候根据已有的FILE 初始化，不需要回填
+    '''
+    from sqlalchemy import Table
+    import dayu_database
+    from dayu_database.base import BASE
+
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS version_counter (
+            parent_id BIGINT PRIMARY KEY,
+            last_version INTEGER,
+            width INTEGER
+        )
+    ''')
+
+    dayu_database.get_session()
+    if 'version_counter' not in BASE.metadata.tables:
+        Table('version_counter', BASE.metadata, autoload=True, autoload_with=connection)
+
+
+@migration('jsonb_gin_index')
+def add_jsonb_gin_index(connection):
+    '''
+    为SEARCH 中会过滤的JSONB column 添加GIN 索引。
+    extra_data、path_data 以及 *_clue 上的 @>、?、?|、?&（以及 extra_data.fps = 24 这种改写成 @> 的条件）可以使用索引
+    '''
+    columns = ('extra_data', 'path_data',
+               'cam_clue', 'scene_clue', 'shot_clue', 'take_clue', 'vfx_clue', 'di_clue')
+    for table_name in ('folder', 'file'):
+        for column in columns:
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_{0}_{1} ON {0} USING gin ({1})'
+                               .format(table_name, column))
+
+
+@migration('clue_tokens')
+def add_clue_tokens(connection):
+    '''
+    为FOLDER、FILE 添加metadata 的线索索引 clue_tokens，并且根据已有的vfx_clue、cam_clue 回填。
+    规则和 clue_index.get_tokens 一致：合并、去重，'ALL'、'*'、空字符串记录为通配符 '*'
+    '''
+    for table_name in ('folder', 'file'):
+        connection.execute('ALTER TABLE {0} ADD COLUMN IF NOT EXISTS clue_tokens JSONB'.format(table_name))
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_{0}_clue_tokens ON {0} USING gin (clue_tokens)'
+                           .format(table_name))
+        connection.execute('''
+            UPDATE {0} SET clue_tokens = tokens.value
+            FROM (
+                SELECT {0}.id,
+                       coalesce(jsonb_agg(DISTINCT CASE WHEN clue IN ('ALL', '*', '') THEN '*' ELSE clue END
+                                          ORDER BY CASE WHEN clue IN ('ALL', '*', '') THEN '*' ELSE clue END)
+                                FILTER (WHERE clue IS NOT NULL), '[]'::jsonb) AS value
+                FROM {0}
+                LEFT JOIN LATERAL jsonb_array_elements_text(
+                    CASE WHEN jsonb_typeof({0}.vfx_clue) = 'array' THEN {0}.vfx_clue ELSE '[]'::jsonb END ||
+                    CASE WHEN jsonb_typeof({0}.cam_clue) = 'array' THEN {0}.cam_clue ELSE '[]'::jsonb END
+                ) AS clue ON true
+                GROUP BY {0}.id
+            ) tokens
+            WHERE {0}.id = tokens.id AND {0}.clue_tokens IS DISTINCT FROM tokens.value
+        '''.format(table_name))
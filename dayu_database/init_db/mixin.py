@@ -4,10 +4,10 @@ import itertools
 
 __author__ = 'andyguo'
 
-from sqlalchemy import Column, String, BigInteger, Integer, DateTime, func
+from sqlalchemy import Column, String, BigInteger, Integer, DateTime, Index, func
 from sqlalchemy.orm import deferred, relationship, backref
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import JSONB, ARRAY
 from dayu_database.util import current_user_name
 
 
@@ -137,6 +137,17 @@ class DepthMixin(object):
     parent_id = Column(BigInteger, index=True)
     top_id = Column(BigInteger, index=True)
 
+    # 物化路径：从root_orm 到自身（包括自身）的所有id，例如 [root_id, project_id, ... self_id]
+    # "X 的所有子孙" 就是 path_ids @> ARRAY[X.id]，"X 的所有祖先" 就是 X.path_ids，都只需要一次走索引的查询
+    path_ids = Column(ARRAY(BigInteger))
+
+    @declared_attr
+    def __table_args__(cls):
+        # path_ids 需要GIN 索引，才能让 @> 的查询走索引
+        # (parent_id, name) 用来检查同一层级内是否重名
+        return (Index('ix_{}_path_ids'.format(cls.__tablename__), 'path_ids', postgresql_using='gin'),
+                Index('ix_{}_parent_id_name'.format(cls.__tablename__), 'parent_id', 'name'))
+
 
 class ClueMixin(object):
     '''
@@ -174,6 +185,11 @@ class ClueMixin(object):
         # di_clue 记录DI 需要的信息（暂时没有）
         return deferred(Column(JSONB, default=[]))
 
+    @declared_attr
+    def clue_tokens(cls):
+        # vfx_clue 和cam_clue 合并之后的线索，由监听函数维护，用来通过GIN 索引匹配metadata（参考 clue_index.py）
+        return Column(JSONB, default=[])
+
 
 class InfoMixin(object):
     '''
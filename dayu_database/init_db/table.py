@@ -77,7 +77,7 @@ VIEW_PERMISSION 提供了对VIEW 共享的控制。适用于下面使用场景
 
 '''
 
-from sqlalchemy import Table, Column, String, BigInteger, Integer, Float, Date, Boolean, ForeignKey, and_
+from sqlalchemy import Table, Column, String, BigInteger, Integer, Float, Date, Boolean, ForeignKey, Index, and_
 from sqlalchemy.orm import deferred, relationship, backref, remote, foreign
 from sqlalchemy.event import listens_for
 from sqlalchemy.inspection import inspect
@@ -296,6 +296,9 @@ class SYMBOL(base.BASE, mixin.ExtraDataMixin, mixin.TimestampMixin, mixin.UserMi
     origin_table = Column(String, index=True)
     origin_id = Column(BigInteger, index=True)
 
+    # 用来检查同一层级内是否重名
+    __table_args__ = (Index('ix_symbol_origin_id_name', 'origin_id', 'name'),)
+
 
 class INFO(base.BASE, mixin.ExtraDataMixin, mixin.TimestampMixin, mixin.UserMixin):
     '''
@@ -522,3 +525,23 @@ class FILE(base.BASE, mixin.ExtraDataMixin, mixin.TimestampMixin, mixin.UserMixi
 
     # 用来表示版本分支的属性
     old_file_id = deferred(Column(BigInteger, index=True))
+
+
+# 硬盘路径 → FOLDER、FILE 的反向索引（参考 dayu_database.path_index）
+# 每个FOLDER、FILE 在每个storage 区域（publish、work、cache）、每个平台下各有一行
+# path 使用 "C" collation，保证可以按照字节顺序进行前缀范围查询（移动FOLDER 时改写整个子树）
+path_index_table = Table('path_index',
+                         base.BASE.metadata,
+                         Column('path', String(collation='C'), index=True),
+                         Column('area', String, primary_key=True),
+                         Column('platform', String, primary_key=True),
+                         Column('storage_name', String),
+                         Column('hook_table', String, primary_key=True),
+                         Column('hook_id', BigInteger, primary_key=True))
+
+# 每个parent 的版本计数器（参考 dayu_database.version_counter）
+version_counter_table = Table('version_counter',
+                              base.BASE.metadata,
+                              Column('parent_id', BigInteger, primary_key=True),
+                              Column('last_version', Integer),
+                              Column('width', Integer))
@@ -3,9 +3,7 @@
 
 __author__ = 'andyguo'
 
-import collections
 import re
-import sys
 
 from sqlalchemy import Column, BigInteger, Boolean, DateTime, String, Integer, func
 from sqlalchemy.dialects.postgresql import JSONB
@@ -182,8 +180,6 @@ class DiskPathMixin(object):
     _cache_work_disk_path = None
     _cache_cache_disk_path = None
 
-    _eval_regex = re.compile(r'<(\w+)>')
-
     @declared_attr
     def path_data(cls):
         return deferred(Column(JSONB, default=lambda: {}))
@@ -198,31 +194,11 @@ class DiskPathMixin(object):
         if getattr(self, '_cache_{}_disk_path'.format(disk_type), None) and refresh is False:
             return getattr(self, '_cache_{}_disk_path'.format(disk_type), None)
 
-        from dayu_path import DayuPath
-        import util
-
-        storage = util.get_storage_config(self.storage_config_name)
-        db_config = util.get_db_config(self.db_config_name)
-        parents = self.hierarchy
-        result = storage.config[disk_type][sys.platform]
-        for index, x in enumerate(parents[1:]):
-            depth_config = db_config.config[str(index + 1)]
-            param_list = []
-            for param in depth_config['to_disk_param'][x.meaning][disk_type]:
-                match = DiskPathMixin._eval_regex.match(param)
-                if match:
-                    func = getattr(util, match.groups()[0])
-                    if func:
-                        param_list.append(func())
-
-                else:
-                    param_list.append(getattr(x, param))
-
-            result += depth_config['to_disk'][x.meaning][disk_type].format(*param_list)
-
-        setattr(self, '_cache_{}_disk_path'.format(disk_type), DayuPath(result))
-        getattr(self, '_cache_{}_disk_path'.format(disk_type), None)._cache_orm = self
-        return getattr(self, '_cache_{}_disk_path'.format(disk_type), None)
+        # 路径模板会按照 (db_config, meaning 序列, disk_type) 预先编译，参考 path_template
+        import path_template
+        result = path_template.disk_paths([self], disk_type=disk_type)[0]
+        setattr(self, '_cache_{}_disk_path'.format(disk_type), result)
+        return result
 
 
 class SubLevelMixin(object):
@@ -271,53 +247,22 @@ class SubLevelMixin(object):
                 temp_flatten_dict.update({sub_level_key: {'file': s, 'orm': v, 'sub_level': sub_level_key}})
         return temp_flatten_dict.values()
 
-    def rescan(self, confirm=True, recursive=True):
+    def rescan(self, confirm=True, recursive=True, workers=None, full=False):
         '''
         自动扫描orm 所对应的硬盘路径下有什么文件，并将这些文件的路径信息保存到orm 中。
         之后可以从过sub_level() 进行访问。
+        没有变化的文件夹会直接使用上一次的扫描结果，多个FILE 可以使用 rescan.rescan_many 一起扫描。
         :param confirm: 是否需要真的更新orm？默认false，防止误操作
         :param recursive: 是否递归遍历？默认True
+        :param workers: int，同时扫描文件夹的线程数量，默认是 rescan.WORKERS
+        :param full: bool，如果为True，那么忽略上一次的扫描结果，全部重新扫描
         :return: True 表示更新orm 成功；否则False
         '''
-
-        def folder_to_structure(folders):
-            result = {}
-            for path in (x.replace('\\', '/').strip('/') for x in folders):
-                temp = result
-                for item in path.split('/'):
-                    temp = temp.setdefault(item, {})
-            return result
-
         if confirm is not True:
             return False
 
-        disk = self.disk_path(disk_type='publish')
-        if not disk.exists():
-            return False
-
-        black_list_begin = ('.', '..', 'Thumb')
-        black_list_end = ('.csv', '.db', '.tmp')
-
-        if recursive:
-            import os
-            file_list = []
-            for root, dirs, files in os.walk(disk):
-                dirs[:] = [x for x in dirs if (not x.startswith(black_list_begin)) and
-                           (not x.endswith(black_list_end))]
-                file_list.extend(('/'.join((root, x)).replace(disk, '') for x in files
-                                  if (not x.startswith(black_list_begin)) and
-                                  (not x.endswith(black_list_end))))
-
-        else:
-            import os
-            file_list = (x.replace(disk, '') for x in disk.listdir(filter=os.path.isfile)
-                         if (not x.name.startswithwhite_list_begin) and
-                         (not x.name.endswith(black_list_end)))
-
-        old_extra = dict(self.path_data)
-        old_extra.update({'vfx_full_path': folder_to_structure(file_list)})
-        self.path_data = old_extra
-        return True
+        import rescan
+        return rescan.rescan(self, workers=workers, recursive=recursive, full=full)
 
 
 class WorkflowMixin(object):
@@ -384,16 +329,11 @@ class DepthMixin(object):
     def walk(self):
         '''
         递归遍历整个树状结构。类似于文件系统中的递归扫描文件
+        如果数据库具备path_ids，那么整个子树只需要固定的几次查询。（参考 tree.walk_with_parent）
         :return: generator
         '''
-        queue = collections.deque()
-        queue.append(self)
-
-        while queue:
-            current = queue.popleft()
-            for x in current.children:
-                yield x
-                queue.append(x)
+        import tree
+        return tree.walk(self)
 
     def find_meaning(self, meaning):
         '''
@@ -424,13 +364,8 @@ class DepthMixin(object):
 
         :return: dict
         '''
-        from util import get_class
-        result = {}
-        for x in self.hierarchy:
-            cascading_info = x.infos.filter(get_class('info').name == 'cascading_info').first()
-            if cascading_info:
-                result.update(cascading_info.extra_data)
-        return result
+        import info_cascade
+        return info_cascade.resolve(self, 'cascading_info')['all_info']
 
     @deco.lazy
     def hierarchy(self):
@@ -440,16 +375,11 @@ class DepthMixin(object):
         :return: list of orm
         '''
 
-        # 经过测试，在层级深度 > 4 之后，deque 开始比list 有速度优势。
-        # 考虑到大部分使用场景都是SHOT、ASSET 之后的深度，所以还是选择了deque
-        result = collections.deque()
-        current_orm = self
-        while getattr(current_orm, 'parent', None):
-            current_orm = getattr(current_orm, 'parent', None)
-            result.appendleft(current_orm)
-
-        result.append(self)
-        return list(result)
+        # 原本沿着.parent 逐级lazy load，深度为N 的orm 需要N 次数据库查询。
+        # 现在交给tree.load_hierarchy()，使用一次WITH RECURSIVE 查询得到全部祖先，
+        # 并且顺便填充了祖先的.parent、.top、.hierarchy
+        import tree
+        return tree.load_hierarchy(self)
 
     # todo: 如果连续创建orm，并且不session.flush()，那么由于无法出发validate_path() 函数
     # 因此，导致depth、meaning 等无法被自动继承。（即使使用@validate(parent)，也不行，会报错）
@@ -471,27 +401,20 @@ class DepthMixin(object):
         if self.meaning is not None:
             return value
 
-        import dayu_database
-        import table
+        import util
 
         # 这个code block 完成了读取db_config，然后根据里面的配置，解析depth 应该对应什么meaning
-        session = dayu_database.get_session()
-        assert session is not None
-
-        config_orm = None
-        try:
-            config_orm = session.query(table.DB_CONFIG).filter(table.DB_CONFIG.name == self.db_config_name).one()
-        except Exception as e:
-            raise e
+        # db_config 来自进程内的缓存，db_pattern 也只会在第一次使用的时候编译
+        config_orm = util.get_db_config(self.db_config_name)
 
         mean = config_orm.config.get(str(value))
         if len(mean['content']) > 1:
-            branch_depth = mean['db_pattern']
+            branch_depth = config_orm.derived('db_pattern', _compile_db_pattern)[str(value)]
             parents = getattr(self, 'hierarchy', None)
             db_path_string = '/' + '/'.join(str(x.name) for x in parents[1:])
 
-            for _key, _value in branch_depth.items():
-                if re.match('^{0}$'.format(_key), db_path_string):
+            for _regex, _value in branch_depth:
+                if _regex.match(db_path_string):
                     self.meaning = _value
                     break
             else:
@@ -511,6 +434,16 @@ class DepthMixin(object):
         return value
 
 
+def _compile_db_pattern(config_entry):
+    '''
+    预先编译db_config 中每个深度的db_pattern。（配合 config_cache.ConfigEntry.derived 使用）
+    :param config_entry: config_cache.ConfigEntry
+    :return: dict，key 是depth string，value 是 [(编译后的正则, meaning), ...]
+    '''
+    return {depth: [(re.compile('^{0}$'.format(k)), v) for k, v in depth_config['db_pattern'].items()]
+            for depth, depth_config in config_entry.config.items() if depth_config.get('db_pattern')}
+
+
 class ClueMixin(object):
     '''
     提供metadata 信息和其他环节信息匹配的mixin。
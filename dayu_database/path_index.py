@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    硬盘路径 → FOLDER、FILE 的反向索引。
+
+    原本 DayuPath.orm() 需要先扫描所有的STORAGE 找到根路径，然后从project 开始逐层访问children，
+    用每个orm 的name 去正则匹配硬盘路径的每一级。渲染节点每写一帧都会调用一次，数据库压力非常大。
+
+    这里把每个FOLDER、FILE 在每个storage 区域（publish、work、cache）、每个平台下的完整硬盘路径，
+    保存在 path_index 这个table 中（table 的定义参考 init_db.table.path_index_table）。
+    查询的时候，把硬盘路径拆分成所有可能的前缀，一次 path IN (...) 的查询，然后取最长的前缀，就得到了对应的orm。
+
+    索引的维护：
+    * FOLDER、FILE insert 之后写入（table.py 中的after_insert 监听函数）
+    * FOLDER、FILE 改名、移动之后，改写自身以及整个子树的前缀（after_update 监听函数）
+    * tree.move_subtree 改变了子树的storage_config_name、db_config_name 时，通过 reindex() 重新生成整个子树
+    * 路径中含有 <current_user_name> 这类动态参数的模板，不会写入索引，查询时会退回到原本逐层匹配的方式
+    * 已经存在的数据，可以通过 init_db.migrate 中的 path_index 进行回填，或者直接调用 rebuild()
+
+    '''
+
+import collections
+
+
+def get_table():
+    '''
+    获得path_index 的Table 对象。如果数据库中还没有这个table（旧的数据库需要先执行 init_db.migrate），返回None
+    :return: sqlalchemy Table 或者None
+    '''
+    import base
+    return base.BASE.metadata.tables.get('path_index', None)
+
+
+def normalize(path):
+    '''
+    统一硬盘路径的写法：使用 / 作为分隔符，windows 的盘符统一为小写，去掉结尾的 /
+    :param path: string
+    :return: string
+    '''
+    component = str(path).replace('\\', '/').split('/')
+    if component and ':' in component[0]:
+        component[0] = component[0].lower()
+    return '/'.join(component).rstrip('/') or '/'
+
+
+def _candidates(path):
+    '''
+    生成硬盘路径所有可能的前缀。
+    和原本 DayuPath.orm() 一样，每一级都允许去掉扩展名之后再匹配（例如 v0001.abc 对应 v0001）
+    :param path: 已经normalize 的string
+    :return: dict，key 是前缀，value 是前缀的层级数量
+    '''
+    component = path.split('/')
+    result = {}
+    for index in range(1, len(component) + 1):
+        prefix = component[:index]
+        level = index * 2
+        result.setdefault('/'.join(prefix), level)
+        stem = prefix[-1].split('.')[0]
+        if stem and stem != prefix[-1]:
+            # 去掉扩展名的匹配，优先级低于完整的匹配
+            result.setdefault('/'.join(prefix[:-1] + [stem]), level - 1)
+    return result
+
+
+def _rows(orm):
+    '''
+    计算orm 需要写入索引的全部内容
+    :param orm: FOLDER、FILE orm
+    :return: list of dict
+    '''
+    import path_template
+    import util
+
+    storage = util.get_storage_config(orm.storage_config_name)
+    db_config = util.get_db_config(orm.db_config_name)
+    levels = orm.hierarchy[1:]
+    meanings = tuple(x.meaning for x in levels)
+
+    result = []
+    for area, roots in storage.config.items():
+        try:
+            template = path_template.get_template(db_config, meanings, area)
+        except KeyError:
+            continue
+        if template.dynamic:
+            continue
+
+        sub_path = template.render(levels)
+        for platform, root in roots.items():
+            if not root:
+                continue
+            result.append({'path'        : normalize(root + sub_path),
+                           'area'        : area,
+                           'platform'    : platform,
+                           'storage_name': storage.name,
+                           'hook_table'  : orm.__tablename__,
+                           'hook_id'     : orm.id})
+    return result
+
+
+def index(connection, orms):
+    '''
+    把orm 的硬盘路径写入索引。（在FOLDER、FILE 的after_insert 中调用）
+    :param connection: sqlalchemy connection
+    :param orms: list of FOLDER、FILE orm
+    :return: int，写入的行数
+    '''
+    path_index_table = get_table()
+    if path_index_table is None:
+        return 0
+
+    from config.const import DAYU_DB_ROOT_FOLDER_NAME
+
+    # root 没有对应的硬盘路径；meaning 为None 表示没有经过insert 的校验（例如标记为删除的orm）
+    rows = [x for orm in orms
+            if orm.name != DAYU_DB_ROOT_FOLDER_NAME and orm.meaning is not None
+            for x in _rows(orm)]
+    if rows:
+        connection.execute(path_index_table.insert(), rows)
+    return len(rows)
+
+
+def path_changed(orm):
+    '''
+    判断orm 的硬盘路径是否可能发生了变化（改名或者移动）
+    :param orm: FOLDER、FILE orm
+    :return: bool
+    '''
+    from sqlalchemy import inspect
+    import tree
+    state = inspect(orm)
+    return state.attrs.name.history.has_changes() or tree.parent_changed(orm)
+
+
+def move(connection, orm):
+    '''
+    orm 改名或者移动之后，更新索引。
+    自身的路径重新计算；如果是FOLDER，子树中所有以旧路径为前缀的路径，使用一条UPDATE 语句替换前缀。
+    :param connection: sqlalchemy connection
+    :param orm: FOLDER、FILE orm
+    :return: None
+    '''
+    from sqlalchemy import select, and_, func, literal
+    import table
+
+    path_index_table = get_table()
+    if path_index_table is None:
+        return
+
+    c = path_index_table.c
+    own = and_(c.hook_table == orm.__tablename__, c.hook_id == orm.id)
+    old_paths = {(x.area, x.platform): x.path
+                 for x in connection.execute(select([c.area, c.platform, c.path]).where(own))}
+
+    # 改名、移动之后，缓存的hierarchy、硬盘路径已经失效
+    orm.__dict__.pop('hierarchy', None)
+    for disk_type in ('publish', 'work', 'cache'):
+        setattr(orm, '_cache_{}_disk_path'.format(disk_type), None)
+
+    connection.execute(path_index_table.delete().where(own))
+    new_rows = _rows(orm) if orm.meaning is not None else []
+    if new_rows:
+        connection.execute(path_index_table.insert(), new_rows)
+
+    if not isinstance(orm, table.FOLDER):
+        return
+
+    new_paths = {(x['area'], x['platform']): x['path'] for x in new_rows}
+    for key, old_path in old_paths.items():
+        new_path = new_paths.get(key, None)
+        if new_path is None or new_path == old_path:
+            continue
+        # '0' 是 '/' 的下一个字符，[old/, old0) 正好是所有以 old/ 开头的路径，可以走path 的索引
+        connection.execute(path_index_table.update()
+                           .where(and_(c.area == key[0],
+                                       c.platform == key[1],
+                                       c.path >= old_path + '/',
+                                       c.path < old_path + '0'))
+                           .values(path=literal(new_path).concat(func.substr(c.path, len(old_path) + 1))))
+
+
+def reindex(connection, hooks, batch_size=1000):
+    '''
+    重新生成部分orm 的索引。
+    跨project、跨storage 移动之后，子树使用的storage 根路径、路径模板都可能不同，不能只替换前缀。
+    :param connection: sqlalchemy connection
+    :param hooks: dict，key 是table 名（folder、file），value 是id 的list
+    :param batch_size: int，每一批读取的orm 数量
+    :return: int，写入的行数
+    '''
+    from sqlalchemy import and_
+    from sqlalchemy.orm import Session
+    import tree
+    import util
+
+    path_index_table = get_table()
+    if path_index_table is None:
+        return 0
+
+    # 使用同一个connection 的session，可以读到当前事务中的修改，也不会把子树的orm 留在用户的session 中
+    session = Session(bind=connection)
+    c = path_index_table.c
+    total = 0
+    try:
+        for hook_table, hook_ids in hooks.items():
+            orm_class = util.get_class(hook_table)
+            hook_ids = sorted(hook_ids)
+            for start in range(0, len(hook_ids), batch_size):
+                batch = hook_ids[start:start + batch_size]
+                connection.execute(path_index_table.delete()
+                                   .where(and_(c.hook_table == hook_table, c.hook_id.in_(batch))))
+                orms = session.query(orm_class).filter(orm_class.id.in_(batch)).all()
+                tree.load_hierarchies(orms)
+                total += index(connection, orms)
+                session.expunge_all()
+    finally:
+        session.close()
+
+    return total
+
+
+def lookup(session, path, area='publish'):
+    '''
+    通过索引查找硬盘路径对应的orm（最长前缀匹配）
+    :param session: sqlalchemy session
+    :param path: string，硬盘路径
+    :param area: string，publish、work、cache 中的一个
+    :return: tuple，(匹配到的前缀, list of orm, 索引中的行)。如果没有匹配，返回 (None, [], None)
+    '''
+    from sqlalchemy import select
+    import util
+
+    path_index_table = get_table()
+    if path_index_table is None:
+        return None, [], None
+
+    candidates = _candidates(normalize(path))
+    c = path_index_table.c
+    rows = session.execute(select([path_index_table])
+                           .where(c.path.in_(list(candidates.keys())))
+                           .where(c.area == area)).fetchall()
+    if not rows:
+        return None, [], None
+
+    best = max(candidates[x.path] for x in rows)
+    rows = [x for x in rows if candidates[x.path] == best]
+
+    hooks = collections.OrderedDict()
+    for x in rows:
+        hooks.setdefault(x.hook_table, []).append(x.hook_id)
+
+    orms = []
+    for hook_table, hook_ids in hooks.items():
+        orm_class = util.get_class(hook_table)
+        orms.extend(session.query(orm_class).filter(orm_class.id.in_(set(hook_ids))).order_by(orm_class.name))
+
+    return rows[0].path, orms, rows[0]
+
+
+def rebuild(session, batch_size=1000):
+    '''
+    重新生成全部索引。
+    :param session: sqlalchemy session，会使用这个session 的connection 写入
+    :param batch_size: int，每一批读取的orm 数量
+    :return: int，写入的行数
+    '''
+    import table
+    import tree
+
+    path_index_table = get_table()
+    if path_index_table is None:
+        return 0
+
+    connection = session.connection()
+    connection.execute(path_index_table.delete())
+
+    total = 0
+    for orm_class in (table.FOLDER, table.FILE):
+        last_id = None
+        while True:
+            query = session.query(orm_class).filter(orm_class.depth > 0)
+            if last_id is not None:
+                query = query.filter(orm_class.id > last_id)
+            orms = query.order_by(orm_class.id).limit(batch_size).all()
+            if not orms:
+                break
+
+            tree.load_hierarchies(orms)
+            total += index(connection, orms)
+            last_id = orms[-1].id
+            session.expunge_all()
+
+    return total
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    预先编译的硬盘路径模板。
+
+    原本 DiskPathMixin.disk_path() 每一次调用，都需要针对每一个祖先orm：
+    读取 db_config.config[str(depth)]，逐个对to_disk_param 进行正则匹配，然后调用一次 str.format。
+
+    实际上，对于同一个db_config，只要从project 到自身的meaning 序列相同，得到路径的方式就完全相同。
+    所以这里把 (db_config, meaning 序列, disk_type) 编译成一个PathTemplate：
+    * 每一层的 to_disk 重新编号之后拼接成一个完整的format string，只需要调用一次 format
+    * 每一个参数都预先解析成取值函数（getattr 或者 util 中的函数）
+    编译的结果保存在 config_cache 的 ConfigEntry.derived 中，db_config 修改后会一起失效。
+
+    storage 的根路径和平台相关，在render 的时候再拼接。
+
+    '''
+
+import operator
+import re
+import string
+
+# to_disk_param 中的 <function_name> 表示调用 util 中的同名函数
+_eval_regex = re.compile(r'<(\w+)>')
+
+
+class PathTemplate(object):
+    '''
+    编译后的路径模板
+    '''
+
+    def __init__(self, format_string, getters, dynamic):
+        '''
+        :param format_string: 拼接、重新编号之后的完整format string
+        :param getters: list of (level, function)，level 是hierarchy[1:] 中的位置
+        :param dynamic: bool，如果参数中包含<function>（例如当前用户名），那么同一个orm 的路径也可能不同
+        '''
+        self.format_string = format_string
+        self.getters = getters
+        self.dynamic = dynamic
+
+    def __repr__(self):
+        return '<PathTemplate>({})'.format(self.format_string)
+
+    def render(self, levels):
+        '''
+        根据orm 的hierarchy 生成路径（不包括storage 的根路径）
+        :param levels: list of orm，也就是 hierarchy[1:]
+        :return: string
+        '''
+        return self.format_string.format(*[func(levels[level]) for level, func in self.getters])
+
+
+def _escape(text):
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+def _renumber(template, offset):
+    '''
+    将某一层的 to_disk 中的位置参数 {0}、{1}、{} 整体偏移offset。
+    :param template: string，例如 '/{0}/{1}'
+    :param offset: int，之前层级已经使用的参数个数
+    :return: string
+    '''
+    result = []
+    auto_index = 0
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(template):
+        result.append(_escape(literal))
+        if field_name is None:
+            continue
+
+        # field_name 可能是 ''、'0'，也可能是 '0.name'、'0[key]'
+        match = re.match(r'^(\d*)(.*)$', field_name)
+        index, rest = match.groups()
+        if index == '':
+            index = auto_index
+            auto_index += 1
+        result.append('{' + str(int(index) + offset) + rest +
+                      ('!' + conversion if conversion else '') +
+                      (':' + format_spec if format_spec else '') + '}')
+
+    return ''.join(result)
+
+
+def _make_getter(param):
+    '''
+    把 to_disk_param 中的一个参数解析成取值函数
+    :param param: string，orm 的属性名，或者 <util 中的函数名>
+    :return: tuple，(函数, 是否是动态参数)
+    '''
+    match = _eval_regex.match(param)
+    if match:
+        import util
+        func = getattr(util, match.groups()[0])
+        return (lambda orm: func()), True
+
+    return operator.attrgetter(param), False
+
+
+def compile_template(db_config, meanings, disk_type):
+    '''
+    编译路径模板
+    :param db_config: config_cache.ConfigEntry（或者DB_CONFIG orm）
+    :param meanings: tuple of string，hierarchy[1:] 对应的meaning
+    :param disk_type: string，publish、work、cache
+    :return: PathTemplate
+    '''
+    config = db_config.config
+    format_parts = []
+    getters = []
+    dynamic = False
+    for index, meaning in enumerate(meanings):
+        depth_config = config[str(index + 1)]
+        params = depth_config['to_disk_param'][meaning][disk_type] or []
+        format_parts.append(_renumber(depth_config['to_disk'][meaning][disk_type], len(getters)))
+        for param in params:
+            func, is_dynamic = _make_getter(param)
+            dynamic = dynamic or is_dynamic
+            getters.append((index, func))
+
+    return PathTemplate(''.join(format_parts), getters, dynamic)
+
+
+def get_template(db_config, meanings, disk_type):
+    '''
+    获得编译后的路径模板，同一个db_config 下相同的(meanings, disk_type) 只会编译一次
+    :param db_config: config_cache.ConfigEntry
+    :param meanings: tuple of string
+    :param disk_type: string
+    :return: PathTemplate
+    '''
+    meanings = tuple(meanings)
+    return db_config.derived(('disk_path', meanings, disk_type),
+                             lambda entry: compile_template(entry, meanings, disk_type))
+
+
+def disk_paths(orms, disk_type='publish', platform=None):
+    '''
+    批量计算多个FOLDER、FILE 的硬盘路径。
+    所有orm 的hierarchy 会通过 tree.load_hierarchies 一次性读取，配置来自缓存，模板只会编译一次。
+
+    :param orms: list of FOLDER、FILE orm
+    :param disk_type: string，通常可以选择 'publish', 'work', 'cache'
+    :param platform: string，默认是当前的 sys.platform
+    :return: list of DayuPath，顺序和orms 一致
+    '''
+    import sys
+    from dayu_path import DayuPath
+    import tree
+    import util
+
+    platform = platform or sys.platform
+    result = []
+    for orm, hierarchy in zip(orms, tree.load_hierarchies(orms)):
+        storage = util.get_storage_config(orm.storage_config_name)
+        db_config = util.get_db_config(orm.db_config_name)
+        levels = hierarchy[1:]
+        template = get_template(db_config, (x.meaning for x in levels), disk_type)
+        path = DayuPath(storage.config[disk_type][platform] + template.render(levels))
+        path._cache_orm = orm
+        result.append(path)
+
+    return result
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    数据库反射结果的本地快照。
+
+    DayuDatabase.session 第一次使用时，会调用 BASE.prepare(reflect=True) 反射数据库中所有的table，
+    每一个table 都需要查询多次系统表。每次打开Maya、Nuke、Houdini，每一个农场任务，在第一次查询之前都要付出这个时间。
+
+    快照模式下：
+    * 通过一条系统表的查询，得到当前schema 的指纹（所有的column、约束、索引的md5）
+    * 如果本地快照的指纹相同，直接使用pickle 保存的MetaData，不需要再反射
+    * 如果指纹不同（数据库结构发生了变化），或者快照无法读取，那么重新反射，并且更新快照
+
+    快照保存在 DAYU_DB_REFLECTION_CACHE 指定的文件夹中。没有设置时，不使用快照，和原本一样每次都进行反射。
+
+    快照中的MetaData 会按照 MetaData.reflect(extend_existing=True, autoload_replace=False) 的规则合并到 BASE.metadata：
+    table.py 中已经明确定义的column 保持不变，只补充数据库中其他的column 和外键。
+
+    '''
+
+import os
+
+# 当前schema 的指纹：column、约束、索引的定义排序之后的md5
+FINGERPRINT_SQL = '''
+    SELECT md5(coalesce(string_agg(item, E'\\n' ORDER BY item), '')) FROM (
+        SELECT 'c:' || c.relname || '.' || a.attname || ':' || format_type(a.atttypid, a.atttypmod) || ':' ||
+               a.attnotnull::text || ':' || coalesce(pg_get_expr(d.adbin, d.adrelid), '') AS item
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+        WHERE n.nspname = current_schema() AND c.relkind IN ('r', 'p') AND a.attnum > 0 AND NOT a.attisdropped
+        UNION ALL
+        SELECT 'k:' || c.relname || ':' || con.conname || ':' || pg_get_constraintdef(con.oid)
+        FROM pg_constraint con
+        JOIN pg_class c ON c.oid = con.conrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = current_schema()
+        UNION ALL
+        SELECT 'i:' || indexname || ':' || indexdef FROM pg_indexes WHERE schemaname = current_schema()
+    ) items
+'''
+
+
+def fingerprint(connection):
+    '''
+    获得当前数据库结构的指纹。只需要一次查询
+    :param connection: sqlalchemy connection 或者engine
+    :return: string
+    '''
+    from sqlalchemy import text
+    return connection.execute(text(FINGERPRINT_SQL)).scalar()
+
+
+def snapshot_path(cache_folder, url):
+    '''
+    快照文件的路径。不同的数据库、不同的sqlalchemy 版本使用不同的文件
+    :param cache_folder: string，DAYU_DB_REFLECTION_CACHE
+    :param url: sqlalchemy URL
+    :return: string
+    '''
+    import hashlib
+    import sqlalchemy
+
+    key = '{}@{}:{}/{}'.format(url.username, url.host, url.port, url.database)
+    return os.path.join(cache_folder, 'reflection_{}_{}.pickle'.format(hashlib.md5(key).hexdigest(),
+                                                                      sqlalchemy.__version__))
+
+
+def load(path, current_fingerprint):
+    '''
+    读取快照
+    :param path: string，快照文件
+    :param current_fingerprint: string，数据库当前的指纹
+    :return: MetaData。如果文件不存在、无法读取或者指纹不同，返回None
+    '''
+    import cPickle
+
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with open(path, 'rb') as pf:
+            data = cPickle.load(pf)
+    except Exception:
+        return None
+
+    if data.get('fingerprint', None) != current_fingerprint:
+        return None
+    return data.get('metadata', None)
+
+
+def save(path, current_fingerprint, metadata):
+    '''
+    写入快照。先写入临时文件再改名，多个进程同时写入也不会读到不完整的文件
+    :param path: string，快照文件
+    :param current_fingerprint: string，数据库当前的指纹
+    :param metadata: 反射得到的MetaData
+    :return: bool，是否写入成功
+    '''
+    import cPickle
+    import tempfile
+
+    folder = os.path.dirname(path)
+    try:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        handle, temp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as pf:
+            cPickle.dump({'fingerprint': current_fingerprint, 'metadata': metadata}, pf, cPickle.HIGHEST_PROTOCOL)
+        # mkstemp 创建的文件只有自己可以读取，快照需要让其他用户共用
+        os.chmod(temp_path, 0o644)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+        return True
+    except Exception:
+        return False
+
+
+def merge(snapshot, metadata):
+    '''
+    把快照中的table 合并到BASE.metadata。
+    和 MetaData.reflect(extend_existing=True, autoload_replace=False) 的规则一致：
+    * metadata 中没有的table，完整的复制
+    * metadata 中已经定义的table，已经定义的column 保持不变，只添加其他的column，以及不涉及已定义column 的外键
+
+    :param snapshot: 快照中的MetaData
+    :param metadata: BASE.metadata
+    :return: None
+    '''
+    for snapshot_table in snapshot.sorted_tables:
+        current_table = metadata.tables.get(snapshot_table.key, None)
+        if current_table is None:
+            snapshot_table.tometadata(metadata)
+            continue
+
+        declared = set(current_table.c.keys())
+        for column in snapshot_table.c:
+            if column.key not in declared:
+                current_table.append_column(column.copy())
+
+        for constraint in snapshot_table.foreign_key_constraints:
+            if declared.intersection(constraint.column_keys):
+                continue
+            current_table.append_constraint(constraint.copy(target_table=current_table))
+
+
+def reflect(engine, metadata, cache_folder=None):
+    '''
+    使用快照（如果可用）或者实际反射，让metadata 得到数据库中的全部table
+    :param engine: sqlalchemy engine
+    :param metadata: BASE.metadata
+    :param cache_folder: string，快照的文件夹。如果为None，那么直接反射
+    :return: bool，是否使用了快照
+    '''
+    if not cache_folder:
+        metadata.reflect(engine, extend_existing=True, autoload_replace=False)
+        return False
+
+    from sqlalchemy import MetaData
+
+    path = snapshot_path(cache_folder, engine.url)
+    with engine.connect() as connection:
+        current_fingerprint = fingerprint(connection)
+        snapshot = load(path, current_fingerprint)
+        used = snapshot is not None
+        if not used:
+            # 指纹不同或者没有快照，重新反射一个干净的MetaData 保存，然后合并
+            snapshot = MetaData()
+            snapshot.reflect(connection)
+            save(path, current_fingerprint, snapshot)
+
+    merge(snapshot, metadata)
+    return used
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    FILE 的SubLevel 扫描（rescan）。
+
+    原本 SubLevelMixin.rescan() 使用 os.walk 串行遍历publish 路径，每次都从头生成 path_data['vfx_full_path']。
+    4K EXR 这种一个文件夹里有10 万帧的序列，放在NFS 上，即使只改动了一帧，也要把所有文件夹重新列一遍。
+
+    这里：
+    * 使用 scandir 列出文件夹内容，不需要对每一个文件再执行一次stat 来判断是否是文件夹
+      （python2 需要安装 scandir 这个package，没有安装的时候退回到 os.listdir + os.path.isdir）
+    * 同一层级的所有子文件夹，交给线程池并行扫描。rescan_many 的多个FILE 共用同一个线程池
+    * 每个文件夹的mtime 保存在 path_data['vfx_scan_mtime']，扫描时间保存在 path_data['vfx_scan_time']，
+      是否递归扫描保存在 path_data['vfx_scan_recursive']。
+      文件夹的mtime 没有变化，说明里面的文件名没有变化，直接使用上一次的结果，不需要再列出内容
+      （子文件夹仍然会被检查，因为子文件夹里的变化不会改变上一层文件夹的mtime）
+    * 只有扫描结果真的发生变化时，才会修改orm 的path_data，没有变化的FILE 不会产生UPDATE
+
+    mtime 的精度有限（NFS 上通常是秒），上一次扫描时刚刚被修改过的文件夹（RACY_SECONDS 以内），下一次一定会重新列出。
+
+    '''
+
+import collections
+import os
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# 同时扫描文件夹的线程数量
+WORKERS = 8
+
+# 扫描时间之前这么多秒内被修改过的文件夹，mtime 不可信，下一次扫描必须重新列出
+RACY_SECONDS = 2.0
+
+# 忽略的文件、文件夹
+BLACK_LIST_BEGIN = ('.', '..', 'Thumb')
+BLACK_LIST_END = ('.csv', '.db', '.tmp')
+
+
+def _ignored(name):
+    return name.startswith(BLACK_LIST_BEGIN) or name.endswith(BLACK_LIST_END)
+
+
+def _join(*parts):
+    return '/'.join(x for x in parts if x)
+
+
+def _listdir(path):
+    '''
+    列出文件夹的内容
+    :param path: string，文件夹的绝对路径
+    :return: tuple，(文件名的list, 需要继续扫描的子文件夹名的list)
+    '''
+    files = []
+    dirs = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if _ignored(entry.name):
+                continue
+            if entry.is_dir():
+                # 和 os.walk 一样，链接到文件夹的symlink 不会被当做文件，也不会继续扫描
+                if not entry.is_symlink():
+                    dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            if _ignored(name):
+                continue
+            full_path = os.path.join(path, name)
+            if os.path.isdir(full_path):
+                if not os.path.islink(full_path):
+                    dirs.append(name)
+            else:
+                files.append(name)
+    return files, dirs
+
+
+class _Scan(object):
+    '''
+    一个FILE 的扫描状态
+    '''
+
+    def __init__(self, orm, root, path_data, recursive, full):
+        self.orm = orm
+        self.root = root
+        self.path_data = path_data
+        self.recursive = recursive
+        self.files = []
+        self.mtimes = {}
+
+        # 上一次扫描的结果。full=True 的时候不使用，全部重新列出。
+        # 上一次不是递归扫描的时候，没有记录子文件夹，递归扫描不能使用上一次的结果
+        reusable = not full and (path_data.get('vfx_scan_recursive', False) or not recursive)
+        self.old_mtimes = dict(path_data.get('vfx_scan_mtime', None) or {}) if reusable else {}
+        self.old_structure = path_data.get('vfx_full_path', None) or {}
+        self.trusted_before = (path_data.get('vfx_scan_time', None) or 0) - RACY_SECONDS
+        self.old_dirs = {}
+        for rel in self.old_mtimes:
+            if rel:
+                self.old_dirs.setdefault(rel.rpartition('/')[0], []).append(rel.rpartition('/')[2])
+
+    def _reuse(self, rel):
+        '''
+        文件夹没有变化时，从上一次的结果中得到文件名和子文件夹名
+        '''
+        node = self.old_structure
+        for part in rel.split('/') if rel else []:
+            node = node.get(part, None) or {}
+        dirs = self.old_dirs.get(rel, [])
+        files = [k for k in node if k not in dirs]
+        return files, list(dirs)
+
+    def visit(self, rel):
+        '''
+        扫描一个文件夹。在线程池中执行，不能访问数据库
+        :param rel: string，相对于root 的路径，root 本身是 ''
+        :return: tuple，(rel, mtime, 文件名的list, 子文件夹名的list)
+        '''
+        path = os.path.join(self.root, *rel.split('/')) if rel else self.root
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            # 扫描过程中被删除的文件夹
+            return rel, None, [], []
+        old_mtime = self.old_mtimes.get(rel, None)
+        if old_mtime is not None and old_mtime == mtime and mtime < self.trusted_before:
+            files, dirs = self._reuse(rel)
+        else:
+            files, dirs = _listdir(path)
+        return rel, mtime, files, dirs if self.recursive else []
+
+    def collect(self, rel, mtime, files, dirs):
+        if mtime is None:
+            return []
+        self.mtimes[rel] = mtime
+        self.files.extend(_join(rel, x) for x in files)
+        return [_join(rel, x) for x in dirs]
+
+    def result(self, scan_time):
+        '''
+        :return: dict，新的path_data。如果没有任何变化，返回None
+        '''
+        structure = {}
+        for path in self.files:
+            temp = structure
+            for item in path.split('/'):
+                temp = temp.setdefault(item, {})
+
+        # 上一次不可信的mtime，如果这次更新扫描时间之后就可信了，也需要写回，否则下一次还会重新列出
+        racy = any(self.trusted_before <= x < scan_time - RACY_SECONDS for x in self.mtimes.values())
+        if structure == self.old_structure and self.mtimes == self.path_data.get('vfx_scan_mtime', None) \
+                and self.recursive == self.path_data.get('vfx_scan_recursive', None) and not racy:
+            return None
+
+        path_data = dict(self.path_data)
+        path_data.update({'vfx_full_path'     : structure,
+                          'vfx_scan_mtime'    : self.mtimes,
+                          'vfx_scan_time'     : scan_time,
+                          'vfx_scan_recursive': self.recursive})
+        return path_data
+
+
+def _visit(args):
+    scan, rel = args
+    return scan.visit(rel)
+
+
+def _path_data(orms):
+    '''
+    一次查询得到所有orm 的path_data（path_data 是deferred column，逐个访问会产生N 次查询）
+    '''
+    from sqlalchemy import inspect
+
+    result = {}
+    missing = collections.defaultdict(list)
+    for orm in orms:
+        state = inspect(orm)
+        if 'path_data' in state.dict or state.session is None or state.key is None:
+            result[orm] = orm.path_data or {}
+        else:
+            missing[(state.session, type(orm))].append(orm)
+
+    for (session, orm_class), orm_list in missing.items():
+        rows = dict(session.query(orm_class.id, orm_class.path_data)
+                    .filter(orm_class.id.in_([x.id for x in orm_list])))
+        for orm in orm_list:
+            result[orm] = rows.get(orm.id, None) or {}
+    return result
+
+
+def rescan_many(files, workers=None, recursive=True, full=False):
+    '''
+    批量扫描FILE 在publish 路径下的文件，并且把结果保存到orm 的path_data 中（需要用户自己commit）。
+    所有FILE 的文件夹共用同一个线程池，同一层级的文件夹会被并行扫描。
+
+    :param files: list of FILE orm（例如一个shot 下的全部VERSION）
+    :param workers: int，线程的数量，默认是 WORKERS
+    :param recursive: bool，是否扫描子文件夹
+    :param full: bool，如果为True，那么忽略上一次扫描的mtime，全部重新列出
+    :return: dict，key 是扫描过的orm（publish 路径不存在的orm 不会包括在内），value 是path_data 是否发生了变化
+    '''
+    import time
+    from multiprocessing.pool import ThreadPool
+    import path_template
+
+    files = list(files)
+    if not files:
+        return {}
+
+    # 硬盘路径、path_data 都在主线程中批量读取，线程池里只访问硬盘
+    roots = path_template.disk_paths(files, disk_type='publish')
+    all_path_data = _path_data(files)
+    scans = [_Scan(orm, root, all_path_data[orm], recursive, full)
+             for orm, root in zip(files, roots) if root is not None and os.path.isdir(root)]
+
+    scan_time = time.time()
+    frontier = [(x, '') for x in scans]
+    pool = ThreadPool(workers or WORKERS)
+    try:
+        while frontier:
+            results = pool.map(_visit, frontier)
+            frontier = [(scan, rel) for (scan, _), result in zip(frontier, results)
+                        for rel in scan.collect(*result)]
+    finally:
+        pool.close()
+        pool.join()
+
+    changed = {}
+    for scan in scans:
+        path_data = scan.result(scan_time)
+        changed[scan.orm] = path_data is not None
+        if path_data is not None:
+            scan.orm.path_data = path_data
+    return changed
+
+
+def rescan(orm, workers=None, recursive=True, full=False):
+    '''
+    扫描一个FILE。参考 rescan_many
+    :param orm: FILE orm
+    :return: bool，是否扫描成功（publish 路径不存在的时候返回False）
+    '''
+    return orm in rescan_many([orm], workers=workers, recursive=recursive, full=full)
@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    SEARCH 的查询计划缓存。
+
+    原本每一次访问 SEARCH.items，都会根据 extra_data['filters'] 重新生成sql：
+    每一个col 的层级都要 inspect(...).attrs，每一个op 都要用 hasattr 试探三种写法，token 也要重新解析。
+    保存的SEARCH 会驱动几秒刷新一次的dashboard，这些重复的工作都浪费在Python 里。
+
+    这里把filters 编译成一个 SearchPlan，并且按照 (target_table, filters) 的json hash 缓存：
+    * column、relationship、op 的解析只在编译的时候进行一次
+    * 用户输入的值全部变成bind parameter。today、current_user 这样的token 在每次执行时重新计算，
+      其他固定的值在编译时就转换好
+    * 使用sqlalchemy 的baked query，sql 只会编译一次，之后每次执行只需要重新绑定参数，
+      数据库每次收到的都是完全相同的sql 文本
+
+    执行的时候还支持：
+    * count()：只查询数量
+    * order_by：任意column 排序，最后总是按照id 排序保证顺序唯一
+    * page_after + limit：keyset 分页。不使用offset，翻到第几页都只需要读取一页的数据
+    * yield_per：服务器端cursor，遍历几十万个VERSION 时内存占用也是固定的
+    * rows()：投影查询，只读取需要的column 和JSONB 中的内容，返回namedtuple 而不是orm
+
+    top.name、created_by.name 这种多对一的relationship，默认使用LEFT JOIN（相同的relationship 只JOIN 一次），
+    而不是每一行都执行一次的EXISTS 子查询。只有一对多的relationship（例如 sub_files.name）才使用EXISTS。
+    SEARCH.extra_data['relationship_filter'] 设置为 'exists' 时，和原本一样全部使用EXISTS。
+    两种方式的执行计划可以使用 benchmark/search_explain.py 对比。
+
+    filters 的格式和规则参考 SEARCH.items。
+
+    '''
+
+import collections
+import hashlib
+import json
+import threading
+
+# 最多缓存的计划数量
+MAX_PLANS = 256
+
+_plans = collections.OrderedDict()
+_lock = threading.Lock()
+_bakery = None
+
+
+def get_bakery():
+    '''
+    baked query 的缓存。所有的SearchPlan 共用
+    '''
+    global _bakery
+    if _bakery is None:
+        from sqlalchemy.ext import baked
+        _bakery = baked.bakery(size=MAX_PLANS * 4)
+    return _bakery
+
+
+def plan_key(target_table, filters, join=True):
+    '''
+    计算查询计划的key
+    :param target_table: string，table 名
+    :param filters: dict，SEARCH.extra_data['filters']
+    :param join: bool，参考 compile_plan
+    :return: string
+    '''
+    return hashlib.md5(json.dumps([target_table, filters, bool(join)], sort_keys=True)).hexdigest()
+
+
+class SearchPlan(object):
+    '''
+    编译好的SEARCH 查询。
+    '''
+
+    def __init__(self, key, model_class, criterion, params, joins=None):
+        '''
+        :param key: string，plan_key() 的结果
+        :param model_class: orm class
+        :param criterion: sqlalchemy 表达式，其中的值都是bind parameter
+        :param params: dict，key 是bind parameter 的名字，value 是固定的值，或者每次执行时调用的函数
+        :param joins: list of tuple，(aliased class, relationship 属性)，查询时需要LEFT JOIN 的多对一relationship
+        '''
+        self.key = key
+        self.model_class = model_class
+        self.criterion = criterion
+        self._params = params
+        self.joins = joins or []
+        self._projections = {}
+
+    def __repr__(self):
+        return '<SearchPlan>({}, {})'.format(self.model_class.__name__, self.key)
+
+    def params(self):
+        '''
+        获得本次执行需要绑定的参数。token 会在这里重新计算
+        :return: dict
+        '''
+        return {k: v() if callable(v) else v for k, v in self._params.items()}
+
+    def projection(self, columns):
+        '''
+        解析投影查询的column。相同的columns 只会解析一次
+        :param columns: list of string，参考 filter_parse.resolve_projection
+        :return: tuple，(sqlalchemy 表达式的list, record class)
+        '''
+        import filter_parse
+
+        key = tuple(columns)
+        projection = self._projections.get(key, None)
+        if projection is None:
+            resolved = filter_parse.resolve_projection(self.model_class, columns)
+            projection = ([x for _, x in resolved], filter_parse.get_row_type(x for x, _ in resolved))
+            self._projections[key] = projection
+        return projection
+
+    def _filter(self, query):
+        '''
+        在query 上加入JOIN 和过滤条件
+        '''
+        if self.joins:
+            query = query.select_from(self.model_class)
+            for alias, relationship_attr in self.joins:
+                query = query.outerjoin(alias, relationship_attr)
+        return query.filter(self.criterion).filter(self.model_class.active == True)
+
+    def _order_columns(self, order_by):
+        '''
+        解析排序。最后总是会加上id，保证排序的结果唯一，才能够进行keyset 分页
+        :param order_by: list of string，column 的名字，前面加上 - 表示倒序。例如 ['-created_time', 'name']
+        :return: list of tuple，(column 名, 是否倒序)
+        '''
+        from sqlalchemy import inspect
+        from sqlalchemy.orm import ColumnProperty
+
+        result = []
+        for name in order_by or []:
+            desc = name.startswith('-')
+            name = name.lstrip('-+')
+            if inspect(self.model_class).attrs.get(name, None).__class__ != ColumnProperty:
+                raise Exception('no such a name in ORM')
+            if name != 'id':
+                result.append((name, desc))
+
+        # id 使用第一个排序的方向，没有指定排序时按照id 正序
+        result.append(('id', result[0][1] if result else False))
+        return result
+
+    def _keyset(self, order_columns):
+        '''
+        生成 "排在page_after 之后" 的条件。page_after 对应的排序值通过子查询获得，
+        例如按照 (created_time desc, id desc) 排序时：
+        created_time < :anchor.created_time OR (created_time = :anchor.created_time AND id < :page_after)
+
+        可以为NULL 的column（例如只有update 之后才有值的updated_time），排序时NULL 被当做最大的值
+        （正序 NULLS LAST，倒序 NULLS FIRST，参考 _order_clauses），这里的比较也按照同样的规则处理NULL：
+        相等使用 IS NOT DISTINCT FROM，大于、小于额外处理anchor 或者column 为NULL 的情况
+        '''
+        from sqlalchemy import and_, or_, select, bindparam, inspect
+
+        mapper = inspect(self.model_class)
+        anchor = self.model_class.__table__.alias('page_anchor')
+        page_after = bindparam('page_after')
+
+        def anchor_value(name):
+            if name == 'id':
+                return page_after
+            return select([anchor.c[mapper.attrs[name].columns[0].key]]).where(anchor.c.id == page_after).as_scalar()
+
+        def nullable(name):
+            return mapper.attrs[name].columns[0].nullable
+
+        def equals(name):
+            column = getattr(self.model_class, name)
+            if nullable(name):
+                return column.isnot_distinct_from(anchor_value(name))
+            return column == anchor_value(name)
+
+        def after(name, desc):
+            column = getattr(self.model_class, name)
+            value = anchor_value(name)
+            if not nullable(name):
+                return column < value if desc else column > value
+            if desc:
+                # 倒序：NULL 排在最前面。anchor 为NULL 时，所有不为NULL 的都在它之后
+                return or_(column < value, and_(value.is_(None), column.isnot(None)))
+            # 正序：NULL 排在最后面。anchor 为NULL 时，之后没有任何内容
+            return and_(value.isnot(None), or_(column > value, column.is_(None)))
+
+        conditions = []
+        for index, (name, desc) in enumerate(order_columns):
+            conditions.append(and_(*([equals(x) for x, _ in order_columns[:index]] + [after(name, desc)])))
+        return or_(*conditions)
+
+    def _order_clauses(self, order_columns):
+        '''
+        生成order by。明确指定NULL 的位置（和postgres 的默认行为一致），保证和 _keyset 的比较规则相同
+        '''
+        return [getattr(self.model_class, x).desc().nullsfirst() if desc
+                else getattr(self.model_class, x).asc().nullslast()
+                for x, desc in order_columns]
+
+    def baked_query(self, order_by=None, page_after=False, limit=None, columns=None):
+        '''
+        获得baked query。相同的计划（以及相同的排序、分页方式、投影）只会编译一次sql
+        :param order_by: list of string，参考 _order_columns
+        :param page_after: bool，是否进行keyset 分页。实际的id 通过参数 page_after 绑定
+        :param limit: int
+        :param columns: list of string，投影查询读取的column，参考 filter_parse.resolve_projection。None 表示读取orm
+        :return: sqlalchemy BakedQuery
+        '''
+        model_class = self.model_class
+
+        if columns:
+            projection, _ = self.projection(columns)
+            baked_query = get_bakery()(lambda s: s.query(*projection), self.key, tuple(columns))
+        else:
+            baked_query = get_bakery()(lambda s: s.query(model_class), self.key)
+        baked_query += (self._filter, self.key)
+
+        if order_by is None and not page_after and limit is None:
+            return baked_query
+
+        order_columns = self._order_columns(order_by)
+        order_key = tuple(order_columns)
+        if page_after:
+            baked_query += (lambda q: q.filter(self._keyset(order_columns)), self.key, order_key)
+        baked_query += (lambda q: q.order_by(*self._order_clauses(order_columns)), self.key, order_key)
+        if limit is not None:
+            baked_query += (lambda q: q.limit(limit), self.key, limit)
+        return baked_query
+
+    def _result(self, session, order_by=None, page_after=None, limit=None, yield_per=None, columns=None):
+        params = self.params()
+        if page_after is not None:
+            params['page_after'] = page_after
+
+        result = self.baked_query(order_by=order_by, page_after=page_after is not None, limit=limit,
+                                  columns=columns)(session)
+        result = result.params(params)
+        if yield_per:
+            # baked query 读取结果时不会使用 yield_per，流式读取时直接使用Query，大量数据的时候编译的时间可以忽略
+            return result._as_query().yield_per(yield_per)
+        return result
+
+    def execute(self, session, order_by=None, page_after=None, limit=None, yield_per=None):
+        '''
+        执行查询
+        :param session: sqlalchemy session
+        :param order_by: list of string，column 的名字，前面加上 - 表示倒序。例如 ['-created_time']
+        :param page_after: 上一页最后一个orm 的id。只返回排序在它之后的结果（keyset 分页）
+        :param limit: int，最多返回的数量
+        :param yield_per: int，使用服务器端的cursor，每次读取这么多行。用于遍历非常大的结果，内存占用是固定的
+        :return: generator of orm
+        '''
+        return (x for x in self._result(session, order_by=order_by, page_after=page_after, limit=limit,
+                                        yield_per=yield_per))
+
+    def rows(self, session, columns, order_by=None, page_after=None, limit=None, yield_per=None):
+        '''
+        投影查询：只读取需要的column（以及JSONB 中的内容），不生成orm。
+        其他参数和 execute() 相同。如果需要keyset 分页，columns 中需要包含id
+        :param session: sqlalchemy session
+        :param columns: list of string，例如 ['id', 'name', 'meaning', 'extra_data.fps']
+        :return: generator of namedtuple，属性名是 filter_parse.resolve_projection 的label，例如 row.extra_data__fps
+        '''
+        _, row_type = self.projection(columns)
+        return (row_type(*x) for x in self._result(session, order_by=order_by, page_after=page_after, limit=limit,
+                                                   yield_per=yield_per, columns=columns))
+
+    def count(self, session):
+        '''
+        只查询结果的数量，不会读取任何orm
+        :param session: sqlalchemy session
+        :return: int
+        '''
+        from sqlalchemy import func
+
+        model_class = self.model_class
+
+        baked_query = get_bakery()(lambda s: s.query(func.count(model_class.id)), self.key, 'count')
+        baked_query += (self._filter, self.key, 'count')
+        return baked_query(session).params(self.params()).scalar()
+
+
+def _operator_name(attr, op):
+    '''
+    得到sqlalchemy 属性上op 对应的函数名。例如 in -> in_，eq -> __eq__
+    '''
+    name = next((x.format(op) for x in ['{}', '{}_', '__{}__'] if hasattr(attr, x.format(op))), None)
+    if name is None:
+        raise Exception('not a legal op')
+    return name
+
+
+def _build_filter(model_class, col_name_list, joins=None):
+    '''
+    根据一条filter 条件的col，得到查询的函数列表。
+    :param model_class: ORM class
+    :param col_name_list: list of string
+    :param joins: OrderedDict，如果为None，所有的relationship 都使用 has()、any()（也就是EXISTS 子查询）。
+                  否则开头连续的多对一relationship 会使用LEFT JOIN，相同的relationship 路径只会JOIN 一次，
+                  key 是relationship 的路径，value 是 (aliased class, relationship 属性)
+    :return: tuple，(list，是否使用了JOIN，JSONB column 中的路径 tuple 或者None)
+    '''
+    from sqlalchemy import inspect
+    from sqlalchemy.dialects.postgresql import JSONB
+    from sqlalchemy.orm import ColumnProperty, RelationshipProperty, aliased
+
+    current_table = model_class
+    relationship_filters = []
+    path = ()
+
+    for index, col_name in enumerate(col_name_list):
+        sql_attr = inspect(current_table).mapper.attrs.get(col_name, None)
+        col_attr = getattr(current_table, col_name, None)
+
+        if sql_attr.__class__ == ColumnProperty:
+            relationship_filters.append(col_attr)
+            json_path = tuple(col_name_list[index + 1:])
+            if json_path:
+                # column 之后的部分是JSONB 中的路径，例如 extra_data.cache.path
+                if not isinstance(sql_attr.columns[0].type, JSONB):
+                    raise Exception('only JSONB column can use path: {}'.format('.'.join(col_name_list)))
+                return relationship_filters, bool(path), json_path
+        elif sql_attr.__class__ == RelationshipProperty:
+            # 多对一的relationship 最多只会对应一行，可以直接JOIN 而不会让结果重复。
+            # 一旦经过了一对多的relationship，之后都在EXISTS 子查询中
+            if joins is not None and not sql_attr.uselist and not relationship_filters:
+                path += (col_name,)
+                if path not in joins:
+                    joins[path] = (aliased(sql_attr.mapper.class_), col_attr)
+                current_table = joins[path][0]
+                continue
+
+            if sql_attr.uselist:
+                col_attr = getattr(col_attr, 'any', None)
+            else:
+                col_attr = getattr(col_attr, 'has', None)
+            current_table = sql_attr.mapper.class_
+            relationship_filters.append(col_attr)
+        else:
+            raise Exception('no such a name in ORM')
+
+    return relationship_filters, bool(path), None
+
+
+def _nest(json_path, value):
+    '''
+    把JSONB 路径和值组合成嵌套的dict。例如 ('cache', 'path'), 'a' -> {'cache': {'path': 'a'}}
+    '''
+    for key in reversed(json_path):
+        value = {key: value}
+    return value
+
+
+def compile_plan(target_table, filters, join=True):
+    '''
+    把SEARCH 的filters 编译成SearchPlan
+    :param target_table: string，table 名
+    :param filters: dict，SEARCH.extra_data['filters']
+    :param join: bool，多对一的relationship（例如 top.name、created_by.name）是否使用LEFT JOIN。
+                 False 时和原本一样全部使用EXISTS 子查询
+    :return: SearchPlan
+    '''
+    from sqlalchemy import bindparam, true, Text
+    from sqlalchemy.dialects.postgresql import ARRAY
+    import filter_parse
+    import util
+
+    model_class = util.get_class(target_table)
+    params = {}
+    joins = collections.OrderedDict() if join else None
+
+    def value_of(raw_value, data_type):
+        '''
+        固定的值直接转换，token 返回一个函数，在每次执行时转换
+        '''
+        if data_type == 'JSONB' and isinstance(raw_value, (dict, list)):
+            # JSONB 的值本身就可以是object、array，不是token
+            return raw_value
+        if isinstance(raw_value, dict):
+            return lambda: filter_parse.resolve_type(data_type, filter_parse.resolve_expression(raw_value))
+        return filter_parse.resolve_type(data_type, filter_parse.resolve_expression(raw_value))
+
+    def traverse_filter(raw_filter, negated=False):
+        for key, value in raw_filter.items():
+            logic = filter_parse.LOGIC_SWITCH[key]
+            param = []
+            for sub in value:
+                if sub.get('col', None) is None:
+                    param.append(traverse_filter(sub, negated=negated or key == 'not'))
+                    continue
+
+                if not sub.get('do'):
+                    continue
+
+                op = sub.get('op')
+                data_type = sub.get('type')
+                exp_value = value_of(sub.get('value'), data_type)
+                attr_list, joined, json_path = _build_filter(model_class, sub.get('col').split('.'), joins)
+
+                if 'not' in op:
+                    op = op.replace('not', '').strip('_')
+
+                name = 'p{}'.format(len(params))
+                if json_path and op == 'eq' and not callable(exp_value) and exp_value not in ('null', None) \
+                        and not isinstance(exp_value, (dict, list)):
+                    # JSONB 中的某个值相等，改写成 @> 包含，这样可以使用GIN 索引。
+                    # 例如 extra_data.fps = 24 -> extra_data @> '{"fps": 24}'
+                    params[name] = _nest(json_path, exp_value)
+                    attr_list[-1] = attr_list[-1].contains(bindparam(name))
+                else:
+                    if json_path:
+                        # -> 得到的仍然是JSONB，和值按照JSONB 的规则比较。like、in 需要 ->> 得到的文本
+                        element = attr_list[-1][json_path[0] if len(json_path) == 1 else json_path]
+                        attr_list[-1] = element.astext if op in ('like', 'in') else element
+
+                    if op == 'in':
+                        if callable(exp_value):
+                            params[name] = lambda f=exp_value: f().split(',')
+                        elif isinstance(exp_value, list):
+                            params[name] = [x if isinstance(x, basestring) else json.dumps(x) for x in exp_value]
+                        elif isinstance(exp_value, basestring):
+                            params[name] = exp_value.split(',')
+                        else:
+                            # JSONB 的单个值（例如 "24"、"true"、"null"）已经被解析成了数字、bool、None
+                            params[name] = [json.dumps(exp_value)]
+                        attr_list[-1] = attr_list[-1].in_(bindparam(name, expanding=True))
+                    elif op == 'has_key':
+                        # ? 的参数是文本，而不是JSONB
+                        params[name] = exp_value if isinstance(exp_value, basestring) else json.dumps(exp_value)
+                        attr_list[-1] = attr_list[-1].has_key(bindparam(name, type_=Text()))
+                    elif op in ('has_any', 'has_all'):
+                        # ?|、?& 的参数是text[]。值可以是json 的list，也可以是 , 分隔的字符串
+                        if isinstance(exp_value, basestring):
+                            params[name] = exp_value.split(',')
+                        elif isinstance(exp_value, list):
+                            params[name] = [x if isinstance(x, basestring) else json.dumps(x) for x in exp_value]
+                        else:
+                            params[name] = [json.dumps(exp_value)]
+                        attr_list[-1] = getattr(attr_list[-1], op)(bindparam(name, type_=ARRAY(Text)))
+                    else:
+                        attr = _operator_name(attr_list[-1], op)
+                        if exp_value in ('null', None):
+                            # NULL 不能作为bind parameter 比较，直接编译到sql 中（JSONB 的 null 解析之后是None）
+                            attr_list[-1] = getattr(attr_list[-1], attr)(None)
+                        else:
+                            params[name] = exp_value
+                            attr_list[-1] = getattr(attr_list[-1], attr)(bindparam(name))
+
+                single_sql = attr_list.pop()
+                while attr_list:
+                    single_sql = attr_list.pop()(single_sql)
+
+                # JOIN 不到的时候条件是NULL，取反之后仍然是NULL。
+                # 有取反的时候使用 IS TRUE，和 NOT EXISTS 一样把"没有对应的行"当作false
+                if joined and (negated or key == 'not' or 'not' in sub.get('op')):
+                    single_sql = single_sql.is_(true())
+
+                if 'not' in sub.get('op'):
+                    single_sql = filter_parse.LOGIC_SWITCH['not'](single_sql)
+
+                param.append(single_sql)
+
+            return logic(*param)
+
+    criterion = traverse_filter(filters)
+    return SearchPlan(plan_key(target_table, filters, join), model_class, criterion, params,
+                      joins.values() if joins else None)
+
+
+def get_plan(target_table, filters, join=True):
+    '''
+    获得缓存的SearchPlan。没有缓存时编译并加入缓存
+    :param target_table: string，table 名
+    :param filters: dict，SEARCH.extra_data['filters']
+    :param join: bool，参考 compile_plan
+    :return: SearchPlan
+    '''
+    key = plan_key(target_table, filters, join)
+    with _lock:
+        plan = _plans.pop(key, None)
+        if plan is not None:
+            _plans[key] = plan
+            return plan
+
+    plan = compile_plan(target_table, filters, join)
+    with _lock:
+        _plans[key] = plan
+        while len(_plans) > MAX_PLANS:
+            _plans.popitem(last=False)
+    return plan
+
+
+def clear():
+    '''
+    清空所有缓存的计划
+    '''
+    with _lock:
+        _plans.clear()
+    if _bakery is not None:
+        _bakery.cache.clear()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    STORAGE 根路径的前缀树。
+
+    原本 DayuPath 的 get_configs()、platform() 每一次调用都会 session.query(STORAGE)，
+    然后逐个比较每一个storage、每一个区域、每一个平台的根路径。
+    渲染农场上批量转换帧序列路径的时候，每一帧都会重复相同的查询和比较。
+
+    这里把所有STORAGE 在所有区域（publish、work、cache）、所有平台下的根路径，按照路径的每一级组成前缀树。
+    一次加载之后，判断路径属于哪个storage、哪个区域，以及跨平台的转换，都只是进程内的字典查找。
+
+    前缀树的失效方式和 config_cache 相同：
+    * 当前进程中修改、删除STORAGE 时，通过 config_cache.invalidate() 一起失效
+    * 每隔 DAYU_DB_CONFIG_CACHE_TTL 秒，检查一次STORAGE 的数量和最新的updated_time，发现变化就重新加载
+
+    '''
+
+import threading
+import time
+
+# 多个区域使用相同根路径的时候，按照这个顺序优先
+AREA_ORDER = ('publish', 'work', 'cache')
+
+_cache = {}
+_lock = threading.RLock()
+
+
+class StorageRoot(object):
+    '''
+    前缀树中的一个根路径
+    '''
+
+    def __init__(self, storage_name, area, platform, roots):
+        '''
+        :param storage_name: string，STORAGE 的名字
+        :param area: string，publish、work、cache 等区域
+        :param platform: string，这个根路径对应的平台
+        :param roots: dict，这个storage 在这个区域下所有平台的根路径
+        '''
+        self.storage_name = storage_name
+        self.area = area
+        self.platform = platform
+        self.roots = roots
+
+    def __repr__(self):
+        return '<StorageRoot>({}, {}, {})'.format(self.storage_name, self.area, self.platform)
+
+
+class StorageTrie(object):
+    '''
+    根路径的前缀树。每一个节点是 {'children': dict, 'roots': list of StorageRoot}
+    '''
+
+    def __init__(self, signature=None):
+        self.signature = signature
+        self.checked_time = time.time()
+        self.root = self._node()
+
+    @staticmethod
+    def _node():
+        return {'children': {}, 'roots': []}
+
+    def add(self, path, storage_root):
+        '''
+        添加一个根路径
+        :param path: string，根路径
+        :param storage_root: StorageRoot
+        :return: None
+        '''
+        node = self.root
+        for x in split(path):
+            node = node['children'].setdefault(x, self._node())
+        node['roots'].append(storage_root)
+
+    def match(self, component, area=None):
+        '''
+        最长前缀匹配。
+        :param component: list of string，已经split 的路径
+        :param area: string，如果不为None，那么只匹配这个区域的根路径
+        :return: tuple，(根路径的层级数量, list of StorageRoot)。如果没有匹配，返回 (None, [])
+        '''
+        node = self.root
+        length = None
+        matched = []
+        for index, x in enumerate(component):
+            node = node['children'].get(x, None)
+            if node is None:
+                break
+            roots = [r for r in node['roots'] if area is None or r.area == area]
+            if roots:
+                length = index + 1
+                matched = roots
+
+        return length, matched
+
+
+def split(path):
+    '''
+    把路径拆分成每一级。统一使用 / 作为分隔符，windows 的盘符统一为小写，忽略结尾的 /
+    :param path: string
+    :return: list of string
+    '''
+    component = str(path).replace('\\', '/').rstrip('/').split('/')
+    if component and ':' in component[0]:
+        component[0] = component[0].lower()
+    return component
+
+
+def _area_key(storage_root):
+    if storage_root.area in AREA_ORDER:
+        return AREA_ORDER.index(storage_root.area)
+    return len(AREA_ORDER)
+
+
+def _signature(session):
+    '''
+    STORAGE 的数量以及最新的updated_time，用来判断前缀树是否需要重新加载
+    '''
+    from sqlalchemy import select, func
+    import table
+
+    storage_table = table.STORAGE.__table__
+    return tuple(session.execute(select([func.count(storage_table.c.id),
+                                         func.max(storage_table.c.updated_time)])).first())
+
+
+def _load(session):
+    '''
+    读取所有的STORAGE，生成前缀树
+    '''
+    from sqlalchemy import select
+    import table
+
+    storage_table = table.STORAGE.__table__
+    signature = _signature(session)
+    trie = StorageTrie(signature)
+    rows = session.execute(select([storage_table.c.name, storage_table.c.extra_data])
+                           .order_by(storage_table.c.id))
+    for row in rows:
+        for area, roots in (row.extra_data or {}).items():
+            if not isinstance(roots, dict):
+                continue
+            for platform, path in roots.items():
+                if path:
+                    trie.add(path, StorageRoot(row.name, area, platform, roots))
+
+    for node in _nodes(trie.root):
+        node['roots'].sort(key=_area_key)
+    return trie
+
+
+def _nodes(node):
+    yield node
+    for x in node['children'].values():
+        for sub_node in _nodes(x):
+            yield sub_node
+
+
+def get_trie(session=None):
+    '''
+    获得当前数据库的前缀树
+    :param session: sqlalchemy session，如果为None，那么使用 dayu_database.get_session()
+    :return: StorageTrie
+    '''
+    if session is None:
+        import dayu_database
+        session = dayu_database.get_session()
+
+    import config_cache
+    key = str(session.bind.url)
+    trie = _cache.get(key, None)
+    if trie is not None:
+        now = time.time()
+        if now - trie.checked_time < config_cache._ttl():
+            return trie
+        if _signature(session) == trie.signature:
+            trie.checked_time = now
+            return trie
+
+    trie = _load(session)
+    with _lock:
+        _cache[key] = trie
+    return trie
+
+
+def match(path, area=None, session=None):
+    '''
+    查找路径所属的storage 根路径
+    :param path: string，硬盘路径
+    :param area: string，publish、work、cache 中的一个。如果为None，那么匹配所有区域
+    :param session: sqlalchemy session
+    :return: tuple，(根路径的层级数量, list of StorageRoot, 拆分之后的路径)
+    '''
+    component = split(path)
+    length, roots = get_trie(session=session).match(component, area=area)
+    return length, roots, component
+
+
+def convert(path, platform, session=None):
+    '''
+    把流程内的硬盘路径转换到另一个平台
+    :param path: string，硬盘路径
+    :param platform: string，win32、darwin、linux2 中的一个
+    :param session: sqlalchemy session
+    :return: string。如果不是流程内的路径，或者目标平台没有设置根路径，返回None
+    '''
+    length, roots, component = match(path, session=session)
+    if not roots:
+        return None
+
+    target = roots[0].roots.get(platform, None)
+    if not target:
+        return None
+    return '/'.join([target.rstrip('/')] + component[length:])
+
+
+def invalidate():
+    '''
+    让前缀树失效，下一次使用时重新加载
+    :return: None
+    '''
+    with _lock:
+        _cache.clear()
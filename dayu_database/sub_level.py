@@ -108,8 +108,22 @@ from config import DECISION_TREE, DAYU_APP_NAME, DAYU_CONFIG_STATIC_PATH
 
 presets_root = 'sub_level_config_presets'
 
-# 用来保存所有分支条件变量的
+# 用来保存所有分支条件变量的。第一次使用时才会读取预设（参考 get_sub_level_configs）
 SUB_LEVEL_CONFIGS = {}
+_configs_loaded = False
+
+
+def get_sub_level_configs():
+    '''
+    获得所有的SubLevel json 预设。第一次调用时扫描预设文件夹，之后直接返回已经读取的内容
+    :return: dict，key 是分支条件的string，value 是json 预设的内容
+    '''
+    global _configs_loaded
+    if not _configs_loaded:
+        if not SUB_LEVEL_CONFIGS:
+            SubLevelConfigManager.load_all_configs()
+        _configs_loaded = True
+    return SUB_LEVEL_CONFIGS
 
 
 def get_sub_level_op(decision, orm):
@@ -122,7 +136,7 @@ def get_sub_level_op(decision, orm):
     :param orm: FILE orm
     :return: list of tuple，tuple 包含 SequentialFile() 和 对应的操作名称
     '''
-    sub_config = SUB_LEVEL_CONFIGS.get(decision, None)
+    sub_config = get_sub_level_configs().get(decision, None)
     if sub_config is None:
         raise Exception('no matching sub level config')
 
@@ -177,7 +191,7 @@ class SubLevelConfigManager(object):
     def load_all_configs(software=None):
         '''
         读取所有设置好的json 预设。需要json 文件存放在 sub_level_config_presets 文件内
-        必须在加载模块的时候运行一次！
+        不需要手动运行，第一次 get_sub_level_op() 的时候会自动读取。如果预设文件夹不存在，不会读取任何预设
         :return:
         '''
 
@@ -187,6 +201,9 @@ class SubLevelConfigManager(object):
 
         root_path = DayuPath(os.environ.get(DAYU_CONFIG_STATIC_PATH,
                                             DayuPath(__file__).parent.child('static', presets_root, software)))
+        if not root_path.isdir():
+            return
+
         for x in root_path.walk(filter=os.path.isfile):
             if x.endswith('.json'):
                 with open(x, 'r') as jf:
@@ -220,10 +237,6 @@ class SubLevelConfigManager(object):
 # 只要运行过一次，不需要每次都运行
 # SubLevelConfigManager.generate_configs()
 
-# 必须运行！才能够读取需要的全局SubLevel config信息！
-if not SUB_LEVEL_CONFIGS:
-    SubLevelConfigManager.load_all_configs()
-
 
 class SubLevel(DayuPath):
     '''
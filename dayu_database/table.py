@@ -19,8 +19,12 @@ from sqlalchemy import inspect, and_, Boolean, Column, FLOAT
 from sqlalchemy.event import listens_for
 from sqlalchemy.orm import relationship, backref, foreign, remote, ColumnProperty, RelationshipProperty, object_session
 
+import clue_index
 import config
 import mixin
+import path_index
+import tree
+import version_counter
 from base import BASE
 from dayu_database.event_center import emit
 
@@ -284,6 +288,25 @@ class PIPELINE_CONFIG(BASE, mixin.BasicMixin, mixin.UserMixin, mixin.ExtraDataMi
         return dict(self.extra_data)
 
 
+@listens_for(STORAGE, 'after_update')
+@listens_for(STORAGE, 'after_delete')
+@listens_for(DB_CONFIG, 'after_update')
+@listens_for(DB_CONFIG, 'after_delete')
+@listens_for(PIPELINE_CONFIG, 'after_update')
+@listens_for(PIPELINE_CONFIG, 'after_delete')
+def invalidate_config_cache(mapper, connection, target):
+    '''
+    修改、删除配置之后，让进程内的配置缓存失效（参考 config_cache）
+    :param mapper:
+    :param connection:
+    :param target: STORAGE、DB_CONFIG、PIPELINE_CONFIG orm
+    :return: None
+    '''
+    import config_cache
+    # 有可能修改的是name，所以直接让整个table 的缓存失效
+    config_cache.invalidate(target.__tablename__)
+
+
 #
 #
 class JOB(BASE, mixin.BasicMixin, mixin.UserMixin, mixin.ExtraDataMixin, mixin.TimestampMixin):
@@ -401,130 +424,106 @@ class SEARCH(BASE, mixin.BasicMixin, mixin.UserMixin, mixin.ExtraDataMixin, mixi
         * op：表示进行的操作，例如 in、eq、not_in
         * value：表示用户输入的内容，也是操作的数据。如果value 需要包含有多个值，可以用 , 隔开。例如："a,b,c,d"
 
+        extra_data 中还可以设置 order_by，例如 ['-created_time']，表示结果的排序。
+        数量很多的时候，请使用 count()、page()、stream()。
+
         :return: sql 查询对象，如果想要得到实际的内容，需要用户自行list()
         '''
         import dayu_database as db
-        import util
-        import filter_parse
-
-        # 获得查询的基本类
-        model_class = util.get_class(self.extra_data.get('target_table', 'folder'))
-        # 建立最基本的查询对象
-        sql_expr = db.get_session().query(model_class)
-
-        def _build_filter(model_class, col_name_list):
-            '''
-            根据一条filter 条件，创建出查询的主体对象
-            （用户永远不应该自己调用）
-            :param model_class: ORM class
-            :param col_name_list: string，查询条件中的 col
-            :return: list
-            '''
-            current_table = model_class
-            relationship_filters = []
-
-            # 如果col 的查询名含有. 分割，那么可以认为需要多次连接查询
-            for col_name in col_name_list:
-                # 得到对应orm class 的所有sqlalchemy 属性，只有这些属性才能够参与sql 的生成。排除纯Python属性
-                sql_attr = inspect(current_table).attrs.get(col_name, None)
-                # 得到 qlalchemy.orm.attributes.InstrumentedAttribute 的对象。本质上就是类似 FOLDER.xxx 这样的形式
-                col_attr = getattr(current_table, col_name, None)
-
-                # 如果是column，那么就是orm 表内属性，不需要子查询
-                if sql_attr.__class__ == ColumnProperty:
-                    relationship_filters.append(col_attr)
-                # 如果是relationship，那么久需要子查询
-                elif sql_attr.__class__ == RelationshipProperty:
-                    # 判断是 one-to-many，还是many-to-one，来选择has、any 函数
-                    if sql_attr.uselist:
-                        col_attr = getattr(col_attr, 'any', None)
-                    else:
-                        col_attr = getattr(col_attr, 'has', None)
-                    # 由于子查询可能跨表查询，所以后续的orm class 就会变为新的table
-                    current_table = sql_attr.mapper.class_
-                    relationship_filters.append(col_attr)
-
-                else:
-                    raise Exception('no such a name in ORM')
-
-            return relationship_filters
-
-        def traverse_filter(raw_filter):
-            '''
-            遍历整个search dict
-            :param raw_filter: dict，必须是一个逻辑类的的。例如：{and: [...]}
-            :return: 可以用在.filter() 函数内
-            '''
-            for key, value in raw_filter.items():
-                # 得到逻辑函数
-                logic = filter_parse.LOGIC_SWITCH[key]
-                # 用于存放当前逻辑函数内的查询条件
-                param = []
-                for sub in value:
-                    # 如果查询条件没有col， 那么认为是一个嵌套的逻辑函数，递归调用traverse_filter
-                    if sub.get('col', None) is None:
-                        param.append(traverse_filter(sub))
-                    else:
-                        # 这部分是正常的一个搜索条件
-                        do = sub.get('do')
-                        # 跳过用户没有check 的条件
-                        if not do:
-                            continue
-
-                        col_name = sub.get('col')
-                        op = sub.get('op')
-                        data_type = sub.get('type')
-                        # 对value 中的关键字进行解析。如果是string 那么直接返回，如果是dict，那么寻找dict 对应的key 处理函数
-                        exp_value = filter_parse.resolve_expression(sub.get('value'))
-                        # 根据sqlalchemy 定义的data type 对string 进行转换，这样才能够得到正确的比较结果（例如DATETIME）
-                        exp_value = filter_parse.resolve_type(data_type, exp_value)
-
-                        # 调用_build_filter 得到查询的函数列表，列表的顺序是按照查询顺序排布
-                        attr_list = _build_filter(model_class, col_name.split('.'))
-
-                        # 小技巧，因为sqlalchemy 没有not_in 之类的操作，只能讲其拆解为两部分，先判断in，然后对结果再not
-                        if 'not' in op:
-                            op = op.replace('not', '').strip('_')
-
-                        # 如果op 是in 的操作，那么value 需要是list
-                        if op == 'in':
-                            attr_list[-1] = attr_list[-1].in_(exp_value.split(','))
-
-                        # 其他正常的操作，通过逐一判断可能存在的函数
-                        else:
-                            attr = next((x.format(op) for x in ['{}', '{}_', '__{}__']
-                                         if hasattr(attr_list[-1], x.format(op))), None)
-                            if attr is None:
-                                raise Exception('not a legal op')
-
-                            if exp_value == 'null':
-                                exp_value = None
-
-                            attr_list[-1] = getattr(attr_list[-1], attr)(exp_value)
-
-                        # 反向reduce，总是用 list[n](list[n+1])，直到全部完成
-                        # 得到类似 FOLDER.top.has(FOLDER.created.has(USER.name.in_([...])))
-                        single_sql = attr_list.pop()
-                        while attr_list:
-                            single_sql = attr_list.pop()(single_sql)
-
-                        # 如果存在not，此时将所有的查询语句取反，例如 not_(...)
-                        if 'not' in sub.get('op'):
-                            single_sql = filter_parse.LOGIC_SWITCH['not'](single_sql)
-
-                        # 加入逻辑列表
-                        param.append(single_sql)
-
-                # 返回逻辑函数
-                return logic(*param)
-
-        # 真正的调用，并且返回sql 查询对象，可以使用for loop 来遍历。否则需要用户自己 list()
-        if self.extra_data.get('filters', None):
-            filter_func = traverse_filter(self.extra_data['filters'])
-            return (x for x in sql_expr.filter(filter_func).filter(model_class.active == True))
+
+        # 编译好的查询计划按照filters 的内容缓存，重复执行时只需要重新绑定参数（参考 search_plan）
+        plan = self.plan()
+        if plan:
+            return plan.execute(db.get_session(), order_by=self.extra_data.get('order_by', None))
         else:
             return []
 
+    def plan(self):
+        '''
+        获得当前SEARCH 编译好的查询计划
+        :return: search_plan.SearchPlan。如果没有filters，返回None
+        '''
+        import search_plan
+
+        if self.extra_data.get('filters', None):
+            return search_plan.get_plan(self.extra_data.get('target_table', 'folder'),
+                                        self.extra_data['filters'],
+                                        join=self.extra_data.get('relationship_filter', 'join') != 'exists')
+        return None
+
+    def count(self):
+        '''
+        搜索结果的数量。只执行一次count 查询，不会读取orm
+        :return: int
+        '''
+        import dayu_database as db
+
+        plan = self.plan()
+        return plan.count(db.get_session()) if plan else 0
+
+    def page(self, page_after=None, limit=100, order_by=None):
+        '''
+        分页读取搜索结果（keyset 分页）。
+        第一页 page_after=None，之后每一页传入上一页最后一个orm 的id：
+            first = search.page(limit=50)
+            second = search.page(page_after=first[-1].id, limit=50)
+        :param page_after: 上一页最后一个orm 的id
+        :param limit: int，每一页的数量
+        :param order_by: list of string，column 的名字，前面加上 - 表示倒序。默认使用 extra_data['order_by']，最后总是按照id 排序
+        :return: list of orm
+        '''
+        import dayu_database as db
+
+        plan = self.plan()
+        if not plan:
+            return []
+        return list(plan.execute(db.get_session(),
+                                 order_by=order_by or self.extra_data.get('order_by', None),
+                                 page_after=page_after,
+                                 limit=limit))
+
+    def rows(self, columns=None, page_after=None, limit=None, order_by=None, yield_per=None):
+        '''
+        投影查询：只读取需要的column 和JSONB 中的内容，返回轻量的namedtuple，而不是完整的orm。
+        适合表格、finder 这种只需要显示几个字段的界面：
+            for row in search.rows(['id', 'name', 'meaning', 'created_time', 'extra_data.fps'], limit=200):
+                print row.id, row.name, row.extra_data__fps
+        :param columns: list of string，JSONB 中的内容使用 . 连接，例如 extra_data.fps。默认使用 extra_data['columns']
+        :param page_after: 上一页最后一行的id（需要columns 中包含id），参考 page()
+        :param limit: int
+        :param order_by: list of string，参考 page()
+        :param yield_per: int，参考 stream()
+        :return: generator of namedtuple
+        '''
+        import dayu_database as db
+
+        plan = self.plan()
+        columns = columns or self.extra_data.get('columns', None) or ['id', 'name']
+        if not plan:
+            return iter([])
+        return plan.rows(db.get_session(), columns,
+                         order_by=order_by or self.extra_data.get('order_by', None),
+                         page_after=page_after,
+                         limit=limit,
+                         yield_per=yield_per)
+
+    def stream(self, yield_per=1000, order_by=None):
+        '''
+        使用服务器端的cursor 遍历搜索结果，每次只读取yield_per 个orm，内存占用是固定的。
+        遍历的过程中不要修改这些orm 或者commit。
+        :param yield_per: int
+        :param order_by: list of string，参考 page()
+        :return: generator of orm
+        '''
+        import dayu_database as db
+
+        plan = self.plan()
+        if not plan:
+            return iter([])
+        return plan.execute(db.get_session(),
+                            order_by=order_by or self.extra_data.get('order_by', None),
+                            yield_per=yield_per)
+
 
 class VIEW_PERMISSION(BASE, mixin.BasicMixin, mixin.UserMixin, mixin.ExtraDataMixin, mixin.TimestampMixin):
     '''
@@ -619,8 +618,8 @@ def insert_symbol(mapper, connection, target):
     assert target.parent_id is not None
     # 确保用户指定了origin
     assert target.origin_table and target.origin_id
-    # 确保同一层级内没有同名的FOLDER、FILE、SYMBOL
-    assert next((x for x in target.parent.children if x.name == target.name and x.id != target.id), None) is None
+    # 确保同一层级内没有同名的FOLDER、FILE、SYMBOL。只查询是否存在，不需要读取所有的兄弟orm
+    assert not tree.sibling_name_exists(connection, target.parent_id, target.name, exclude_id=target.id)
 
     if target.lable is None:
         target.label = target.name
@@ -702,6 +701,21 @@ def setup_info_listener(mapper, _class):
         value.hook_table = hook_type
 
 
+@listens_for(INFO, 'after_insert')
+@listens_for(INFO, 'after_update')
+@listens_for(INFO, 'after_delete')
+def invalidate_info_cascade(mapper, connection, target):
+    '''
+    INFO 发生变化之后，让路径上包含这个INFO 的继承info 缓存失效（参考 info_cascade）
+    :param mapper:
+    :param connection:
+    :param target: INFO orm
+    :return: None
+    '''
+    import info_cascade
+    info_cascade.invalidate_info(target)
+
+
 # # TAG 和 FOLDER 之间的链接表， 提供TAG.folders 和 FOLDER.tags
 # tag_folder_association_table = Table('tag_folder_association',
 #                                      METADATA,
@@ -890,11 +904,29 @@ def update_folder(mapper, connection, target):
             target.top_id = target.parent.top_id
             target.top = target.parent.top
 
+        # 如果移动到了新的parent，需要更新自身以及所有子孙的path_ids
+        if tree.parent_changed(target):
+            tree.sync_path_ids(connection, target)
+
 
 @listens_for(FOLDER, 'after_insert')
 @emit('event.db.folder.commit.after')
 def after_insert_folder(mapper, connection, target):
-    pass
+    # 写入硬盘路径的反向索引
+    path_index.index(connection, [target])
+
+
+@listens_for(FOLDER, 'after_update')
+def after_update_folder(mapper, connection, target):
+    '''
+    FOLDER 改名、移动之后，更新硬盘路径的反向索引（包括整个子树）
+    :param mapper:
+    :param connection:
+    :param target: FOLDER orm
+    :return: None
+    '''
+    if path_index.path_changed(target):
+        path_index.move(connection, target)
 
 
 @listens_for(FOLDER, 'before_insert')
@@ -915,6 +947,7 @@ def insert_folder(mapper, connection, target):
 
     # 如果是root，那么不验证
     if target.name == config.DAYU_DB_ROOT_FOLDER_NAME:
+        tree.assign_path_ids(target)
         return
 
     # 必须指定parent
@@ -967,12 +1000,13 @@ def insert_folder(mapper, connection, target):
                       index in depth_config['to_name_param'][target.meaning])
     target.name = depth_config['to_name'][target.meaning].format(*selected_names)
 
-    # 确保没有重名orm
-    try:
-        assert next((x for x in target.parent.children if x.name == target.name and x.id != target.id), None) is None
-    except:
+    # 确保没有重名orm。只查询是否存在，不需要读取所有的兄弟orm
+    if tree.sibling_name_exists(connection, target.parent_id, target.name, exclude_id=target.id):
         raise Exception(target.name)
 
+    # 记录从root 到自身的物化路径
+    tree.assign_path_ids(target)
+
     # 如果没有输入label，那么用name 赋值给label，方便GUI 读取
     if target.label is None:
         target.label = target.name
@@ -1044,11 +1078,29 @@ def update_file(mapper, connection, target):
     # 当前depth 是parent 的深度+1，会触发 @validate('depth') 的函数，重新进行meaning 的解析。
     target.depth = target.parent.depth + 1
 
+    # 如果移动到了新的parent，需要更新path_ids
+    if tree.parent_changed(target):
+        tree.sync_path_ids(connection, target)
+
 
 @listens_for(FILE, 'after_insert')
 @emit('event.db.file.commit.after')
 def after_insert_file(mapper, connection, target):
-    pass
+    # 写入硬盘路径的反向索引
+    path_index.index(connection, [target])
+
+
+@listens_for(FILE, 'after_update')
+def after_update_file(mapper, connection, target):
+    '''
+    FILE 改名、移动之后，更新硬盘路径的反向索引
+    :param mapper:
+    :param connection:
+    :param target: FILE orm
+    :return: None
+    '''
+    if path_index.path_changed(target):
+        path_index.move(connection, target)
 
 
 @listens_for(FILE, 'before_insert')
@@ -1101,25 +1153,15 @@ def insert_file(mapper, connection, target):
         target.top = target.parent.top
 
     # 如果FILE 不指定文件名，那么很可能是meaning 为VERSION、DAILIES
-    # 那么需要根据parent 文件夹内的已有文件，进行版本名自增
+    # 那么需要根据parent 文件夹内的已有文件，进行版本名自增（参考 version_counter）
     session = db.get_session()
     assert session is not None
 
     config_orm = util.get_db_config(target.db_config_name)
 
-    if target.name is None:
-        try:
-            contents = target.parent.sub_files.filter(FILE.id != target.id)[-1]
-            match = version_regex.match(str(contents.name))
-            if match:
-                version_num = match.groups()[0]
-                target.name = 'v%0{}d'.format(len(version_num)) % (int(version_num) + 1)
-                # if target.old_file_id is None:
-                #     target.old_file_id = contents.id
-
-        except:
-            cas_info = db.util.get_cascading_info(target, 'cascading_info')['all_info']
-            target.name = cas_info.get('init_{}_version'.format(target.type_group_name), 'v0001')
+    auto_version = target.name is None
+    if auto_version:
+        target.name = version_counter.next_version(connection, target)
 
     # 继续根据db_config 来进行完整name 的组合
     parents = list(getattr(target, 'hierarchy', None))
@@ -1128,8 +1170,15 @@ def insert_file(mapper, connection, target):
                       index in depth_config['to_name_param'][target.meaning])
     target.name = depth_config['to_name'][target.meaning].format(*selected_names)
 
-    # 保证没有重名
-    assert next((x for x in target.parent.children if x.name == target.name and x.id != target.id), None) is None
+    # 保证没有重名。只查询是否存在，不需要读取所有的兄弟orm
+    assert not tree.sibling_name_exists(connection, target.parent_id, target.name, exclude_id=target.id)
+
+    # 手动指定的版本名，需要同步到版本计数器
+    if not auto_version:
+        version_counter.observe(connection, [(target.parent_id, target.name)])
+
+    # 记录从root 到自身的物化路径
+    tree.assign_path_ids(target)
 
     # 如果没有label，那么把name 赋值给label，方便GUI 读取显示
     if target.label is None:
@@ -1138,3 +1187,27 @@ def insert_file(mapper, connection, target):
     # 由于shotgun 的监听事件需要修改cloud_id 和cloud_table, 所以必须在这里强行发射信号
     import message
     message.pub(('event', 'db', 'file', 'commit', 'before'), mapper, connection, target)
+
+
+@listens_for(mixin.ClueMixin, 'before_insert', propagate=True)
+def insert_clue_tokens(mapper, connection, target):
+    '''
+    根据vfx_clue、cam_clue 生成clue_tokens，用来通过GIN 索引匹配onset metadata（参考 clue_index.py）
+    :param mapper:
+    :param connection:
+    :param target: FOLDER、FILE orm
+    :return: None
+    '''
+    clue_index.sync(target, force=True)
+
+
+@listens_for(mixin.ClueMixin, 'before_update', propagate=True)
+def update_clue_tokens(mapper, connection, target):
+    '''
+    vfx_clue、cam_clue 发生变化之后，更新clue_tokens
+    :param mapper:
+    :param connection:
+    :param target: FOLDER、FILE orm
+    :return: None
+    '''
+    clue_index.sync(target)
@@ -0,0 +1,617 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    FOLDER、FILE 树状层级结构的批量读取。
+
+    原本 DepthMixin.hierarchy 是沿着 .parent 逐级向上访问，每一级都会触发一次 lazy load 的数据库查询。
+    对于VERSION 这种深度为8、9 的orm，仅仅得到hierarchy 就需要将近10 次数据库往返，
+    而 disk_path()、db_path()、find_meaning()、before_insert 的校验都依赖hierarchy。
+
+    这里使用 WITH RECURSIVE 的方式，一次查询就可以得到一个（或者多个）orm 的全部祖先FOLDER。
+    查询得到的FOLDER 会进入session 的identity map，同时直接写入 .parent、.top 以及 .hierarchy，
+    之后再次访问这些属性都不会再访问数据库。
+
+    已经在内存中的parent（例如用户刚刚赋值、还没有flush 的orm）会被直接使用，不会去数据库查询。
+
+    FOLDER、FILE 还会维护物化路径 path_ids（从root 到自身的全部id）：
+    * "X 的所有祖先" 就是 X.path_ids，只需要一次 id IN (...) 的查询
+    * "X 的所有子孙" 就是 path_ids @> ARRAY[X.id]，一次走GIN 索引的查询
+    path_ids 由table.py 中insert_folder、insert_file、update_folder、update_file 监听函数负责维护，
+    已经存在的数据可以通过 init_db.migrate 进行回填。
+    如果数据库还没有path_ids 这个column，那么所有函数都会退回到原本逐层查询的方式。
+
+    删除、恢复整个子树（set_active）直接对FOLDER、FILE、SYMBOL 各执行一条集合的UPDATE，不需要读取子孙orm。
+    移动整个子树（move_subtree）也一样，只检查一次，然后用集合的UPDATE 修改depth、top_id、path_ids 等。
+
+    '''
+
+import collections
+
+from sqlalchemy import inspect, select, and_, or_, text
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import set_committed_value
+
+
+def _loaded_parent(orm):
+    '''
+    在不访问数据库的前提下，尝试得到orm 的parent。
+    :param orm: FOLDER、FILE orm
+    :return: tuple，(parent orm 或者None, 是否已经确定)。如果没有确定，表示需要去数据库查询
+    '''
+    state = inspect(orm)
+    if 'parent' in state.dict:
+        return state.dict['parent'], True
+
+    parent_id = orm.parent_id
+    if parent_id is None:
+        return None, True
+
+    # 已经在identity map 中的FOLDER，直接拿来使用
+    session = state.session
+    if session is not None:
+        import table
+        key = inspect(table.FOLDER).identity_key_from_primary_key([parent_id])
+        parent = session.identity_map.get(key, None)
+        if parent is not None:
+            return parent, True
+
+    return None, False
+
+
+def has_path_ids(orm_class):
+    '''
+    判断当前数据库的table 是否已经具备 path_ids 这个column（旧的数据库需要先执行 init_db.migrate）
+    :param orm_class: FOLDER、FILE class
+    :return: bool
+    '''
+    return 'path_ids' in orm_class.__table__.c
+
+
+def _known_path_ids(orm):
+    '''
+    得到orm 已经保存的path_ids。如果没有（旧数据库、或者还没有insert 的orm），返回None
+    :param orm: FOLDER、FILE orm
+    :return: list of int 或者None
+    '''
+    if not has_path_ids(type(orm)):
+        return None
+    return orm.path_ids or None
+
+
+def _query_ancestors(session, folder_ids):
+    '''
+    使用 WITH RECURSIVE，一次性查询多个FOLDER 以及它们的全部祖先FOLDER。
+    :param session: sqlalchemy session
+    :param folder_ids: FOLDER 的id 集合
+    :return: dict，key 是id，value 是FOLDER orm
+    '''
+    import table
+
+    folder = table.FOLDER.__table__
+    ancestor_cte = select([folder.c.id, folder.c.parent_id]) \
+        .where(folder.c.id.in_(folder_ids)) \
+        .cte('ancestor', recursive=True)
+    parent_folder = folder.alias('parent_folder')
+    # 使用union 而不是union all，即使数据出现了环状引用，查询也能正常结束
+    ancestor_cte = ancestor_cte.union(select([parent_folder.c.id, parent_folder.c.parent_id])
+                                      .where(parent_folder.c.id == ancestor_cte.c.parent_id))
+
+    return {x.id: x for x in session.query(table.FOLDER)
+        .filter(table.FOLDER.id.in_(select([ancestor_cte.c.id])))}
+
+
+def _link(chain, by_id):
+    '''
+    把查询得到的祖先FOLDER 写入 .parent、.top、.hierarchy，避免之后的 lazy load
+    :param chain: list of orm，[root_orm, project, ... self]
+    :param by_id: dict，key 是id，value 是FOLDER orm
+    :return: None
+    '''
+    for index, orm in enumerate(chain):
+        state = inspect(orm)
+        if state.persistent:
+            if index > 0 and 'parent' not in state.dict:
+                set_committed_value(orm, 'parent', chain[index - 1])
+            if 'top' not in state.dict and orm.top_id in by_id:
+                set_committed_value(orm, 'top', by_id[orm.top_id])
+
+        if 'hierarchy' not in orm.__dict__:
+            orm.hierarchy = chain[:index + 1]
+
+
+def load_hierarchies(orms):
+    '''
+    批量获得多个orm 的hierarchy。
+    不论传入多少个orm，最多只会进行一次数据库查询。
+    返回的每个list 和 DepthMixin.hierarchy 一样：[root_orm, project, sequence_group, sequence... self]
+
+    :param orms: FOLDER、FILE 的orm 列表
+    :return: list of list，顺序和传入的orms 一致
+    '''
+    import dayu_database
+
+    chains = []
+    # key 是session，value 是dict：{还没有加载的parent_id: [需要补全的chain]}
+    frontiers = collections.defaultdict(lambda: collections.defaultdict(list))
+    # key 是session，value 是已经通过path_ids 得知的全部祖先id，可以直接使用 id IN (...) 查询
+    known_ids = collections.defaultdict(set)
+    # key 是session，value 是不知道path_ids，需要使用WITH RECURSIVE 查询的parent_id
+    recursive_ids = collections.defaultdict(set)
+
+    for orm in orms:
+        chain = collections.deque([orm])
+        current = orm
+        while True:
+            # 如果某个祖先已经计算过hierarchy，那么直接复用
+            cached = current.__dict__.get('hierarchy', None) if current is not orm else None
+            if cached is not None:
+                chain.extendleft(reversed(cached[:-1]))
+                break
+
+            parent, resolved = _loaded_parent(current)
+            if not resolved:
+                session = object_session(current) or dayu_database.get_session()
+                frontiers[session][current.parent_id].append(chain)
+                path_ids = _known_path_ids(current)
+                if path_ids:
+                    known_ids[session].update(path_ids[:-1])
+                else:
+                    recursive_ids[session].add(current.parent_id)
+                break
+
+            if parent is None:
+                break
+
+            chain.appendleft(parent)
+            current = parent
+
+        chains.append(chain)
+
+    import table
+
+    for session, frontier in frontiers.items():
+        by_id = {}
+        if known_ids[session]:
+            by_id.update((x.id, x) for x in
+                         session.query(table.FOLDER).filter(table.FOLDER.id.in_(list(known_ids[session]))))
+        if recursive_ids[session]:
+            by_id.update(_query_ancestors(session, list(recursive_ids[session])))
+
+        for folder_id, waiting_chains in frontier.items():
+            ancestors = collections.deque()
+            # 防止错误数据形成环状引用时死循环
+            for _ in range(len(by_id)):
+                folder = by_id.get(folder_id, None)
+                if folder is None:
+                    break
+                ancestors.appendleft(folder)
+                folder_id = folder.parent_id
+
+            for chain in waiting_chains:
+                chain.extendleft(reversed(ancestors))
+
+    result = []
+    for chain in chains:
+        chain = list(chain)
+        _link(chain, {x.id: x for x in chain})
+        result.append(chain)
+
+    return result
+
+
+def load_hierarchy(orm):
+    '''
+    获得单个orm 的hierarchy。（参考 load_hierarchies）
+    :param orm: FOLDER、FILE orm
+    :return: list of orm
+    '''
+    return load_hierarchies([orm])[0]
+
+
+def assign_path_ids(orm):
+    '''
+    根据hierarchy 设置orm 的path_ids。（在insert_folder、insert_file 中调用）
+    :param orm: FOLDER、FILE orm
+    :return: None
+    '''
+    if has_path_ids(type(orm)):
+        orm.path_ids = [x.id for x in orm.hierarchy]
+
+
+def parent_changed(orm):
+    '''
+    判断orm 是否被移动到了新的parent 下
+    :param orm: FOLDER、FILE orm
+    :return: bool
+    '''
+    state = inspect(orm)
+    return state.attrs.parent_id.history.has_changes() or state.attrs.parent.history.has_changes()
+
+
+def sync_path_ids(connection, orm):
+    '''
+    orm 移动到新的parent 之后，重新计算自身的path_ids。
+    如果是FOLDER，那么同时使用一条UPDATE 语句改写全部子孙的path_ids 前缀。（在update_folder、update_file 中调用）
+
+    :param connection: before_update 监听函数传入的connection
+    :param orm: FOLDER、FILE orm
+    :return: None
+    '''
+    import table
+
+    if not has_path_ids(type(orm)):
+        return
+
+    old_path_ids = list(orm.path_ids or [])
+    # 移动之后，缓存的hierarchy 已经失效
+    orm.__dict__.pop('hierarchy', None)
+    new_path_ids = list(_known_path_ids(orm.parent) or [x.id for x in orm.parent.hierarchy]) + [orm.id]
+    if new_path_ids == old_path_ids:
+        return
+
+    orm.path_ids = new_path_ids
+    if not old_path_ids or not isinstance(orm, table.FOLDER):
+        return
+
+    for table_name in ('folder', 'file'):
+        connection.execute(text('UPDATE {0} '
+                                'SET path_ids = CAST(:new_path_ids AS BIGINT[]) || '
+                                'path_ids[:start : array_length(path_ids, 1)] '
+                                'WHERE path_ids @> CAST(:node AS BIGINT[]) AND id != :node_id'.format(table_name)),
+                           new_path_ids=new_path_ids,
+                           start=len(old_path_ids) + 1,
+                           node=[orm.id],
+                           node_id=orm.id)
+
+    # session 中已经读取的子孙orm，同步修改内存中的值，避免读到过期的path_ids
+    session = object_session(orm)
+    if session is None:
+        return
+    for x in list(session.identity_map.values()):
+        if x is orm or not isinstance(x, (table.FOLDER, table.FILE)):
+            continue
+        path_ids = inspect(x).dict.get('path_ids', None)
+        if path_ids and path_ids[:len(old_path_ids)] == old_path_ids:
+            set_committed_value(x, 'path_ids', new_path_ids + list(path_ids[len(old_path_ids):]))
+            x.__dict__.pop('hierarchy', None)
+
+
+def _subtree_folder_ids(orm):
+    '''
+    FOLDER 子树（包括自身）所有FOLDER id 的子查询。有path_ids 时走GIN 索引，否则使用 WITH RECURSIVE
+    :param orm: FOLDER orm
+    :return: sqlalchemy selectable，只有一个id column
+    '''
+    import table
+
+    folder_table = table.FOLDER.__table__
+    if _known_path_ids(orm) is not None:
+        return select([folder_table.c.id]).where(folder_table.c.path_ids.contains([orm.id]))
+
+    subtree = select([folder_table.c.id]).where(folder_table.c.id == orm.id).cte('subtree', recursive=True)
+    subtree = subtree.union_all(select([folder_table.c.id]).where(folder_table.c.parent_id == subtree.c.id))
+    return select([subtree.c.id])
+
+
+def set_active(orm, active, session=None):
+    '''
+    把orm 以及它的全部子孙FOLDER、FILE、SYMBOL 的active 设置为指定的值。
+    每一个table 只需要一条UPDATE 语句，不会读取任何子孙orm，也不会触发orm 的监听函数。
+    语句在session 当前的事务中执行，需要用户自己commit。
+    session 中已经读取的orm，会同步修改内存中的active。
+
+    :param orm: FOLDER、FILE orm
+    :param active: bool
+    :param session: sqlalchemy session，默认是orm 所在的session
+    :return: dict，key 是table 名（folder、file、symbol），value 是实际被修改的数量
+    '''
+    import dayu_database
+    import table
+
+    session = session or object_session(orm) or dayu_database.get_session()
+    # 先写入还没有flush 的修改（例如刚刚创建的子孙），UPDATE 才能覆盖整个子树
+    session.flush()
+    connection = session.connection()
+
+    if isinstance(orm, table.FOLDER):
+        folder_ids = _subtree_folder_ids(orm)
+        conditions = {table.FOLDER: table.FOLDER.__table__.c.id.in_(folder_ids),
+                      table.FILE: table.FILE.__table__.c.parent_id.in_(folder_ids),
+                      table.SYMBOL: and_(table.SYMBOL.__table__.c.origin_table == 'folder',
+                                         table.SYMBOL.__table__.c.origin_id.in_(folder_ids))}
+    else:
+        conditions = {type(orm): type(orm).__table__.c.id == orm.id}
+
+    result = {'folder': 0, 'file': 0, 'symbol': 0}
+    changed = {}
+    for orm_class, condition in conditions.items():
+        orm_table = orm_class.__table__
+        # 只修改需要修改的row，返回的数量就是实际删除、恢复的数量
+        config_changed = config_changed or 'storage_config_name' in values or 'db_config_name' in values
+
+        ids = [x for x, in connection.execute(orm_table.update()
+                                              .where(condition)
+                                              .where(orm_table.c.active.isnot(active))
+                                              .values(active=active)
+                                              .returning(orm_table.c.id))]
+        result[orm_table.name] = len(ids)
+        changed[orm_class] = set(ids)
+
+    for x in list(session.identity_map.values()):
+        if inspect(x).key[1][0] in changed.get(type(x), ()):
+            set_committed_value(x, 'active', active)
+
+    return result
+
+
+# 创建时从parent 继承的column。移动之后，和旧parent 相同的值（也就是继承来的值）会改成新parent 的值
+INHERITED_COLUMNS = ('db_config_name', 'storage_config_name', 'pipeline_config_name', 'type_name', 'type_group_name')
+
+
+def _validate_move(session, node, new_parent):
+    '''
+    检查node 是否可以移动到new_parent 下。（move_subtree 中调用，整个子树只检查一次）
+    :return: None，不满足条件的时候raise Exception
+    '''
+    import mixin
+    import table
+    import util
+    from config import DAYU_DB_ROOT_FOLDER_NAME
+
+    if not isinstance(node, (table.FOLDER, table.FILE)) or not isinstance(new_parent, table.FOLDER):
+        raise Exception('only move FOLDER or FILE into a FOLDER: {} -> {}'.format(node, new_parent))
+    if node.name == DAYU_DB_ROOT_FOLDER_NAME or node.depth <= 1:
+        raise Exception('can not move root or project: {}'.format(node))
+    if new_parent.active is False:
+        raise Exception('can not move into a deleted FOLDER: {}'.format(new_parent))
+
+    parents = load_hierarchy(new_parent)
+    if node.id in [x.id for x in parents]:
+        raise Exception('can not move a FOLDER into itself: {} -> {}'.format(node, new_parent))
+    if sibling_name_exists(session.connection(), new_parent.id, node.name, exclude_id=node.id):
+        raise Exception('name already exists in {}: {}'.format(new_parent, node.name))
+
+    # 子树中每一种 (depth, meaning) 在新的深度都必须是合法的meaning
+    db_config_name = new_parent.db_config_name if node.db_config_name == node.parent.db_config_name \
+        else node.db_config_name
+    config_orm = util.get_db_config(db_config_name)
+    delta = new_parent.depth + 1 - node.depth
+    if isinstance(node, table.FOLDER):
+        subtree_folder_ids = _subtree_folder_ids(node)
+        folder_table = table.FOLDER.__table__
+        file_table = table.FILE.__table__
+        meanings = select([folder_table.c.depth, folder_table.c.meaning]) \
+            .where(folder_table.c.id.in_(subtree_folder_ids)) \
+            .union(select([file_table.c.depth, file_table.c.meaning])
+                   .where(file_table.c.parent_id.in_(subtree_folder_ids)))
+        meanings = session.execute(meanings).fetchall()
+    else:
+        meanings = [(node.depth, node.meaning)]
+
+    for depth, meaning in meanings:
+        depth_config = config_orm.config.get(str(depth + delta), None)
+        if depth_config is None or meaning not in depth_config['content']:
+            raise Exception('no match meaning with depth!, {}: {}'.format(meaning, depth + delta))
+
+    # 同一深度有多个meaning 的时候，node 在新位置按照db_pattern 解析出的meaning 必须不变
+    branch_depth = config_orm.derived('db_pattern', mixin._compile_db_pattern).get(str(node.depth + delta), None)
+    if branch_depth and len(config_orm.config[str(node.depth + delta)]['content']) > 1:
+        db_path_string = '/' + '/'.join(str(x.name) for x in parents[1:] + [node])
+        if next((v for k, v in branch_depth if k.match(db_path_string)), None) != node.meaning:
+            raise Exception('no match meaning with depth!, {}'.format(db_path_string))
+
+
+def move_subtree(node, new_parent, session=None):
+    '''
+    把node 连同整个子树移动到new_parent 下。
+    移动只在开始的时候检查一次（重名、环状引用、子树中每一个meaning 在新深度是否合法），
+    然后使用集合的UPDATE 语句修改parent_id，以及整个子树的depth、top_id、path_ids、继承的config name，
+    不会读取任何子孙orm，也不会触发orm 的监听函数（validate_depth、update_folder 等）。
+    硬盘路径的反向索引（path_index）会替换整个子树的前缀；
+    如果移动改变了子树的storage_config_name 或者db_config_name，那么重新生成整个子树的索引。
+    语句在session 当前的事务中执行，需要用户自己commit。
+
+    :param node: FOLDER、FILE orm
+    :param new_parent: FOLDER orm
+    :param session: sqlalchemy session，默认是node 所在的session
+    :return: dict，key 是table 名（folder、file），value 是被修改的数量
+    '''
+    import dayu_database
+    import path_index
+    import table
+    from sqlalchemy import case, cast, bindparam, func, BigInteger
+    from sqlalchemy.dialects.postgresql import ARRAY
+
+    session = session or object_session(node) or dayu_database.get_session()
+    session.flush()
+    result = {'folder': 0, 'file': 0}
+    if node.parent_id == new_parent.id:
+        return result
+
+    _validate_move(session, node, new_parent)
+    connection = session.connection()
+    old_parent = node.parent
+    old_path_ids = _known_path_ids(node)
+    new_parent_path_ids = _known_path_ids(new_parent)
+    delta = new_parent.depth + 1 - node.depth
+    top_id = new_parent.id if new_parent.depth == 1 else new_parent.top_id
+
+    node_table = type(node).__table__
+    connection.execute(node_table.update().where(node_table.c.id == node.id).values(parent_id=new_parent.id))
+
+    if isinstance(node, table.FOLDER):
+        subtree_folder_ids = _subtree_folder_ids(node)
+        conditions = {table.FOLDER: table.FOLDER.__table__.c.id.in_(subtree_folder_ids),
+                      table.FILE: table.FILE.__table__.c.parent_id.in_(subtree_folder_ids)}
+    else:
+        conditions = {table.FILE: table.FILE.__table__.c.id == node.id}
+
+    changed = set()
+    config_changed = False
+    for orm_class, condition in conditions.items():
+        orm_table = orm_class.__table__
+        values = {'depth': orm_table.c.depth + delta, 'top_id': top_id}
+        for column in INHERITED_COLUMNS:
+            old_value = getattr(old_parent, column, None)
+            new_value = getattr(new_parent, column, None)
+            if column in orm_table.c and old_value != new_value:
+                values[column] = case([(orm_table.c[column].isnot_distinct_from(old_value), new_value)],
+                                      else_=orm_table.c[column])
+        if old_path_ids is not None and new_parent_path_ids is not None:
+            # 新的前缀 + 从node 开始的原本路径
+            values['path_ids'] = cast(bindparam('new_path_ids', list(new_parent_path_ids), type_=ARRAY(BigInteger)),
+                                      ARRAY(BigInteger)) \
+                .concat(orm_table.c.path_ids[len(old_path_ids):func.array_length(orm_table.c.path_ids, 1)])
+
+        config_changed = config_changed or 'storage_config_name' in values or 'db_config_name' in values
+
+        ids = [x for x, in connection.execute(orm_table.update()
+                                              .where(condition)
+                                              .values(**values)
+                                              .returning(orm_table.c.id))]
+        result[orm_table.name] = len(ids)
+        changed.update((orm_table.name, x) for x in ids)
+
+    # session 中已经读取的子树orm，内存中的值已经过期。缓存的hierarchy、路径也需要清除
+    expired = ['depth', 'top_id', 'top'] + [x for x in INHERITED_COLUMNS + ('path_ids',) if x in node_table.c]
+    for x in list(session.identity_map.values()):
+        if isinstance(x, (table.FOLDER, table.FILE)) and (x.__tablename__, inspect(x).key[1][0]) in changed:
+            session.expire(x, expired)
+            x.__dict__.pop('hierarchy', None)
+            x._cache_db_path = None
+            for disk_type in ('publish', 'work', 'cache'):
+                setattr(x, '_cache_{}_disk_path'.format(disk_type), None)
+    set_committed_value(node, 'parent_id', new_parent.id)
+    set_committed_value(node, 'parent', new_parent)
+
+    if config_changed:
+        # storage 根路径、路径模板都可能不同，子树的索引不能只替换前缀
+        hooks = collections.defaultdict(list)
+        for table_name, x in changed:
+            hooks[table_name].append(x)
+        path_index.reindex(connection, hooks)
+    else:
+        path_index.move(connection, node)
+    return result
+
+
+def sibling_name_exists(connection, parent_id, name, exclude_id=None):
+    '''
+    判断同一个FOLDER 中是否已经存在同名的FOLDER、FILE、SYMBOL。（和FOLDER.children 的范围相同）
+    只会进行一次走 (parent_id, name) 索引的EXISTS 查询，不会读取所有的兄弟orm。
+
+    :param connection: sqlalchemy connection 或者 session
+    :param parent_id: 所在FOLDER 的id
+    :param name: string，需要检查的名字
+    :param exclude_id: 需要排除的id（通常是自身）
+    :return: bool
+    '''
+    from sqlalchemy import and_, exists
+    import table
+
+    folder_table = table.FOLDER.__table__
+    file_table = table.FILE.__table__
+    symbol_table = table.SYMBOL.__table__
+
+    clauses = []
+    for current_table, parent_column in ((folder_table, folder_table.c.parent_id),
+                                         (file_table, file_table.c.parent_id),
+                                         (symbol_table, symbol_table.c.origin_id)):
+        condition = and_(parent_column == parent_id, current_table.c.name == name)
+        if current_table is symbol_table:
+            condition = and_(condition, symbol_table.c.origin_table == 'folder')
+        if exclude_id is not None:
+            condition = and_(condition, current_table.c.id != exclude_id)
+        clauses.append(exists().where(condition))
+
+    return bool(connection.execute(select([or_(*clauses)])).scalar())
+
+
+def ancestors(orm):
+    '''
+    获得orm 的所有祖先FOLDER，不包括自身。顺序为 [root_orm, project, ...]
+    :param orm: FOLDER、FILE orm
+    :return: list of FOLDER orm
+    '''
+    return load_hierarchy(orm)[:-1]
+
+
+def descendants(orm):
+    '''
+    获得FOLDER 下的所有子孙FOLDER、FILE（不包括SYMBOL，不包括自身）。
+    有path_ids 的情况下只需要两次查询（FOLDER、FILE 各一次）
+    :param orm: FOLDER orm
+    :return: list of orm，按照depth 从小到大排列
+    '''
+    import table
+    return [x for _, x in walk_with_parent(orm) if not isinstance(x, table.SYMBOL)]
+
+
+def walk(orm):
+    '''
+    广度优先遍历orm 下的全部内容，顺序和原本的 DepthMixin.walk() 一致。
+    :param orm: FOLDER、FILE orm
+    :return: generator
+    '''
+    for _, x in walk_with_parent(orm):
+        yield x
+
+
+def walk_with_parent(orm):
+    '''
+    广度优先遍历orm 下的全部内容，同时返回遍历时的上一级orm。
+    有path_ids 的时候，会一次性读取整个子树（FOLDER、FILE、SYMBOL 各一次查询），然后在内存中按照children 的顺序遍历。
+    SYMBOL 只会被列出，不会继续遍历它所链接的内容（避免链接形成的死循环）。
+    没有path_ids 的时候，退回到逐个访问children 的方式。
+
+    :param orm: FOLDER、FILE orm
+    :return: generator，每次返回 (parent_orm, orm)
+    '''
+    import table
+
+    if not isinstance(orm, table.FOLDER):
+        return
+
+    if _known_path_ids(orm) is None:
+        queue = collections.deque([orm])
+        while queue:
+            current = queue.popleft()
+            for x in current.children:
+                yield current, x
+                queue.append(x)
+        return
+
+    session = object_session(orm)
+    sub_folder_ids = select([table.FOLDER.id]).where(table.FOLDER.path_ids.contains([orm.id]))
+    sub_folders = session.query(table.FOLDER) \
+        .filter(table.FOLDER.path_ids.contains([orm.id]), table.FOLDER.id != orm.id) \
+        .order_by(table.FOLDER.name)
+    sub_files = session.query(table.FILE) \
+        .filter(table.FILE.path_ids.contains([orm.id])) \
+        .order_by(table.FILE.name)
+    symbols = session.query(table.SYMBOL) \
+        .filter(table.SYMBOL.origin_table == 'folder', table.SYMBOL.origin_id.in_(sub_folder_ids)) \
+        .order_by(table.SYMBOL.origin_table, table.SYMBOL.origin_id)
+
+    # 和FOLDER.children 一样的顺序：sub_folders、sub_files、symbols
+    children = collections.defaultdict(list)
+    for x in sub_folders:
+        children[x.parent_id].append(x)
+    for x in sub_files:
+        children[x.parent_id].append(x)
+    for x in symbols:
+        children[x.origin_id].append(x)
+
+    queue = collections.deque([orm])
+    while queue:
+        current = queue.popleft()
+        for x in children.get(current.id, ()):
+            state = inspect(x)
+            if not isinstance(x, table.SYMBOL):
+                if state.persistent and 'parent' not in state.dict:
+                    set_committed_value(x, 'parent', current)
+                queue.append(x)
+            yield current, x
@@ -31,11 +31,26 @@ def short_uuid():
 
 
 def delete_tree(orm):
+    '''
+    把orm 以及全部子孙FOLDER、FILE、SYMBOL 标记为删除（active = False）。
+    使用集合的UPDATE 语句，不会读取子孙orm（参考 tree.set_active），需要用户自己commit
+    :param orm: FOLDER、FILE orm
+    :return: dict，每一个table 被删除的数量，例如 {'folder': 20, 'file': 400, 'symbol': 0}
+    '''
     # import net_log
     # net_log.get_logger().warn('delete data orm tree: {}'.format(orm))
-    orm.active = False
-    for x in orm.walk():
-        x.active = False
+    import tree
+    return tree.set_active(orm, False)
+
+
+def restore_tree(orm):
+    '''
+    恢复delete_tree 删除的orm 以及全部子孙（active = True），需要用户自己commit
+    :param orm: FOLDER、FILE orm
+    :return: dict，每一个table 被恢复的数量
+    '''
+    import tree
+    return tree.set_active(orm, True)
 
 
 def snowflake():
@@ -99,26 +114,79 @@ def get_current_user():
 
 def get_db_config(db_config_name):
     '''
-    获得对应的DB_CONFIG orm
+    获得对应的DB_CONFIG
+    返回的是进程内缓存的配置（config_cache.ConfigEntry），和orm 一样可以使用 .config、.extra_data、.name。
+    缓存是只读的，需要修改配置的时候使用 get_db_config_orm()
+    :param db_config_name: 用户输入的config 名称。例如 db.movie
+    :return: ConfigEntry
+    '''
+    import config_cache
+    return config_cache.get('db_config', db_config_name)
+
+
+def get_db_config_orm(db_config_name):
+    '''
+    获得对应的DB_CONFIG orm（不经过缓存）。用于修改配置，修改之后commit，缓存会自动失效
     :param db_config_name: 用户输入的config 名称。例如 db.movie
     :return: DB_CONFIG orm
     '''
-    import dayu_database
-    from table import DB_CONFIG
-    session = dayu_database.get_session()
-    return session.query(DB_CONFIG).filter(DB_CONFIG.name == db_config_name).one()
+    import config_cache
+    return config_cache.get_orm('db_config', db_config_name)
 
 
 def get_storage_config(storage_config_name):
     '''
-    获得对应的STORAGE orm
+    获得对应的STORAGE
+    返回的是进程内缓存的配置（config_cache.ConfigEntry），和orm 一样可以使用 .config、.extra_data、.name。
+    缓存是只读的，需要修改配置的时候使用 get_storage_config_orm()
+    :param storage_config_name: 用户输入的config 名称。例如 storage.movie
+    :return: ConfigEntry
+    '''
+    import config_cache
+    return config_cache.get('storage', storage_config_name)
+
+
+def get_storage_config_orm(storage_config_name):
+    '''
+    获得对应的STORAGE orm（不经过缓存）。用于修改配置，修改之后commit，缓存会自动失效
     :param storage_config_name: 用户输入的config 名称。例如 storage.movie
     :return: STORAGE orm
     '''
-    import dayu_database
-    from table import STORAGE
-    session = dayu_database.get_session()
-    return session.query(STORAGE).filter(STORAGE.name == storage_config_name).one()
+    import config_cache
+    return config_cache.get_orm('storage', storage_config_name)
+
+
+def get_pipeline_config(pipeline_config_name):
+    '''
+    获得对应的PIPELINE_CONFIG
+    返回的是进程内缓存的配置（config_cache.ConfigEntry），和orm 一样可以使用 .config、.extra_data、.name。
+    缓存是只读的，需要修改配置的时候使用 get_pipeline_config_orm()
+    :param pipeline_config_name: 用户输入的config 名称。例如 pipeline.movie
+    :return: ConfigEntry
+    '''
+    import config_cache
+    return config_cache.get('pipeline_config', pipeline_config_name)
+
+
+def get_pipeline_config_orm(pipeline_config_name):
+    '''
+    获得对应的PIPELINE_CONFIG orm（不经过缓存）。用于修改配置，修改之后commit，缓存会自动失效
+    :param pipeline_config_name: 用户输入的config 名称。例如 pipeline.movie
+    :return: PIPELINE_CONFIG orm
+    '''
+    import config_cache
+    return config_cache.get_orm('pipeline_config', pipeline_config_name)
+
+
+def refresh_config(table_name=None, name=None):
+    '''
+    让缓存的DB_CONFIG、STORAGE、PIPELINE_CONFIG 失效，下一次读取时会重新查询数据库
+    :param table_name: string，db_config、storage、pipeline_config 中的一个。如果为None，那么全部失效
+    :param name: string，配置的名字。如果为None，那么对应table 的全部配置失效
+    :return: None
+    '''
+    import config_cache
+    config_cache.refresh(table_name=table_name, name=name)
 
 
 def get_class(orm_tablename):
@@ -135,11 +203,10 @@ def get_cascading_info(orm, info_name, debug=False):
     '''
     获得某个FOLDER、FILE 对象的继承info
     处理过程如下：
-    1. 获取orm 拥有的所有info 对象
-    2. 判断是否存在有info_name 的对象
-    3. 读取extra_data 还是debug_data
-    4. 进行继承关系分析
-    5. 循环执行1~4，直到ROOT_FOLDER。
+    1. 一次查询得到hierarchy 上所有orm 名为info_name 的info 对象
+    2. 读取extra_data 还是debug_data
+    3. 从ROOT_FOLDER 开始，按照层级进行继承关系分析
+    合并的结果会缓存在进程内（参考 info_cascade.py）
 
     返回的字典数据形式：
     {'all_info':     {u'\u6307\u5bfc': u'\u9a6c\u4e01', u'FPS': u'23.98'},
@@ -155,29 +222,8 @@ def get_cascading_info(orm, info_name, debug=False):
     :return: dict
 
     '''
-    result = {'all_info': {}, 'private_info': {}, 'inherit_info': {}}
-    for x in orm.hierarchy[:-1]:
-        cascading_info = x.infos.filter(get_class('info').name == info_name).first()
-        if debug:
-            result['inherit_info'].update(dict(cascading_info.debug_data) if cascading_info else {})
-        else:
-            result['inherit_info'].update(dict(cascading_info.extra_data) if cascading_info else {})
-
-    private_info = orm.infos.filter(get_class('info').name == info_name).first()
-    if debug:
-        result['private_info'] = dict(private_info.debug_data) if private_info else {}
-    else:
-        result['private_info'] = dict(private_info.extra_data) if private_info else {}
-
-    for k in result['private_info']:
-        try:
-            result['inherit_info'].pop(k)
-        except:
-            pass
-
-    result['all_info'].update(result['inherit_info'])
-    result['all_info'].update(result['private_info'])
-    return result
+    import info_cascade
+    return info_cascade.resolve(orm, info_name, debug=debug)
 
 
 def get_next_depth(db_config_name, current_depth):
@@ -228,41 +274,24 @@ def get_next_depth(db_config_name, current_depth):
 def get_vfx_onset(orm):
     '''
     快速获得可能和某个orm 相关的onset metadata。
-    匹配的依据是如果orm.name(或者orm.name 的一部分) 出现在metadata FILE.vfx_clue 中，那么就认为是相关的。
+    匹配的依据是如果orm.name(或者orm.name 的一部分) 出现在metadata FILE.vfx_clue 或者cam_clue 中，那么就认为是相关的。
+    只需要一次走索引的查询（参考 clue_index.py）
     :param orm: FOLDER 或者FILE orm
     :return: generator
     '''
-    import dayu_database
-    import table
-    session = dayu_database.get_session()
-    for meta_file in session.query(table.FILE) \
-            .filter(table.FILE.meaning == 'METADATA') \
-            .filter(table.FILE.top == orm.top):
-        found = False
-        for vfx_match_name in meta_file.vfx_clue:
-            if vfx_match_name in ('ALL', '*'):
-                found = True
-                yield meta_file
-                break
-
-            if vfx_match_name in orm.name:
-                found = True
-                yield meta_file
-                break
+    for meta_file in get_vfx_onset_many([orm])[orm]:
+        yield meta_file
 
-        if found is True:
-            continue
 
-        for vfx_match_name in meta_file.cam_clue:
-            if vfx_match_name in ('ALL', '*'):
-                found = True
-                yield meta_file
-                break
-
-            if vfx_match_name in orm.name:
-                found = True
-                yield meta_file
-                break
+def get_vfx_onset_many(orms):
+    '''
+    批量获得多个orm 相关的onset metadata，用于报表这类需要处理整个sequence 的情况
+    :param orms: list of FOLDER 或者FILE orm
+    :return: dict，key 是orm，value 是metadata FILE orm 的list
+    '''
+    import dayu_database
+    import clue_index
+    return clue_index.find_many(dayu_database.get_session(), orms)
 
 
 def get_name_pattern(project_name, meaning):
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    FILE 自动版本号的分配。
+
+    原本insert_file 在FILE.name 为None 时，使用 parent.sub_files.filter(...)[-1] 得到最后一个版本，
+    sqlalchemy 会先count 然后offset 整个有序的列表；同时多个发布程序并发的时候，可能得到同一个版本号。
+
+    这里为每一个parent 保存一行计数器（table 的定义参考 init_db.table.version_counter_table）：
+    * 分配版本号只需要一条 UPDATE ... RETURNING，计数器的row lock 会持续到事务结束，并发的发布程序会依次得到不同的版本号
+    * 第一次分配时，根据parent 中已有的最后一个版本（或者 init_xxx_version 的继承设置）初始化计数器
+    * 用户手动指定了版本名的FILE，会通过 observe() 让计数器不小于这个版本号
+    * 批量发布时，可以通过 reserve() 一次预留多个版本号
+    * 如果数据库中还没有version_counter（旧的数据库需要先执行 init_db.migrate），
+      那么使用advisory lock 保护的 "最后一个版本" 查询，同样可以保证并发安全
+
+    '''
+
+
+def get_table():
+    '''
+    获得version_counter 的Table 对象。如果数据库中还没有这个table，返回None
+    :return: sqlalchemy Table 或者None
+    '''
+    import base
+    return base.BASE.metadata.tables.get('version_counter', None)
+
+
+def format_version(number, width):
+    '''
+    生成版本名，例如 format_version(3, 4) 得到 v0003
+    :param number: int
+    :param width: int，数字部分的位数
+    :return: string
+    '''
+    return 'v%0{}d'.format(width) % number
+
+
+def _seed(connection, parent_id, initial):
+    '''
+    根据parent 中已有的最后一个FILE，得到已经使用的最大版本号
+    :param connection: sqlalchemy connection
+    :param parent_id: parent FOLDER 的id
+    :param initial: 函数，parent 中没有任何FILE 时调用，返回初始的版本名（例如 v0001）
+    :return: tuple，(已经使用的最大版本号, 位数, None)。
+             如果无法解析版本号，返回 (None, None, 应该使用的名字)，没有应该使用的名字时为 (None, None, None)
+    '''
+    from sqlalchemy import select
+    import table
+
+    file_table = table.FILE.__table__
+    last_name = connection.execute(select([file_table.c.name])
+                                   .where(file_table.c.parent_id == parent_id)
+                                   .order_by(file_table.c.name.desc())
+                                   .limit(1)).scalar()
+    if last_name is None:
+        name = initial() if initial else 'v0001'
+        match = table.version_regex.match(str(name))
+        if match:
+            version_num = match.groups()[0]
+            return int(version_num) - 1, len(version_num), None
+        return None, None, name
+
+    match = table.version_regex.match(str(last_name))
+    if match:
+        version_num = match.groups()[0]
+        return int(version_num), len(version_num), None
+    return None, None, None
+
+
+def _allocate(connection, parent_id, count, initial):
+    '''
+    在parent 中分配count 个连续的版本号
+    :return: tuple，(分配之前已经使用的最大版本号, 位数, None)。如果parent 中的版本名无法解析，参考 _seed
+    '''
+    from sqlalchemy import func
+    from sqlalchemy.dialects.postgresql import insert
+
+    counter_table = get_table()
+    if counter_table is None:
+        # 没有计数器，使用advisory lock 让同一个parent 的分配依次进行
+        connection.execute(func.pg_advisory_xact_lock(parent_id).select())
+        return _seed(connection, parent_id, initial)
+
+    c = counter_table.c
+    row = connection.execute(counter_table.update()
+                             .where(c.parent_id == parent_id)
+                             .values(last_version=c.last_version + count)
+                             .returning(c.last_version, c.width)).first()
+    if row is None:
+        seed = _seed(connection, parent_id, initial)
+        if seed[0] is None:
+            return seed
+        statement = insert(counter_table).values(parent_id=parent_id,
+                                                 last_version=seed[0] + count,
+                                                 width=seed[1])
+        statement = statement.on_conflict_do_update(
+                index_elements=[c.parent_id],
+                set_={'last_version': c.last_version + count})
+        row = connection.execute(statement.returning(c.last_version, c.width)).first()
+
+    return row.last_version - count, row.width, None
+
+
+def allocate(connection, parent_id, count=1, initial=None):
+    '''
+    在parent 中分配count 个连续的版本名。分配的结果在当前事务提交之后才对其他事务可见。
+    :param connection: sqlalchemy connection（通常是监听函数传入的connection，或者 session.connection()）
+    :param parent_id: parent FOLDER 的id
+    :param count: int，需要分配的数量
+    :param initial: 函数，parent 中没有任何FILE 时调用，返回初始的版本名
+    :return: list of string。如果parent 中的版本名无法解析，raise Exception
+    '''
+    last_version, width, _ = _allocate(connection, parent_id, count, initial)
+    if last_version is None:
+        raise Exception('no version found in: {}'.format(parent_id))
+
+    return [format_version(x, width) for x in range(last_version + 1, last_version + count + 1)]
+
+
+def observe(connection, files):
+    '''
+    用户手动指定了版本名的FILE 写入之后，让计数器不小于其中的版本号，避免之后自动分配到重复的版本。
+    还没有计数器的parent 不需要处理，第一次分配的时候会根据已有的FILE 初始化。
+    :param connection: sqlalchemy connection
+    :param files: list of tuple，(parent_id, FILE 的name)
+    :return: None
+    '''
+    from sqlalchemy import func, bindparam
+    import table
+
+    counter_table = get_table()
+    if counter_table is None:
+        return
+
+    numbers = {}
+    for parent_id, name in files:
+        match = table.version_regex.match(str(name))
+        if match:
+            numbers[parent_id] = max(numbers.get(parent_id, 0), int(match.groups()[0]))
+    if not numbers:
+        return
+
+    c = counter_table.c
+    connection.execute(counter_table.update()
+                       .where(c.parent_id == bindparam('_parent_id'))
+                       .values(last_version=func.greatest(c.last_version, bindparam('_number'))),
+                       [{'_parent_id': k, '_number': v} for k, v in numbers.items()])
+
+
+def next_version(connection, target):
+    '''
+    为没有指定name 的FILE 分配下一个版本名。（在insert_file 中调用）
+    :param connection: sqlalchemy connection
+    :param target: FILE orm
+    :return: string 或者None
+    '''
+    import util
+
+    def initial():
+        cas_info = util.get_cascading_info(target, 'cascading_info')['all_info']
+        return cas_info.get('init_{}_version'.format(target.type_group_name), 'v0001')
+
+    last_version, width, fallback_name = _allocate(connection, target.parent_id, 1, initial)
+    if last_version is None:
+        # 无法解析版本号：parent 中没有FILE 时，使用 init_xxx_version 原本的名字；否则和原来一样，不自动命名
+        return fallback_name
+
+    return format_version(last_version + 1, width)
+
+
+def reserve(parent, count, session=None):
+    '''
+    批量发布时，预先在parent 中预留count 个版本名。
+    预留的版本名在session 提交之后生效，之后使用 FILE(name=预留的版本名, parent=parent) 创建即可。
+    :param parent: FOLDER orm
+    :param count: int
+    :param session: sqlalchemy session，默认使用parent 所在的session
+    :return: list of string，例如 ['v0003', 'v0004', 'v0005']
+    '''
+    from sqlalchemy.orm import object_session
+    import dayu_database
+    import util
+
+    session = session or object_session(parent) or dayu_database.get_session()
+
+    def initial():
+        cas_info = util.get_cascading_info(parent, 'cascading_info')['all_info']
+        return cas_info.get('init_{}_version'.format(parent.type_group_name), 'v0001')
+
+    return allocate(session.connection(), parent.id, count, initial)
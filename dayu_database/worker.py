@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+__author__ = 'andyguo'
+__doc__ = \
+    '''
+    多进程并行使用数据库的helper。
+
+    fork 出的子进程会丢弃从父进程继承的连接（参考 engine.py），所以直接使用 multiprocessing 也是安全的。
+    这里的 process_pool() 额外保证每一个worker 进程在开始工作之前，就已经拥有了连接好的DayuDatabase：
+    * fork 方式启动的worker，丢弃继承的连接池，重新连接
+    * 没有继承父进程状态的worker（例如windows），使用父进程的DayuDatabaseConfig 重新connect()
+
+    使用方法：
+        from dayu_database import worker
+
+        def publish(shot_name):
+            session = dayu_database.get_session()
+            ...
+            session.commit()
+
+        pool = worker.process_pool(processes=8)
+        results = pool.map(publish, shot_names)
+        pool.close()
+        pool.join()
+
+    python2 的标准库中没有 concurrent.futures，所以返回的是 multiprocessing.Pool。
+
+    '''
+
+
+def _export_config(db=None):
+    '''
+    获得可以传给子进程的DayuDatabaseConfig 内容（去掉parent）
+    :param db: string，数据库的名字
+    :return: dict
+    '''
+    import dayu_database
+    return {k: v for k, v in dayu_database.get_db(db).config.items() if k != 'parent'}
+
+
+def init_worker(db=None, config=None):
+    '''
+    worker 进程的初始化函数。让当前进程拥有一个可以使用的DayuDatabase
+    :param db: string，数据库的名字
+    :param config: dict，DayuDatabaseConfig 的内容。只有当前进程中的DayuDatabase 还没有connect() 时才会使用
+    :return: DayuDatabase
+    '''
+    import dayu_database
+    import engine
+    from status import DayuDatabaseStatusNotConnect
+
+    engine.check_fork()
+    db_obj = dayu_database.get_db(db)
+    if db_obj.status is DayuDatabaseStatusNotConnect:
+        if config:
+            db_obj.config.update(**config)
+        db_obj.connect()
+    return db_obj
+
+
+def process_pool(processes=None, db=None, initializer=None, initargs=(), **kwargs):
+    '''
+    创建一个进程池，每一个worker 进程都会先初始化自己的数据库连接
+    :param processes: int，进程的数量，默认是cpu 的数量
+    :param db: string，数据库的名字
+    :param initializer: 函数，数据库初始化之后，每一个worker 额外执行的初始化函数
+    :param initargs: tuple，initializer 的参数
+    :param kwargs: 其他传给 multiprocessing.Pool 的参数
+    :return: multiprocessing.Pool
+    '''
+    import multiprocessing
+
+    return multiprocessing.Pool(processes=processes,
+                                initializer=_initialize,
+                                initargs=(db, _export_config(db), initializer, initargs),
+                                **kwargs)
+
+
+def _initialize(db, config, initializer, initargs):
+    init_worker(db=db, config=config)
+    if initializer is not None:
+        initializer(*initargs)